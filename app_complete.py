@@ -1,46 +1,33 @@
 import streamlit as st
-import pickle
-import os
-from datetime import datetime, timedelta
+from streamlit.errors import StreamlitAPIException
+from datetime import datetime
+import metrics
+import search
+import services
+from storage import get_store
 
-STORAGE_FILE = "study_buddy_data.pkl"
+# Data file; a name ending in .db keeps the records in SQLite (create one with sqlite_storage.py),
+# a directory ending in .shards partitions them by user (create one with sharding.py)
+DATA_FILE = "study_buddy_data.pkl"
 
-def load_persistent_data():
-    if os.path.exists(STORAGE_FILE):
-        try:
-            with open(STORAGE_FILE, 'rb') as f:
-                return pickle.load(f)
-        except:
-            pass
-    
-    return {
-        "accounts": {
-            "admin": "password123",
-            "alice": "alice123",
-            "bob": "bob123",
-            "carol": "carol123",
-            "david": "david123",
-            "emma": "emma123"
-        },
-        "users": {
-            "alice": {"name": "Alice Chen", "subjects": ["Math", "Physics"], "interests": ["Technology", "Reading"], "study_style": "Visual", "availability": ["Morning", "Evening"]},
-            "bob": {"name": "Bob Martinez", "subjects": ["Computer Science", "Math"], "interests": ["Gaming", "Technology"], "study_style": "Kinesthetic", "availability": ["Afternoon", "Evening"]},
-            "carol": {"name": "Carol Johnson", "subjects": ["Biology", "Chemistry"], "interests": ["Sports", "Music"], "study_style": "Auditory", "availability": ["Morning", "Weekend"]},
-            "david": {"name": "David Kim", "subjects": ["Physics", "Math"], "interests": ["Technology", "Movies"], "study_style": "Visual", "availability": ["Evening", "Weekend"]},
-            "emma": {"name": "Emma Wilson", "subjects": ["Literature", "History"], "interests": ["Reading", "Art"], "study_style": "Reading/Writing", "availability": ["Morning", "Afternoon"]}
-        },
-        "invitations": [],
-        "invitation_counter": 0,
-        "messages": [],
-        "message_counter": 0,
-        "sessions": [],
-        "session_counter": 0,
-        "feedback": []
-    }
+# Messages shown per chat page; older pages are fetched with "Load older messages"
+CHAT_PAGE_SIZE = 20
 
-def save_persistent_data(data):
-    with open(STORAGE_FILE, 'wb') as f:
-        pickle.dump(data, f)
+# Hits shown per page of search results
+SEARCH_PAGE_SIZE = 10
+
+# Seconds between live refreshes of the Chat and Invitations views (None turns them off);
+# a refresh reruns only that view and fetches only what the event bus reports as new
+LIVE_REFRESH_SECONDS = 3
+
+# Use MinHash/LSH candidates instead of the exact ranking (for multi-campus deployments)
+APPROXIMATE_MATCHING = False
+
+AVAILABILITY_OPTIONS = ["Morning", "Afternoon", "Evening", "Weekend"]
+STUDY_STYLES = ["Visual", "Auditory", "Kinesthetic", "Reading/Writing"]
+
+# Account that sees the performance page instead of the student views
+ADMIN_USER = "admin"
 
 def init_session():
     if 'logged_in' not in st.session_state:
@@ -48,548 +35,608 @@ def init_session():
     if 'current_user' not in st.session_state:
         st.session_state.current_user = None
 
-def calculate_match_score(user1, user2):
-    score = 0
-    common_subjects = len(set(user1["subjects"]) & set(user2["subjects"]))
-    total_subjects = len(set(user1["subjects"]) | set(user2["subjects"]))
-    score += (common_subjects / total_subjects) * 0.4 if total_subjects > 0 else 0
-    
-    common_times = len(set(user1["availability"]) & set(user2["availability"]))
-    total_times = len(set(user1["availability"]) | set(user2["availability"]))
-    score += (common_times / total_times) * 0.3 if total_times > 0 else 0
-    
-    common_interests = len(set(user1["interests"]) & set(user2["interests"]))
-    total_interests = len(set(user1["interests"]) | set(user2["interests"]))
-    score += (common_interests / total_interests) * 0.2 if total_interests > 0 else 0
-    
-    score += 0.1 if user1["study_style"] == user2["study_style"] else 0.05
-    
-    return score
-
-def get_accepted_buddies(username, data):
+def get_accepted_buddies(username, store):
     """Get list of accepted study buddies"""
-    buddies = []
-    for inv in data["invitations"]:
-        if inv["status"] == "accepted":
-            if inv["from_username"] == username:
-                buddies.append(inv["to_username"])
-            elif inv["to_username"] == username:
-                buddies.append(inv["from_username"])
-    return list(set(buddies))
+    return services.buddies(store, username)
 
-def get_unread_count(username, buddy_username, data):
+def get_unread_count(username, buddy_username, store):
     """Count unread messages from a buddy"""
-    if "messages" not in data:
-        data["messages"] = []
-    count = 0
-    for msg in data["messages"]:
-        if msg["to_username"] == username and msg["from_username"] == buddy_username and not msg.get("read", False):
-            count += 1
-    return count
+    return store.unread_count(username, buddy_username)
 
-def main():
-    st.set_page_config(page_title="Study Buddy Matchmaker", page_icon="🎓", layout="wide")
-    init_session()
+@st.cache_data(max_entries=256, show_spinner=False)
+def profile_choices(_store, field, current, version):
+    """Profile form options; recomputed only when some profile changed (`version`)"""
+    return services.profile_choices(_store, field, current)
+
+def rerun_view():
+    """Rerun just the fragment being drawn; a full rerun when the whole page is running"""
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
+def logout():
+    st.session_state.logged_in = False
+    st.session_state.current_user = None
+    # Clear matches when logging out
+    st.session_state.show_matches = False
+    st.session_state.matches_list = []
+    st.rerun()
+
+def admin_page(store):
+    """Instrumentation switches, collected metrics, profiler output and Prometheus export"""
+    col1, col2 = st.columns([4, 1])
+    with col1:
+        st.header("🛠️ Performance")
+    with col2:
+        if st.button("Logout", type="secondary"):
+            logout()
     
-    data = load_persistent_data()
+    col1, col2 = st.columns(2)
+    with col1:
+        collect = st.toggle("Collect metrics", value=metrics.ENABLED)
+        if collect != metrics.ENABLED:
+            metrics.enable(collect)
+    with col2:
+        profiling = st.toggle("Sampling profiler", value=metrics.profiler_running())
+        if profiling and not metrics.profiler_running():
+            metrics.start_profiler()
+        elif not profiling and metrics.profiler_running():
+            metrics.stop_profiler()
     
-    st.title("🎓 Smart Study Buddy Matchmaker")
-    st.caption("AI-Powered Study Partner Matching System")
+    summary = metrics.summary()
+    if summary["histograms"]:
+        st.subheader("⏱️ Latencies (seconds), sizes and scan lengths")
+        st.dataframe(summary["histograms"], use_container_width=True, hide_index=True)
+    if summary["counters"]:
+        st.subheader("🔢 Counters")
+        st.dataframe(summary["counters"], use_container_width=True, hide_index=True)
+    if not summary["histograms"] and not summary["counters"]:
+        st.info("No metrics yet. Turn on collection and use the app in another tab.")
     
-    if not st.session_state.logged_in:
-        st.header("🔐 Login")
-        
-        with st.form("login_form"):
-            username = st.text_input("Username")
-            password = st.text_input("Password", type="password")
-            submitted = st.form_submit_button("Login", type="primary")
-            
-            if submitted:
-                if username in data["accounts"] and data["accounts"][username] == password:
-                    st.session_state.logged_in = True
-                    st.session_state.current_user = username
-                    st.success(f"✅ Welcome, {data['users'][username]['name']}!")
-                    st.rerun()
-                else:
-                    st.error("❌ Invalid credentials")
+    report = metrics.profiler_report()
+    if report and report["samples"]:
+        st.subheader(f"🔬 Profile: {report['samples']} samples over {report['seconds']:.0f}s")
+        col1, col2 = st.columns(2)
+        with col1:
+            st.caption("Innermost function")
+            st.dataframe(report["self"], use_container_width=True, hide_index=True)
+        with col2:
+            st.caption("Anywhere on the stack")
+            st.dataframe(report["total"], use_container_width=True, hide_index=True)
     
-    else:
-        col1, col2, col3 = st.columns([3, 1, 1])
+    st.divider()
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        if st.button("💾 Write Prometheus file", use_container_width=True):
+            st.success(f"Wrote {metrics.write_prometheus()}")
+    with col2:
+        st.download_button("⬇️ Download metrics", metrics.prometheus_text(), file_name=metrics.METRICS_FILE,
+                           mime="text/plain", use_container_width=True)
+    with col3:
+        if st.button("🗑️ Reset metrics", use_container_width=True):
+            metrics.reset()
+            st.rerun()
+    
+    st.divider()
+    st.subheader("🔍 Search all messages and feedback")
+    query = st.text_input("Search", key="admin_search", label_visibility="collapsed")
+    if query.strip():
+        search_results(store, None, query, "admin")
+
+def search_results(store, username, query, key):
+    """Ranked, paginated message and feedback comment hits for a user (everyone for None)"""
+    if 'search_pages' not in st.session_state:
+        st.session_state.search_pages = {}
+    sections = [("messages", "💬 Messages", services.search_messages),
+                ("feedback", "📝 Feedback Comments", services.search_feedback)]
+    for kind, title, find in sections:
+        page_key = (key, kind, query)
+        page = st.session_state.search_pages.get(page_key, 1)
+        hits, total = find(store, username, query, page, SEARCH_PAGE_SIZE)
+        st.subheader(f"{title} ({total}{'+' if total >= search.MAX_MATCHES else ''})")
+        if not hits:
+            st.info("No matches")
+            continue
+        for record, score in hits:
+            if kind == "messages":
+                text = record["message"]
+                who = f"{services.display_name(store, record['from_username'])} → {services.display_name(store, record['to_username'])}"
+            else:
+                text = record["comments"]
+                who = f"{services.display_name(store, record['from_username'])} about {services.display_name(store, record['partner_username'])}"
+            st.markdown(search.highlight(text, query))
+            st.caption(f"{who} | {record['timestamp']}")
+        pages = -(-total // SEARCH_PAGE_SIZE)
+        if pages > 1:
+            col1, col2, col3 = st.columns([1, 2, 1])
+            with col1:
+                if st.button("⬅️ Previous", key=f"{key}_{kind}_prev", disabled=page == 1, use_container_width=True):
+                    st.session_state.search_pages[page_key] = page - 1
+                    rerun_view()
+            with col2:
+                st.caption(f"Page {page} of {pages}")
+            with col3:
+                if st.button("Next ➡️", key=f"{key}_{kind}_next", disabled=page == pages, use_container_width=True):
+                    st.session_state.search_pages[page_key] = page + 1
+                    rerun_view()
+
+def matches_view(store, username):
+    st.header("Find Your Perfect Study Match")
+    
+    current_user = store.data["users"][username]
+    version = services.profile_version(store)
+    
+    with st.expander("📋 My Profile"):
+        col1, col2 = st.columns(2)
         with col1:
-            st.write(f"### 👤 {data['users'][st.session_state.current_user]['name']}")
+            st.write("**Subjects:**", ", ".join(current_user["subjects"]))
+            st.write("**Study Style:**", current_user["study_style"])
         with col2:
-            buddies = get_accepted_buddies(st.session_state.current_user, data)
-            st.metric("Study Buddies", len(buddies))
-        with col3:
-            if st.button("Logout", type="secondary"):
-                st.session_state.logged_in = False
-                st.session_state.current_user = None
-                # Clear matches when logging out
+            st.write("**Interests:**", ", ".join(current_user["interests"]))
+            st.write("**Availability:**", ", ".join(current_user["availability"]))
+        
+        with st.form("edit_profile"):
+            subjects = st.multiselect("Subjects", profile_choices(store, "subjects", tuple(current_user["subjects"]), version),
+                                      default=current_user["subjects"])
+            interests = st.multiselect("Interests", profile_choices(store, "interests", tuple(current_user["interests"]), version),
+                                       default=current_user["interests"])
+            availability = st.multiselect("Availability", AVAILABILITY_OPTIONS, default=current_user["availability"])
+            study_style = st.selectbox("Study Style", STUDY_STYLES,
+                                       index=STUDY_STYLES.index(current_user["study_style"]) if current_user["study_style"] in STUDY_STYLES else 0)
+            
+            if st.form_submit_button("💾 Update Profile"):
+                services.update_profile(store, username, subjects=subjects, interests=interests,
+                                        availability=availability, study_style=study_style)
                 st.session_state.show_matches = False
                 st.session_state.matches_list = []
+                st.success("Profile updated!")
                 st.rerun()
+    
+    # Initialize or check if matches belong to current user
+    if 'show_matches' not in st.session_state:
+        st.session_state.show_matches = False
+    if 'matches_list' not in st.session_state:
+        st.session_state.matches_list = []
+    if 'matches_for_user' not in st.session_state:
+        st.session_state.matches_for_user = None
+    
+    # Reset matches if user changed
+    if st.session_state.matches_for_user != username:
+        st.session_state.show_matches = False
+        st.session_state.matches_list = []
+        st.session_state.matches_for_user = username
+    
+    if st.button("🎯 Find Compatible Study Partners", type="primary", use_container_width=True):
+        st.session_state.show_matches = True
+        st.session_state.matches_for_user = username
+        st.session_state.matches_list = services.find_partners(store, username, k=5, approximate=APPROXIMATE_MATCHING)
+    
+    if st.session_state.show_matches and st.session_state.matches_list:
+        st.success(f"✨ Found {len(st.session_state.matches_list)} compatible study partners!")
+        st.write("")
         
-        st.divider()
-        
-        tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs(["🔍 Find Matches", "📬 Invitations", "💬 Chat", "📅 Study Sessions", "⭐ Feedback", "📊 Dashboard"])
-        
-        with tab1:
-            st.header("Find Your Perfect Study Match")
+        for i, (partner, user_info, score) in enumerate(st.session_state.matches_list, 1):
+            match_pct = int(score * 100)
             
-            current_user = data["users"][st.session_state.current_user]
+            if match_pct >= 70:
+                badge = "🟢 Excellent"
+            elif match_pct >= 50:
+                badge = "🟡 Good"
+            else:
+                badge = "🟠 Fair"
             
-            with st.expander("📋 My Profile"):
-                col1, col2 = st.columns(2)
-                with col1:
-                    st.write("**Subjects:**", ", ".join(current_user["subjects"]))
-                    st.write("**Study Style:**", current_user["study_style"])
-                with col2:
-                    st.write("**Interests:**", ", ".join(current_user["interests"]))
-                    st.write("**Availability:**", ", ".join(current_user["availability"]))
+            with st.container():
+                st.write(f"### {i}. {user_info['name']}")
+                st.progress(match_pct / 100)
+                st.caption(f"Compatibility Score: {match_pct}% {badge}")
             
-            # Initialize or check if matches belong to current user
-            if 'show_matches' not in st.session_state:
-                st.session_state.show_matches = False
-            if 'matches_list' not in st.session_state:
-                st.session_state.matches_list = []
-            if 'matches_for_user' not in st.session_state:
-                st.session_state.matches_for_user = None
+            col1, col2, col3 = st.columns([2, 2, 1])
             
-            # Reset matches if user changed
-            if st.session_state.matches_for_user != st.session_state.current_user:
-                st.session_state.show_matches = False
-                st.session_state.matches_list = []
-                st.session_state.matches_for_user = st.session_state.current_user
+            with col1:
+                st.write("**📚 Subjects:**", ", ".join(user_info["subjects"]))
+                st.write("**🎨 Interests:**", ", ".join(user_info["interests"]))
             
-            if st.button("🎯 Find Compatible Study Partners", type="primary", use_container_width=True):
-                st.session_state.show_matches = True
-                st.session_state.matches_for_user = st.session_state.current_user
-                matches = []
-                for username, user_info in data["users"].items():
-                    if username != st.session_state.current_user:
-                        score = calculate_match_score(current_user, user_info)
-                        matches.append((username, user_info, score))
-                
-                matches.sort(key=lambda x: x[2], reverse=True)
-                st.session_state.matches_list = matches[:5]
+            with col2:
+                st.write("**📖 Style:**", user_info["study_style"])
+                st.write("**⏰ Available:**", ", ".join(user_info["availability"]))
             
-            if st.session_state.show_matches and st.session_state.matches_list:
-                st.success(f"✨ Found {len(st.session_state.matches_list)} compatible study partners!")
-                st.write("")
-                
-                for i, (username, user_info, score) in enumerate(st.session_state.matches_list, 1):
-                    match_pct = int(score * 100)
-                    
-                    if match_pct >= 70:
-                        badge = "🟢 Excellent"
-                    elif match_pct >= 50:
-                        badge = "🟡 Good"
+            with col3:
+                if store.has_sent_invitation(username, partner):
+                    st.button("✅ Sent", key=f"sent_{i}", disabled=True, use_container_width=True)
+                elif st.button("📨 Invite", key=f"invite_{i}", type="primary", use_container_width=True):
+                    if services.send_invitation(store, username, partner, score):
+                        st.balloons()
+                        st.success(f"🎉 Invitation sent to {user_info['name']}!")
+                        st.rerun()
                     else:
-                        badge = "🟠 Fair"
-                    
-                    with st.container():
-                        st.write(f"### {i}. {user_info['name']}")
-                        st.progress(match_pct / 100)
-                        st.caption(f"Compatibility Score: {match_pct}% {badge}")
-                    
-                    col1, col2, col3 = st.columns([2, 2, 1])
-                    
-                    with col1:
-                        st.write("**📚 Subjects:**", ", ".join(user_info["subjects"]))
-                        st.write("**🎨 Interests:**", ", ".join(user_info["interests"]))
-                    
-                    with col2:
-                        st.write("**📖 Style:**", user_info["study_style"])
-                        st.write("**⏰ Available:**", ", ".join(user_info["availability"]))
-                    
-                    with col3:
-                        already_sent = any(inv["to_username"] == username and inv["from_username"] == st.session_state.current_user 
-                                         for inv in data["invitations"])
-                        
-                        if already_sent:
-                            st.button("✅ Sent", key=f"sent_{i}", disabled=True, use_container_width=True)
-                        else:
-                            if st.button("📨 Invite", key=f"invite_{i}", type="primary", use_container_width=True):
-                                data["invitation_counter"] += 1
-                                invitation = {
-                                    "id": data["invitation_counter"],
-                                    "from_username": st.session_state.current_user,
-                                    "from_name": current_user["name"],
-                                    "to_username": username,
-                                    "to_name": user_info["name"],
-                                    "match_score": score,
-                                    "status": "pending",
-                                    "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                                }
-                                data["invitations"].append(invitation)
-                                save_persistent_data(data)
-                                
-                                st.balloons()
-                                st.success(f"🎉 Invitation sent to {user_info['name']}!")
-                                st.rerun()
-                    
-                    st.divider()
-        
-        with tab2:
-            st.header("Study Partner Invitations")
-            
-            received = [inv for inv in data["invitations"] if inv["to_username"] == st.session_state.current_user]
-            sent = [inv for inv in data["invitations"] if inv["from_username"] == st.session_state.current_user]
+                        st.warning(f"An invitation to {user_info['name']} was already sent")
             
-            st.subheader(f"📨 Received Invitations ({len(received)})")
-            
-            if received:
-                for inv in received:
-                    match_pct = int(inv["match_score"] * 100)
-                    
-                    col1, col2 = st.columns([3, 1])
-                    
-                    with col1:
-                        st.write(f"### From: {inv['from_name']}")
-                        st.write(f"**Compatibility:** {match_pct}%")
-                        st.write(f"**Status:** {inv['status'].title()}")
-                        st.caption(f"Sent: {inv['timestamp']}")
-                    
-                    with col2:
-                        if inv["status"] == "pending":
-                            if st.button("✅ Accept", key=f"accept_{inv['id']}", type="primary", use_container_width=True):
-                                for invitation in data["invitations"]:
-                                    if invitation["id"] == inv["id"]:
-                                        invitation["status"] = "accepted"
-                                save_persistent_data(data)
-                                st.success("Accepted!")
-                                st.rerun()
-                            
-                            if st.button("❌ Decline", key=f"decline_{inv['id']}", use_container_width=True):
-                                for invitation in data["invitations"]:
-                                    if invitation["id"] == inv["id"]:
-                                        invitation["status"] = "declined"
-                                save_persistent_data(data)
-                                st.info("Declined")
-                                st.rerun()
-                    
-                    st.divider()
-            else:
-                st.info("No invitations received yet")
+            st.divider()
+
+@st.fragment(run_every=LIVE_REFRESH_SECONDS)
+def invitations_view(store, username):
+    # New invitations and answers show up on the next live refresh tick
+    store.refresh()
+    st.header("Study Partner Invitations")
+    
+    received, sent = services.invitations(store, username)
+    
+    st.subheader(f"📨 Received Invitations ({len(received)})")
+    
+    if received:
+        for inv in received:
+            match_pct = int(inv["match_score"] * 100)
             
-            st.write("")
-            st.subheader(f"📤 Sent Invitations ({len(sent)})")
+            col1, col2 = st.columns([3, 1])
             
-            if sent:
-                for inv in sent:
-                    status_emoji = {"pending": "⏳", "accepted": "✅", "declined": "❌"}[inv["status"]]
-                    match_pct = int(inv["match_score"] * 100)
-                    with st.container():
-                        col1, col2, col3 = st.columns([2, 1, 1])
-                        with col1:
-                            st.write(f"{status_emoji} **{inv['to_name']}**")
-                        with col2:
-                            st.write(f"Compatibility: {match_pct}%")
-                        with col3:
-                            st.write(f"{inv['status'].title()}")
-                        st.caption(inv['timestamp'])
-                        st.divider()
-            else:
-                st.info("No invitations sent yet. Visit 'Find Matches' to connect with study partners!")
-        
-        with tab3:
-            st.header("💬 Chat with Study Partners")
+            with col1:
+                st.write(f"### From: {services.display_name(store, inv['from_username'])}")
+                st.write(f"**Compatibility:** {match_pct}%")
+                st.write(f"**Status:** {inv['status'].title()}")
+                st.caption(f"Sent: {inv['timestamp']}")
             
-            buddies = get_accepted_buddies(st.session_state.current_user, data)
+            with col2:
+                if inv["status"] == "pending":
+                    if st.button("✅ Accept", key=f"accept_{inv['id']}", type="primary", use_container_width=True):
+                        if services.respond_to_invitation(store, inv["id"], accept=True):
+                            st.success("Accepted!")
+                        st.rerun()
+                    
+                    if st.button("❌ Decline", key=f"decline_{inv['id']}", use_container_width=True):
+                        if services.respond_to_invitation(store, inv["id"], accept=False):
+                            st.info("Declined")
+                        st.rerun()
             
-            if buddies:
-                col1, col2 = st.columns([1, 3])
-                
+            st.divider()
+    else:
+        st.info("No invitations received yet")
+    
+    st.write("")
+    st.subheader(f"📤 Sent Invitations ({len(sent)})")
+    
+    if sent:
+        for inv in sent:
+            status_emoji = {"pending": "⏳", "accepted": "✅", "declined": "❌"}[inv["status"]]
+            match_pct = int(inv["match_score"] * 100)
+            with st.container():
+                col1, col2, col3 = st.columns([2, 1, 1])
                 with col1:
-                    st.subheader("Active Chats")
-                    
-                    if 'selected_buddy' not in st.session_state:
-                        st.session_state.selected_buddy = buddies[0]
-                    
-                    for buddy in buddies:
-                        unread = get_unread_count(st.session_state.current_user, buddy, data)
-                        buddy_name = data["users"][buddy]["name"]
-                        
-                        button_label = f"{buddy_name}"
-                        if unread > 0:
-                            button_label += f" ({unread} new)"
-                        
-                        if st.button(button_label, key=f"buddy_{buddy}", use_container_width=True):
-                            st.session_state.selected_buddy = buddy
-                            # Mark messages as read
-                            for msg in data["messages"]:
-                                if msg["to_username"] == st.session_state.current_user and msg["from_username"] == buddy:
-                                    msg["read"] = True
-                            save_persistent_data(data)
-                            st.rerun()
-                
+                    st.write(f"{status_emoji} **{services.display_name(store, inv['to_username'])}**")
                 with col2:
-                    selected_buddy = st.session_state.selected_buddy
-                    buddy_name = data["users"][selected_buddy]["name"]
-                    
-                    st.subheader(f"💬 {buddy_name}")
-                    
-                    # Display messages
-                    if "messages" not in data:
-                        data["messages"] = []
-                    messages = [msg for msg in data["messages"] 
-                               if (msg["from_username"] == st.session_state.current_user and msg["to_username"] == selected_buddy) or
-                                  (msg["from_username"] == selected_buddy and msg["to_username"] == st.session_state.current_user)]
-                    
-                    messages.sort(key=lambda x: x["timestamp"])
-                    
-                    # Chat container
-                    chat_container = st.container(height=400)
-                    with chat_container:
-                        if messages:
-                            for msg in messages:
-                                if msg["from_username"] == st.session_state.current_user:
-                                    with st.chat_message("user"):
-                                        st.write(msg["message"])
-                                        st.caption(msg["timestamp"])
-                                else:
-                                    with st.chat_message("assistant"):
-                                        st.write(msg["message"])
-                                        st.caption(msg["timestamp"])
-                        else:
-                            st.info("No messages yet. Start the conversation!")
-                    
-                    # Message input
-                    message_input = st.chat_input("Type your message...")
-                    
-                    if message_input:
-                        if "message_counter" not in data:
-                            data["message_counter"] = 0
-                        data["message_counter"] += 1
-                        new_message = {
-                            "id": data["message_counter"],
-                            "from_username": st.session_state.current_user,
-                            "to_username": selected_buddy,
-                            "message": message_input,
-                            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                            "read": False
-                        }
-                        data["messages"].append(new_message)
-                        save_persistent_data(data)
-                        st.rerun()
-            else:
-                st.info("No active study partners yet. Accept invitations to start chatting!")
+                    st.write(f"Compatibility: {match_pct}%")
+                with col3:
+                    st.write(f"{inv['status'].title()}")
+                st.caption(inv['timestamp'])
+                st.divider()
+    else:
+        st.info("No invitations sent yet. Visit 'Find Matches' to connect with study partners!")
+
+    # Archive files are only read once asked for
+    if st.toggle("🗄️ Show archived invitations", key="show_archived_invitations"):
+        archived = services.archived_invitations(store, username)
+        for inv in archived:
+            sent_by_me = inv["from_username"] == username
+            who = services.display_name(store, inv["to_username"] if sent_by_me else inv["from_username"])
+            st.write(f"❌ {'To' if sent_by_me else 'From'} **{who}** — {inv['status'].title()}")
+            st.caption(inv["timestamp"])
+        if not archived:
+            st.info("No archived invitations")
+
+def live_messages(store, username, buddy_username, pages):
+    """Messages of the open chat kept in the session; when the event bus reports
+    new messages for the user only the ones after the last seen id are fetched.
+    Only the open chat is kept, and at most `pages` pages of it."""
+    version = services.events_version(store, username, "message")
+    key = (username, buddy_username)
+    cached = st.session_state.get('chat_cache', {}).get(key)
+    if cached is None or cached["pages"] != pages:
+        messages, has_older = services.chat_messages(store, username, buddy_username, pages, CHAT_PAGE_SIZE)
+        cached = {"messages": [dict(msg.items()) for msg in messages], "has_older": has_older, "pages": pages,
+                  "version": version}
+    elif cached["version"] != version:
+        last_id = cached["messages"][-1]["id"] if cached["messages"] else 0
+        cached["messages"].extend(dict(msg.items()) for msg in services.new_messages(store, username, buddy_username, last_id))
+        cached["version"] = version
+        excess = len(cached["messages"]) - pages * CHAT_PAGE_SIZE
+        if excess > 0:
+            del cached["messages"][:excess]
+            cached["has_older"] = True
+    st.session_state.chat_cache = {key: cached}
+    return cached["messages"], cached["has_older"]
+
+@st.fragment(run_every=LIVE_REFRESH_SECONDS)
+def chat_view(store, username):
+    # Picking a chat, sending a message and every live refresh tick rerun only this view
+    store.refresh()
+    st.header("💬 Chat with Study Partners")
+    
+    buddies = services.buddies(store, username)
+    
+    if buddies:
+        col1, col2 = st.columns([1, 3])
+        
+        if st.session_state.get('selected_buddy') not in buddies:
+            st.session_state.selected_buddy = buddies[0]
         
-        with tab4:
-            st.header("📅 Schedule & Manage Study Sessions")
+        with col2:
+            selected_buddy = st.session_state.selected_buddy
             
-            buddies = get_accepted_buddies(st.session_state.current_user, data)
+            st.subheader(f"💬 {services.display_name(store, selected_buddy)}")
             
-            if buddies:
-                st.subheader("📝 Schedule New Study Session")
-                
-                with st.form("schedule_session"):
-                    buddy = st.selectbox("Study Partner", [data["users"][b]["name"] for b in buddies])
-                    session_date = st.date_input("Date", min_value=datetime.now().date())
-                    session_time = st.time_input("Time")
-                    duration = st.selectbox("Duration", ["30 min", "1 hour", "1.5 hours", "2 hours", "3 hours"])
-                    location = st.selectbox("Location", ["Library", "Online (Zoom)", "Online (Google Meet)", "Cafe", "Study Room", "Other"])
-                    subject = st.text_input("Subject/Topic")
-                    notes = st.text_area("Notes (optional)")
-                    
-                    if st.form_submit_button("📅 Schedule Session", type="primary"):
-                        buddy_username = [u for u, d in data["users"].items() if d["name"] == buddy][0]
-                        
-                        if "session_counter" not in data:
-                            data["session_counter"] = 0
-                        if "sessions" not in data:
-                            data["sessions"] = []
-                        data["session_counter"] += 1
-                        session = {
-                            "id": data["session_counter"],
-                            "user1": st.session_state.current_user,
-                            "user2": buddy_username,
-                            "date": session_date.strftime("%Y-%m-%d"),
-                            "time": session_time.strftime("%H:%M"),
-                            "duration": duration,
-                            "location": location,
-                            "subject": subject,
-                            "notes": notes,
-                            "status": "scheduled",
-                            "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        }
-                        data["sessions"].append(session)
-                        save_persistent_data(data)
-                        
-                        st.success(f"✅ Session scheduled with {buddy}!")
-                        st.balloons()
-                        st.rerun()
-                
-                st.divider()
-                st.subheader("📆 Upcoming Study Sessions")
-                
-                if "sessions" not in data:
-                    data["sessions"] = []
-                my_sessions = [s for s in data["sessions"] 
-                              if (s["user1"] == st.session_state.current_user or s["user2"] == st.session_state.current_user) 
-                              and s["status"] == "scheduled"]
-                
-                if my_sessions:
-                    for session in sorted(my_sessions, key=lambda x: x["date"]):
-                        partner = session["user2"] if session["user1"] == st.session_state.current_user else session["user1"]
-                        partner_name = data["users"][partner]["name"]
-                        
-                        with st.expander(f"📚 {session['subject']} with {partner_name}", expanded=False):
-                            st.write(f"**📅 Date:** {session['date']}")
-                            st.write(f"**🕐 Time:** {session['time']}")
-                            col1, col2 = st.columns([2, 1])
-                            
-                            with col1:
-                                st.write(f"**Duration:** {session['duration']}")
-                                st.write(f"**Location:** {session['location']}")
-                                if session['notes']:
-                                    st.write(f"**Notes:** {session['notes']}")
-                            
-                            with col2:
-                                if st.button("✅ Complete", key=f"complete_{session['id']}", use_container_width=True):
-                                    for s in data["sessions"]:
-                                        if s["id"] == session["id"]:
-                                            s["status"] = "completed"
-                                    save_persistent_data(data)
-                                    st.success("Session completed!")
-                                    st.rerun()
-                                
-                                if st.button("❌ Cancel", key=f"cancel_{session['id']}", use_container_width=True):
-                                    for s in data["sessions"]:
-                                        if s["id"] == session["id"]:
-                                            s["status"] = "cancelled"
-                                    save_persistent_data(data)
-                                    st.info("Session cancelled")
-                                    st.rerun()
+            # Chat container, filled once a message typed below has been sent
+            chat_container = st.container(height=400)
+            
+            # Message input; the message shows up in this same run, no extra rerun needed
+            message_input = st.chat_input("Type your message...")
+            
+            if message_input:
+                services.send_message(store, username, selected_buddy, message_input)
+            
+            # Display messages, newest page first; older pages load on demand
+            if 'chat_pages' not in st.session_state:
+                st.session_state.chat_pages = {}
+            pages = st.session_state.chat_pages.get(selected_buddy, 1)
+            messages, has_older = live_messages(store, username, selected_buddy, pages)
+            
+            with chat_container:
+                if has_older:
+                    if st.button("⬆️ Load older messages", key=f"older_{selected_buddy}", use_container_width=True):
+                        st.session_state.chat_pages[selected_buddy] = pages + 1
+                        rerun_view()
+                if messages:
+                    for msg in messages:
+                        with st.chat_message("user" if msg["from_username"] == username else "assistant"):
+                            st.write(msg["message"])
+                            st.caption(msg["timestamp"])
                 else:
-                    st.info("No upcoming sessions scheduled. Create one above to get started!")
-            else:
-                st.info("Accept study partner invitations first to schedule sessions!")
+                    st.info("No messages yet. Start the conversation!")
         
-        with tab5:
-            st.header("⭐ Rate Your Study Sessions")
+        with col1:
+            st.subheader("Active Chats")
             
-            if "sessions" not in data:
-                data["sessions"] = []
-            if "feedback" not in data:
-                data["feedback"] = []
-            completed_sessions = [s for s in data["sessions"] 
-                                 if (s["user1"] == st.session_state.current_user or s["user2"] == st.session_state.current_user) 
-                                 and s["status"] == "completed"]
+            for buddy, unread in services.chat_list(store, username):
+                button_label = services.display_name(store, buddy)
+                if unread > 0:
+                    button_label += f" ({unread} new)"
+                
+                if st.button(button_label, key=f"buddy_{buddy}", use_container_width=True):
+                    st.session_state.selected_buddy = buddy
+                    # Mark messages as read
+                    services.open_chat(store, username, buddy)
+                    rerun_view()
+    else:
+        st.info("No active study partners yet. Accept invitations to start chatting!")
+
+@st.fragment
+def sessions_view(store, username):
+    # Scheduling, completing and cancelling rerun only this view
+    store.refresh()
+    st.header("📅 Schedule & Manage Study Sessions")
+    
+    buddies = services.buddies(store, username)
+    
+    if buddies:
+        st.subheader("📝 Schedule New Study Session")
+        
+        with st.form("schedule_session"):
+            buddy_username = st.selectbox("Study Partner", buddies, format_func=lambda b: services.display_name(store, b))
+            session_date = st.date_input("Date", min_value=datetime.now().date())
+            session_time = st.time_input("Time")
+            duration = st.selectbox("Duration", services.DURATIONS)
+            location = st.selectbox("Location", services.LOCATIONS)
+            subject = st.text_input("Subject/Topic")
+            notes = st.text_area("Notes (optional)")
             
-            if completed_sessions:
-                # Check which sessions don't have feedback yet
-                sessions_without_feedback = []
-                for session in completed_sessions:
-                    has_feedback = any(f["session_id"] == session["id"] and f["from_username"] == st.session_state.current_user 
-                                      for f in data["feedback"])
-                    if not has_feedback:
-                        sessions_without_feedback.append(session)
+            if st.form_submit_button("📅 Schedule Session", type="primary"):
+                session, clashes = services.schedule_session(store, username, buddy_username, session_date, session_time,
+                                                             duration, location, subject, notes)
+                if clashes:
+                    for clash in clashes:
+                        who = [services.display_name(store, u) for u in {clash["user1"], clash["user2"]}]
+                        st.error(f"⚠️ Overlaps with \"{clash['subject']}\" ({' & '.join(who)}) on "
+                                 f"{clash['date']} at {clash['time']} for {clash['duration']}")
+                    slots = services.suggest_slots(store, username, buddy_username, duration, datetime.now())
+                    if slots:
+                        st.info("🕐 You are both free on: " +
+                                ", ".join(slot.strftime("%a %Y-%m-%d %H:%M") for slot in slots))
+                else:
+                    st.success(f"✅ Session scheduled with {services.display_name(store, buddy_username)}!")
+                    st.balloons()
+                    rerun_view()
+        
+        st.divider()
+        st.subheader("📆 Upcoming Study Sessions")
+        
+        my_sessions = services.upcoming_sessions(store, username)
+        
+        if my_sessions:
+            for session in my_sessions:
+                partner_name = services.display_name(store, services.partner_of(session, username))
                 
-                if sessions_without_feedback:
-                    st.subheader("📝 Provide Session Feedback")
+                with st.expander(f"📚 {session['subject']} with {partner_name}", expanded=False):
+                    st.write(f"**📅 Date:** {session['date']}")
+                    st.write(f"**🕐 Time:** {session['time']}")
+                    col1, col2 = st.columns([2, 1])
                     
-                    for session in sessions_without_feedback:
-                        partner = session["user2"] if session["user1"] == st.session_state.current_user else session["user1"]
-                        partner_name = data["users"][partner]["name"]
+                    with col1:
+                        st.write(f"**Duration:** {session['duration']}")
+                        st.write(f"**Location:** {session['location']}")
+                        if session['notes']:
+                            st.write(f"**Notes:** {session['notes']}")
+                    
+                    with col2:
+                        if st.button("✅ Complete", key=f"complete_{session['id']}", use_container_width=True):
+                            if services.finish_session(store, session["id"], "completed"):
+                                st.success("Session completed!")
+                            rerun_view()
                         
-                        with st.expander(f"Session: {session['subject']} with {partner_name}", expanded=False):
-                            st.caption(f"Date: {session['date']}")
-                            with st.form(f"feedback_{session['id']}"):
-                                rating = st.slider("Rating", 1, 5, 3, key=f"rating_{session['id']}")
-                                productivity = st.slider("Productivity", 1, 5, 3, key=f"prod_{session['id']}")
-                                would_study_again = st.radio("Would you study with them again?", ["Yes", "Maybe", "No"], key=f"again_{session['id']}")
-                                comments = st.text_area("Comments (optional)", key=f"comments_{session['id']}")
-                                
-                                if st.form_submit_button("Submit Feedback", type="primary"):
-                                    feedback = {
-                                        "session_id": session["id"],
-                                        "from_username": st.session_state.current_user,
-                                        "partner_username": partner,
-                                        "rating": rating,
-                                        "productivity": productivity,
-                                        "would_study_again": would_study_again,
-                                        "comments": comments,
-                                        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                                    }
-                                    data["feedback"].append(feedback)
-                                    save_persistent_data(data)
-                                    
-                                    st.success("Thank you for your feedback!")
-                                    st.rerun()
-                else:
-                    st.success("✅ All completed sessions have been rated! Great job!")
+                        if st.button("❌ Cancel", key=f"cancel_{session['id']}", use_container_width=True):
+                            if services.finish_session(store, session["id"], "cancelled"):
+                                st.info("Session cancelled")
+                            rerun_view()
+        else:
+            st.info("No upcoming sessions scheduled. Create one above to get started!")
+    else:
+        st.info("Accept study partner invitations first to schedule sessions!")
+
+    # Archive files are only read once asked for
+    if st.toggle("🗄️ Show archived sessions", key="show_archived_sessions"):
+        archived = services.archived_sessions(store, username)
+        for session in archived:
+            partner_name = services.display_name(store, services.partner_of(session, username))
+            st.write(f"📚 **{session['subject']}** with {partner_name} — {session['status'].title()}")
+            st.caption(f"{session['date']} at {session['time']} · {session['duration']} · {session['location']}")
+        if not archived:
+            st.info("No archived sessions")
+
+def feedback_view(store, username):
+    st.header("⭐ Rate Your Study Sessions")
+    
+    completed_sessions, sessions_without_feedback = services.sessions_to_rate(store, username)
+    
+    if completed_sessions:
+        if sessions_without_feedback:
+            st.subheader("📝 Provide Session Feedback")
+            
+            for session in sessions_without_feedback:
+                partner_name = services.display_name(store, services.partner_of(session, username))
                 
+                with st.expander(f"Session: {session['subject']} with {partner_name}", expanded=False):
+                    st.caption(f"Date: {session['date']}")
+                    with st.form(f"feedback_{session['id']}"):
+                        rating = st.slider("Rating", 1, 5, 3, key=f"rating_{session['id']}")
+                        productivity = st.slider("Productivity", 1, 5, 3, key=f"prod_{session['id']}")
+                        would_study_again = st.radio("Would you study with them again?", ["Yes", "Maybe", "No"], key=f"again_{session['id']}")
+                        comments = st.text_area("Comments (optional)", key=f"comments_{session['id']}")
+                        
+                        if st.form_submit_button("Submit Feedback", type="primary"):
+                            if services.submit_feedback(store, username, session, rating, productivity,
+                                                        would_study_again, comments):
+                                st.success("Thank you for your feedback!")
+                                st.rerun()
+                            else:
+                                st.warning("You already rated this session")
+        else:
+            st.success("✅ All completed sessions have been rated! Great job!")
+        
+        st.divider()
+        st.subheader("📜 Your Feedback History")
+        
+        for fb in services.feedback_history(store, username):
+            partner_name = services.display_name(store, fb["partner_username"])
+            st.write(f"⭐ **{partner_name}** - Rating: {fb['rating']}/5 | Productivity: {fb['productivity']}/5 | {fb['timestamp']}")
+            if fb['comments']:
+                st.write(f"  💬 {fb['comments']}")
+    else:
+        st.info("Complete study sessions first, then you can provide feedback!")
+
+@st.fragment
+def search_view(store, username):
+    # Paging through the results reruns only this view
+    st.header("🔍 Search")
+    query = st.text_input("Search your chats and feedback comments", key="search_query")
+    if query.strip():
+        search_results(store, username, query, "search")
+
+def dashboard_view(store, username):
+    st.header("📊 Your Activity Dashboard")
+    
+    stats, partners = services.dashboard(store, username)
+    
+    col1, col2, col3, col4 = st.columns(4)
+    
+    with col1:
+        st.metric("📤 Invitations Sent", stats["sent"])
+    with col2:
+        st.metric("📨 Invitations Received", stats["received"])
+    with col3:
+        st.metric("✅ Connections Made", stats["connections"])
+    with col4:
+        st.metric("📚 Sessions Completed", stats["completed"])
+    
+    st.write("")
+    
+    col1, col2 = st.columns(2)
+    
+    with col1:
+        st.subheader("🤝 Your Study Partners")
+        if partners:
+            for buddy, buddy_sessions in partners:
+                st.write(f"👥 **{services.display_name(store, buddy)}**")
+                st.caption(f"{buddy_sessions} sessions completed")
                 st.divider()
-                st.subheader("📜 Your Feedback History")
-                
-                my_feedback = [f for f in data["feedback"] if f["from_username"] == st.session_state.current_user]
-                
-                if my_feedback:
-                    for fb in my_feedback:
-                        partner_name = data["users"][fb["partner_username"]]["name"]
-                        st.write(f"⭐ **{partner_name}** - Rating: {fb['rating']}/5 | Productivity: {fb['productivity']}/5 | {fb['timestamp']}")
-                        if fb['comments']:
-                            st.write(f"  💬 {fb['comments']}")
-            else:
-                st.info("Complete study sessions first, then you can provide feedback!")
+        else:
+            st.info("No study partners yet. Start by finding matches!")
+    
+    with col2:
+        st.subheader("📈 Your Performance")
+        if stats["feedback"]:
+            st.metric("⭐ Average Session Rating", f"{stats['avg_rating']:.1f}/5")
+            st.metric("📈 Average Productivity", f"{stats['avg_productivity']:.1f}/5")
+            st.metric("🔄 Would Study Again", f"{stats['would_study_again'] * 100:.0f}%")
+        else:
+            st.info("Complete sessions and provide feedback to see your performance metrics!")
+
+# Only the selected view runs on a rerun; st.tabs would compute every one of them every time
+VIEWS = {
+    "🔍 Find Matches": matches_view,
+    "📬 Invitations": invitations_view,
+    "💬 Chat": chat_view,
+    "📅 Study Sessions": sessions_view,
+    "⭐ Feedback": feedback_view,
+    "🔍 Search": search_view,
+    "📊 Dashboard": dashboard_view,
+}
+
+@metrics.timed("rerun_seconds")
+def main():
+    st.set_page_config(page_title="Study Buddy Matchmaker", page_icon="🎓", layout="wide")
+    init_session()
+    
+    store = get_store(DATA_FILE)
+    store.refresh()
+    data = store.data
+    
+    st.title("🎓 Smart Study Buddy Matchmaker")
+    st.caption("AI-Powered Study Partner Matching System")
+    
+    if not st.session_state.logged_in:
+        st.header("🔐 Login")
         
-        with tab6:
-            st.header("📊 Your Activity Dashboard")
-            
-            if "sessions" not in data:
-                data["sessions"] = []
-            if "feedback" not in data:
-                data["feedback"] = []
-            
-            received = [inv for inv in data["invitations"] if inv["to_username"] == st.session_state.current_user]
-            sent = [inv for inv in data["invitations"] if inv["from_username"] == st.session_state.current_user]
-            my_sessions = [s for s in data["sessions"] if s["user1"] == st.session_state.current_user or s["user2"] == st.session_state.current_user]
-            my_feedback = [f for f in data["feedback"] if f["from_username"] == st.session_state.current_user]
-            
-            col1, col2, col3, col4 = st.columns(4)
-            
-            with col1:
-                st.metric("📤 Invitations Sent", len(sent))
-            with col2:
-                st.metric("📨 Invitations Received", len(received))
-            with col3:
-                accepted = len([inv for inv in sent if inv["status"] == "accepted"])
-                st.metric("✅ Connections Made", accepted)
-            with col4:
-                completed = len([s for s in my_sessions if s["status"] == "completed"])
-                st.metric("📚 Sessions Completed", completed)
-            
-            st.write("")
-            
-            col1, col2 = st.columns(2)
-            
-            with col1:
-                st.subheader("🤝 Your Study Partners")
-                buddies = get_accepted_buddies(st.session_state.current_user, data)
-                if buddies:
-                    for buddy in buddies:
-                        buddy_name = data["users"][buddy]["name"]
-                        buddy_sessions = len([s for s in my_sessions if (s["user1"] == buddy or s["user2"] == buddy) and s["status"] == "completed"])
-                        st.write(f"👥 **{buddy_name}**")
-                        st.caption(f"{buddy_sessions} sessions completed")
-                        st.divider()
-                else:
-                    st.info("No study partners yet. Start by finding matches!")
+        with st.form("login_form"):
+            username = st.text_input("Username")
+            password = st.text_input("Password", type="password")
+            submitted = st.form_submit_button("Login", type="primary")
             
-            with col2:
-                st.subheader("📈 Your Performance")
-                if my_feedback:
-                    avg_rating = sum(f["rating"] for f in my_feedback) / len(my_feedback)
-                    avg_productivity = sum(f["productivity"] for f in my_feedback) / len(my_feedback)
-                    st.metric("⭐ Average Session Rating", f"{avg_rating:.1f}/5")
-                    st.metric("📈 Average Productivity", f"{avg_productivity:.1f}/5")
-                    
-                    would_study_again_yes = len([f for f in my_feedback if f["would_study_again"] == "Yes"])
-                    if len(my_feedback) > 0:
-                        st.metric("🔄 Would Study Again", f"{(would_study_again_yes/len(my_feedback)*100):.0f}%")
+            if submitted:
+                if username in data["accounts"] and data["accounts"][username] == password:
+                    st.session_state.logged_in = True
+                    st.session_state.current_user = username
+                    st.success(f"✅ Welcome, {services.display_name(store, username)}!")
+                    st.rerun()
                 else:
-                    st.info("Complete sessions and provide feedback to see your performance metrics!")
+                    st.error("❌ Invalid credentials")
+    
+    elif st.session_state.current_user == ADMIN_USER:
+        admin_page(store)
+    
+    else:
+        username = st.session_state.current_user
+        col1, col2, col3 = st.columns([3, 1, 1])
+        with col1:
+            st.write(f"### 👤 {services.display_name(store, username)}")
+        with col2:
+            st.metric("Study Buddies", len(get_accepted_buddies(username, store)))
+        with col3:
+            if st.button("Logout", type="secondary"):
+                logout()
+        
+        view = st.radio("View", list(VIEWS), horizontal=True, key="view", label_visibility="collapsed")
+        st.divider()
+        
+        with metrics.timer("view_seconds", view=view.split(" ", 1)[-1]):
+            VIEWS[view](store, username)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,239 @@
+import argparse
+import json
+import random
+import threading
+import time
+import zlib
+
+import numpy as np
+
+import metrics
+from matching import SET_FIELDS, MatchEngine, calculate_match_score, recommend
+
+# Recall/speed knobs: more bands find more true matches, more rows per band make each bucket pickier
+LSH_BANDS = 30
+LSH_ROWS = 2
+# Candidates scored exactly per query, best LSH agreement first
+LSH_MAX_CANDIDATES = 1000
+# Profiles changed since the last build are kept aside until they reach this share of all users
+LSH_REBUILD_SHARE = 0.05
+
+_MERSENNE_PRIME = (1 << 61) - 1
+
+_index_lock = threading.Lock()
+_index = None
+
+
+def feature_set(profile):
+    """Every subject, time slot, interest and the study style of a profile as one set of tokens"""
+    features = {f"{field}:{value}" for field in SET_FIELDS for value in profile[field]}
+    features.add(f"study_style:{profile['study_style']}")
+    return features
+
+
+def feature_ids(profile):
+    return np.array(sorted(zlib.crc32(token.encode("utf-8")) for token in feature_set(profile)), dtype=np.uint64)
+
+
+class LSHIndex:
+    """MinHash signatures of every user's combined feature set, bucketed by
+    band, so a query only scores users who collide with it in some band.
+    """
+
+    def __init__(self, users, bands=LSH_BANDS, rows=LSH_ROWS, max_candidates=LSH_MAX_CANDIDATES, seed=7):
+        self.users = users
+        self.bands = bands
+        self.rows = rows
+        self.max_candidates = max_candidates
+        rng = np.random.default_rng(seed)
+        num_perm = bands * rows
+        self._a = rng.integers(1, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self._band_weights = rng.integers(1, 1 << 62, size=rows, dtype=np.uint64)
+        self.last_candidates = 0
+        self.build()
+
+    def signatures(self, profiles):
+        """MinHash signature matrix, one row per profile"""
+        ids = [feature_ids(profile) for profile in profiles]
+        lengths = np.array([len(x) for x in ids])
+        signatures = np.full((len(profiles), len(self._a)), np.iinfo(np.uint64).max, dtype=np.uint64)
+        filled = np.flatnonzero(lengths)
+        if len(filled) == 0:
+            return signatures
+        flat = np.concatenate([ids[i] for i in filled])
+        starts = np.concatenate([[0], np.cumsum(lengths[filled])[:-1]])
+        # Chunked so one (features x permutations) block stays small
+        for lo in range(0, len(self._a), 16):
+            a, b = self._a[lo:lo + 16], self._b[lo:lo + 16]
+            # uint64 products wrap around, which is fine for a hash family
+            hashed = (flat[:, None] * a + b) % _MERSENNE_PRIME
+            signatures[filled, lo:lo + 16] = np.minimum.reduceat(hashed, starts, axis=0)
+        return signatures
+
+    def band_keys(self, signatures):
+        """One 64-bit bucket key per (profile, band)"""
+        shaped = signatures.reshape(len(signatures), self.bands, self.rows)
+        return (shaped * self._band_weights).sum(axis=2, dtype=np.uint64)
+
+    def build(self):
+        self.usernames = list(self.users)
+        self.row = {username: i for i, username in enumerate(self.usernames)}
+        self.pending = {}
+        self.removed = set()
+        keys = np.zeros((0, self.bands), dtype=np.uint64)
+        chunks = []
+        for lo in range(0, len(self.usernames), 50000):
+            chunk = self.usernames[lo:lo + 50000]
+            chunks.append(self.band_keys(self.signatures([self.users[u] for u in chunk])))
+        if chunks:
+            keys = np.vstack(chunks)
+        self.sorted_keys = []
+        self.sorted_rows = []
+        for band in range(self.bands):
+            order = np.argsort(keys[:, band], kind="stable")
+            self.sorted_keys.append(keys[order, band])
+            self.sorted_rows.append(order)
+
+    def update_user(self, username, profile):
+        """Track a new or changed profile; folded into the buckets by the next rebuild"""
+        self.removed.discard(username)
+        self.pending[username] = self.band_keys(self.signatures([profile]))[0]
+        if len(self.pending) > LSH_REBUILD_SHARE * max(len(self.usernames), 1):
+            self.build()
+
+    def remove_user(self, username):
+        self.pending.pop(username, None)
+        self.removed.add(username)
+
+    def candidates(self, profile, exclude=None):
+        """Users sharing at least one band bucket with `profile`, most shared bands first"""
+        keys = self.band_keys(self.signatures([profile]))[0]
+        colliding = [np.empty(0, dtype=np.int64)]
+        for band in range(self.bands):
+            sorted_keys = self.sorted_keys[band]
+            lo = np.searchsorted(sorted_keys, keys[band], side="left")
+            hi = np.searchsorted(sorted_keys, keys[band], side="right")
+            colliding.append(self.sorted_rows[band][lo:hi])
+        rows, counts = np.unique(np.concatenate(colliding), return_counts=True)
+        best = np.argsort(-counts, kind="stable")[:self.max_candidates + len(self.removed) + len(self.pending) + 1]
+        hits = {self.usernames[rows[i]]: int(counts[i]) for i in best}
+        for username, pending_keys in self.pending.items():
+            shared = int((pending_keys == keys).sum())
+            if shared:
+                hits[username] = shared
+            else:
+                hits.pop(username, None)
+        for username in self.removed:
+            hits.pop(username, None)
+        hits.pop(exclude, None)
+        ranked = sorted(hits, key=hits.get, reverse=True)
+        return ranked[:self.max_candidates]
+
+    def top_matches(self, username, k=5):
+        """Approximate best k partners as (username, score), scored exactly over the LSH candidates"""
+        profile = self.users[username]
+        shortlist = self.candidates(profile, exclude=username)
+        self.last_candidates = len(shortlist)
+        scored = [(calculate_match_score(profile, self.users[other]), other) for other in shortlist
+                  if other in self.users]
+        scored.sort(key=lambda item: (-item[0], self.row.get(item[1], len(self.row))))
+        return [(other, score) for score, other in scored[:k]]
+
+
+def get_lsh_index(users):
+    """Shared index for the current users dict, built on first use"""
+    global _index
+    with _index_lock:
+        if _index is None or _index.users is not users:
+            _index = LSHIndex(users)
+        return _index
+
+
+@metrics.timed("match_seconds", method="approximate")
+def recommend_approximate(username, store, k=5):
+    """Approximate top k matches as (username, profile, score), for very large user bases"""
+    users = store.data["users"]
+    index = get_lsh_index(users)
+    with _index_lock:
+        seen = getattr(index, "changes_seen", (store.reloads, len(store.user_changes)))
+        if seen[0] != store.reloads:
+            index.build()
+        else:
+            for changed in store.user_changes[seen[1]:]:
+                if changed in users:
+                    index.update_user(changed, users[changed])
+                else:
+                    index.remove_user(changed)
+        index.changes_seen = (store.reloads, len(store.user_changes))
+        matches = index.top_matches(username, k)
+        metrics.observe("match_scan_rows", index.last_candidates, method="lsh")
+    if len(matches) < min(k, len(users) - 1):
+        # Too few collisions (tiny or unusual profiles): the exact ranking is cheap enough then
+        return recommend(username, store, k)
+    return [(other, users[other], score) for other, score in matches]
+
+
+def recall_report(users, sample=200, k=5, bands=LSH_BANDS, rows=LSH_ROWS, max_candidates=LSH_MAX_CANDIDATES, seed=0):
+    """Compare the approximate top k against the exact ranking for a random sample of users.
+
+    `id_recall` counts exact top-k users that were found; `score_recall` also
+    accepts a different user with a score tied with the exact k-th place.
+    """
+    started = time.perf_counter()
+    index = LSHIndex(users, bands=bands, rows=rows, max_candidates=max_candidates)
+    build_seconds = time.perf_counter() - started
+    engine = MatchEngine(users)
+    queries = random.Random(seed).sample(list(users), min(sample, len(users)))
+
+    id_hits = score_hits = expected = candidates = 0
+    exact_seconds = approx_seconds = 0.0
+    for username in queries:
+        started = time.perf_counter()
+        exact = engine.top_matches(username, k)
+        exact_seconds += time.perf_counter() - started
+
+        started = time.perf_counter()
+        approx = index.top_matches(username, k)
+        approx_seconds += time.perf_counter() - started
+        candidates += index.last_candidates
+
+        if not exact:
+            continue
+        expected += len(exact)
+        exact_users = {other for other, _ in exact}
+        kth_score = exact[-1][1]
+        id_hits += sum(1 for other, _ in approx if other in exact_users)
+        score_hits += sum(1 for _, score in approx if score >= kth_score - 1e-9)
+
+    return {
+        "users": len(users),
+        "sample": len(queries),
+        "k": k,
+        "bands": bands,
+        "rows": rows,
+        "max_candidates": max_candidates,
+        "id_recall": id_hits / expected if expected else 1.0,
+        "score_recall": min(score_hits, expected) / expected if expected else 1.0,
+        "mean_candidates": candidates / len(queries) if queries else 0,
+        "build_seconds": build_seconds,
+        "exact_ms_per_query": exact_seconds / len(queries) * 1000 if queries else 0,
+        "approx_ms_per_query": approx_seconds / len(queries) * 1000 if queries else 0,
+    }
+
+
+if __name__ == "__main__":
+    from storage import STORAGE_FILE, load_persistent_data
+
+    parser = argparse.ArgumentParser(description="Recall of LSH matching against the exact top-k")
+    parser.add_argument("--data", default=STORAGE_FILE)
+    parser.add_argument("--sample", type=int, default=200)
+    parser.add_argument("-k", type=int, default=5)
+    parser.add_argument("--bands", type=int, default=LSH_BANDS)
+    parser.add_argument("--rows", type=int, default=LSH_ROWS)
+    parser.add_argument("--max-candidates", type=int, default=LSH_MAX_CANDIDATES)
+    args = parser.parse_args()
+
+    report = recall_report(load_persistent_data(args.data)["users"], sample=args.sample, k=args.k,
+                           bands=args.bands, rows=args.rows, max_candidates=args.max_candidates)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,260 @@
+import argparse
+import bisect
+import glob
+import gzip
+import json
+import os
+import re
+import threading
+import zlib
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta
+
+from dashboard_stats import DashboardStats
+from indexes import pair_key
+from records import TIMESTAMP_FORMAT, make_record
+
+# Days before records leave the hot data: completed or cancelled sessions (counted from
+# the session date), declined invitations and read messages (from when they were sent)
+SESSION_DAYS = 90
+INVITATION_DAYS = 30
+MESSAGE_DAYS = 180
+
+# The archived messages of a month are spread over this many files by conversation,
+# so paging back through one conversation reads a small file
+MESSAGE_BUCKETS = 64
+
+# Archive files kept parsed in memory, least recently read dropped first
+CACHED_PARTITIONS = 16
+
+_MONTH = re.compile(r"\d{4}-\d{2}")
+
+_partitions = OrderedDict()
+_partitions_lock = threading.Lock()
+
+
+def archive_dir(path):
+    """Directory of the archive files of the data file at `path`"""
+    return path + ".archive"
+
+
+def month_of(value):
+    """Partition of a date or timestamp, such as "2025-03" """
+    month = str(value)[:7]
+    return month if _MONTH.fullmatch(month) else "undated"
+
+
+def message_bucket(user_a, user_b):
+    first, second = pair_key(user_a, user_b)
+    return zlib.crc32(f"{first}\n{second}".encode("utf-8")) % MESSAGE_BUCKETS
+
+
+def partition_path(path, collection, month, bucket=None):
+    name = month if bucket is None else f"{month}-{bucket:02d}"
+    return os.path.join(archive_dir(path), collection, name + ".jsonl.gz")
+
+
+def _add_month(data, collection, key, month):
+    months = data.setdefault("archive_months", {}).setdefault(collection, {}).setdefault(key, [])
+    if month not in months:
+        bisect.insort(months, month)
+
+
+def rated_sessions(data):
+    """(session id, username) for every rating written"""
+    return {(feedback["session_id"], feedback["from_username"]) for feedback in data.get("feedback", [])}
+
+
+def split_off(data, path, now=None, session_days=SESSION_DAYS, invitation_days=INVITATION_DAYS,
+              message_days=MESSAGE_DAYS, rated=None):
+    """Move the records past their retention out of `data` into the archive files of the
+    data file at `path`; returns how many records of each collection were moved.
+
+    A completed session stays until both users rated it, so it can still be rated;
+    `rated` is the `rated_sessions()` of the whole store when `data` is one part of it.
+
+    What the dashboard counted from the moved records is kept in data["archived_stats"],
+    the invitation pairs in data["archived_pairs"] (a declined invitation still blocks
+    inviting the same person again) and the months each user or conversation has in
+    the archive in data["archive_months"]. Messages leave a conversation oldest first
+    and stop at the first unread one, so the archive only holds what comes before the
+    hot messages; ids grow with timestamps, so older months hold the older ids.
+    """
+    now = now or datetime.now()
+
+    def cutoff(days):
+        return (now - timedelta(days=days)).strftime(TIMESTAMP_FORMAT)
+
+    rated = rated_sessions(data) if rated is None else rated
+    stats = data.setdefault("archived_stats", DashboardStats())
+    pairs = data.setdefault("archived_pairs", set())
+    partitions = defaultdict(list)
+    moved = {}
+
+    # Dates are "YYYY-MM-DD", which compares as text against the start of the cutoff
+    before = cutoff(session_days)[:10]
+    kept = []
+    for session in data.get("sessions", []):
+        unrated = session["status"] == "completed" and not all(
+            (session["id"], username) in rated for username in (session["user1"], session["user2"]))
+        if session["status"] in ("completed", "cancelled") and not unrated and str(session.get("date")) < before:
+            month = month_of(session.get("date"))
+            partitions[("sessions", month, None)].append(dict(session.items()))
+            stats.session_added(session)
+            for username in (session["user1"], session["user2"]):
+                _add_month(data, "sessions", username, month)
+        else:
+            kept.append(session)
+    moved["sessions"] = len(data.get("sessions", [])) - len(kept)
+    data["sessions"] = kept
+
+    before = cutoff(invitation_days)
+    kept = []
+    for invitation in data.get("invitations", []):
+        if invitation["status"] == "declined" and str(invitation.get("timestamp")) < before:
+            month = month_of(invitation.get("timestamp"))
+            partitions[("invitations", month, None)].append(dict(invitation.items()))
+            stats.invitation_added(invitation)
+            pairs.add((invitation["from_username"], invitation["to_username"]))
+            for username in (invitation["from_username"], invitation["to_username"]):
+                _add_month(data, "invitations", username, month)
+        else:
+            kept.append(invitation)
+    moved["invitations"] = len(data.get("invitations", [])) - len(kept)
+    data["invitations"] = kept
+
+    before = cutoff(message_days)
+    messages = data["messages"]
+    marks = data.get("read_marks", {})
+    # Conversations whose archived part has ended
+    closed = set()
+    kept = []
+    for row in range(len(messages)):
+        message = messages[row]
+        sender, recipient = message["from_username"], message["to_username"]
+        key = pair_key(sender, recipient)
+        read = message.get("read") or message["id"] <= marks.get((recipient, sender), 0)
+        if key not in closed and read and str(message.get("timestamp")) < before:
+            month = month_of(message.get("timestamp"))
+            partitions[("messages", month, message_bucket(sender, recipient))].append(dict(message.items()))
+            _add_month(data, "messages", key, month)
+        else:
+            closed.add(key)
+            kept.append(row)
+    moved["messages"] = len(messages) - len(kept)
+    if moved["messages"]:
+        data["messages"] = type(messages)(messages[row] for row in kept)
+
+    # Appended as a new gzip member per run; a run that crashes before the snapshot
+    # is saved leaves duplicates, which reading drops by id
+    for (collection, month, bucket), records in partitions.items():
+        file = partition_path(path, collection, month, bucket)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        with gzip.open(file, "at", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+    return moved
+
+
+def read_partition(file):
+    """Records of one archive file in id order, parsed once while it stays among
+    the CACHED_PARTITIONS most recently read"""
+    try:
+        key = (file, os.stat(file).st_mtime_ns)
+    except FileNotFoundError:
+        return []
+    with _partitions_lock:
+        if key in _partitions:
+            _partitions.move_to_end(key)
+            return _partitions[key]
+
+    records = {}
+    with gzip.open(file, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                # A torn last line from a crash mid-archive is skipped
+                if line.endswith("\n"):
+                    record = json.loads(line)
+                    records[record["id"]] = record
+        except EOFError:
+            pass
+    records = sorted(records.values(), key=lambda record: record["id"])
+
+    with _partitions_lock:
+        _partitions[key] = records
+        while len(_partitions) > CACHED_PARTITIONS:
+            _partitions.popitem(last=False)
+    return records
+
+
+def archived_messages(path, data, user_a, user_b, before_id=None, limit=20):
+    """The `limit` newest archived messages of a conversation older than `before_id`,
+    oldest first, and whether there are older ones left; reads the newest months first
+    and stops as soon as the page is full"""
+    key = pair_key(user_a, user_b)
+    months = data.get("archive_months", {}).get("messages", {}).get(key, [])
+    bucket = message_bucket(user_a, user_b)
+    found = []
+    for i in range(len(months) - 1, -1, -1):
+        older = [message for message in read_partition(partition_path(path, "messages", months[i], bucket))
+                 if pair_key(message["from_username"], message["to_username"]) == key
+                 and (before_id is None or message["id"] < before_id)]
+        found = older + found
+        if len(found) > limit or (len(found) == limit and i > 0):
+            return found[len(found) - limit:], True
+    return found, False
+
+
+def has_archived_messages(data, user_a, user_b):
+    return bool(data.get("archive_months", {}).get("messages", {}).get(pair_key(user_a, user_b)))
+
+
+def archived_records(path, data, collection, username):
+    """A user's archived sessions or invitations, newest first; reads only the months
+    the user has records in"""
+    months = data.get("archive_months", {}).get(collection, {}).get(username, [])
+    fields = ("user1", "user2") if collection == "sessions" else ("from_username", "to_username")
+    found = []
+    for month in reversed(months):
+        records = read_partition(partition_path(path, collection, month))
+        found.extend(record for record in reversed(records) if username in (record[fields[0]], record[fields[1]]))
+    return found
+
+
+def restore(data, path):
+    """Put every archived record of the data file at `path` back into `data`, undoing
+    `split_off`; for copying the data into another backend, which keeps its own history"""
+    if not data.get("archive_months"):
+        return data
+    for collection in ("sessions", "invitations", "messages"):
+        archived = {}
+        for file in sorted(glob.glob(os.path.join(glob.escape(archive_dir(path)), collection, "*.jsonl.gz"))):
+            for record in read_partition(file):
+                archived[record["id"]] = record
+        if collection == "messages":
+            messages = data["messages"]
+            records = list(archived.values()) + [dict(message.items()) for message in messages]
+            data["messages"] = type(messages)(sorted(records, key=lambda record: record["id"]))
+        else:
+            records = [make_record(collection, record) for record in archived.values()] + data.get(collection, [])
+            data[collection] = sorted(records, key=lambda record: record["id"])
+    for key in ("archived_stats", "archived_pairs", "archive_months"):
+        data.pop(key, None)
+    return data
+
+
+if __name__ == "__main__":
+    from storage import STORAGE_FILE, get_store
+
+    parser = argparse.ArgumentParser(description="Move old sessions, invitations and messages into the archive files")
+    parser.add_argument("--data", default=STORAGE_FILE)
+    parser.add_argument("--session-days", type=int, default=SESSION_DAYS)
+    parser.add_argument("--invitation-days", type=int, default=INVITATION_DAYS)
+    parser.add_argument("--message-days", type=int, default=MESSAGE_DAYS)
+    args = parser.parse_args()
+
+    moved = get_store(args.data).archive(session_days=args.session_days, invitation_days=args.invitation_days,
+                                         message_days=args.message_days)
+    print(json.dumps(moved, indent=2))
@@ -0,0 +1,393 @@
+import argparse
+import heapq
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import types
+from datetime import date, datetime, timedelta
+
+# Profile vocabularies of the synthetic students; a few popular subjects and a long tail
+SUBJECTS = ["Math", "Physics", "Computer Science", "Biology", "Chemistry", "Literature", "History", "Economics",
+            "Psychology", "Statistics", "Philosophy", "Sociology", "Accounting", "Marketing", "Nursing",
+            "Engineering", "Architecture", "Law", "Political Science", "Art History", "Music Theory", "Geology",
+            "Astronomy", "Linguistics"]
+INTERESTS = ["Technology", "Reading", "Gaming", "Sports", "Music", "Movies", "Art", "Travel", "Cooking",
+             "Photography", "Hiking", "Writing", "Dance", "Volunteering", "Chess", "Fitness"]
+STUDY_STYLES = ["Visual", "Auditory", "Kinesthetic", "Reading/Writing"]
+AVAILABILITY = ["Morning", "Afternoon", "Evening", "Weekend"]
+DURATIONS = ["30 min", "1 hour", "1.5 hours", "2 hours", "3 hours"]
+LOCATIONS = ["Library", "Online (Zoom)", "Online (Google Meet)", "Cafe", "Study Room", "Other"]
+COMMENTS = ["", "", "Great session!", "Very helpful explanations", "We got a lot done", "A bit distracted today",
+            "Would like to cover more problems next time", "Good pace"]
+
+# Average records per user
+VOLUMES = {"invitations": 3.0, "messages": 12.0, "sessions": 1.5}
+# Share of invitations accepted and declined; the rest are pending
+ACCEPTED_SHARE = 0.5
+DECLINED_SHARE = 0.25
+# Share of participants who rate a completed session
+FEEDBACK_SHARE = 0.7
+HISTORY_DAYS = 180
+
+# Queries timed per benchmark; brute-force matching scans every user, so it gets fewer
+SAMPLE_USERS = 50
+BRUTE_FORCE_SAMPLE = 10
+# A metric counts as a regression when it is this much slower than in the baseline report
+REGRESSION_RATIO = 1.2
+
+
+def generate(users, path, seed=0, volumes=VOLUMES):
+    """Write a snapshot with `users` synthetic students plus the seeded accounts; returns record counts"""
+    from records import Profile, compact_data, make_record
+    from storage import default_data, save_persistent_data
+
+    rng = random.Random(seed)
+    data = compact_data(default_data())
+    subject_weights = [1 / (rank + 1) for rank in range(len(SUBJECTS))]
+    for i in range(users):
+        username = f"student{i:07d}"
+        data["accounts"][username] = f"pass{i}"
+        data["users"][username] = Profile({
+            "name": f"Student {i}",
+            "subjects": list(set(rng.choices(SUBJECTS, subject_weights, k=rng.randint(1, 4)))),
+            "interests": rng.sample(INTERESTS, rng.randint(1, 4)),
+            "study_style": rng.choice(STUDY_STYLES),
+            "availability": rng.sample(AVAILABILITY, rng.randint(1, 3)),
+        })
+    usernames = list(data["users"])
+    now = int(time.time())
+    start = now - HISTORY_DAYS * 86400
+
+    pairs, buddies = set(), []
+    for _ in range(int(len(usernames) * volumes["invitations"])):
+        sender, recipient = rng.sample(usernames, 2)
+        if (sender, recipient) in pairs:
+            continue
+        pairs.add((sender, recipient))
+        roll = rng.random()
+        status = "accepted" if roll < ACCEPTED_SHARE else "declined" if roll < ACCEPTED_SHARE + DECLINED_SHARE else "pending"
+        data["invitation_counter"] += 1
+        data["invitations"].append(make_record("invitations", {
+            "id": data["invitation_counter"], "from_username": sender, "to_username": recipient,
+            "match_score": round(rng.random(), 3), "status": status, "timestamp": rng.randrange(start, now)}))
+        if status == "accepted":
+            buddies.append((sender, recipient))
+    # Messages and sessions only happen between accepted buddies
+    messages = int(len(usernames) * volumes["messages"]) if buddies else 0
+    for n in range(messages):
+        pair = rng.choice(buddies)
+        sender, recipient = pair if rng.random() < 0.5 else pair[::-1]
+        data["message_counter"] += 1
+        # Ids and timestamps grow together; everything but the newest tenth has been read
+        data["messages"].append({
+            "id": data["message_counter"], "from_username": sender, "to_username": recipient,
+            "message": f"message {n} about {rng.choice(SUBJECTS)}", "timestamp": start + (now - start) * n // messages,
+            "read": n < messages * 0.9 or rng.random() < 0.5})
+
+    today = date.today()
+    for _ in range(int(len(usernames) * volumes["sessions"]) if buddies else 0):
+        user1, user2 = rng.choice(buddies)
+        status = rng.choices(["completed", "scheduled", "cancelled"], [0.6, 0.25, 0.15])[0]
+        offset = rng.randint(1, 30) if status == "scheduled" else -rng.randint(0, HISTORY_DAYS)
+        data["session_counter"] += 1
+        session = make_record("sessions", {
+            "id": data["session_counter"], "user1": user1, "user2": user2,
+            "date": (today + timedelta(days=offset)).strftime("%Y-%m-%d"), "time": f"{rng.randint(8, 20):02d}:00",
+            "duration": rng.choice(DURATIONS), "location": rng.choice(LOCATIONS), "subject": rng.choice(SUBJECTS),
+            "notes": "", "status": status, "created_at": rng.randrange(start, now)})
+        data["sessions"].append(session)
+        if status != "completed":
+            continue
+        for me, partner in ((user1, user2), (user2, user1)):
+            if rng.random() < FEEDBACK_SHARE:
+                data["feedback"].append(make_record("feedback", {
+                    "session_id": session["id"], "from_username": me, "partner_username": partner,
+                    "rating": rng.randint(1, 5), "productivity": rng.randint(1, 5),
+                    "would_study_again": rng.choice(["Yes", "Yes", "Maybe", "No"]),
+                    "comments": rng.choice(COMMENTS), "timestamp": rng.randrange(start, now)}))
+
+    save_persistent_data(data, path)
+    return {collection: len(data[collection]) for collection in ("users", "invitations", "messages", "sessions", "feedback")}
+
+
+def latency(samples):
+    """Summary of a list of durations in seconds, in milliseconds"""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "mean_ms": sum(ordered) / len(ordered) * 1000,
+        "p50_ms": ordered[len(ordered) // 2] * 1000,
+        "p95_ms": ordered[int(0.95 * (len(ordered) - 1))] * 1000,
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+def timed(func, args):
+    """Call `func(arg)` once per arg; latency summary of the calls"""
+    samples = []
+    for arg in args:
+        started = time.perf_counter()
+        func(arg)
+        samples.append(time.perf_counter() - started)
+    return latency(samples)
+
+
+class _Stub:
+    """Stands in for any Streamlit element: accepts every call, attribute and `with` block"""
+
+    def __call__(self, *args, **kwargs):
+        return self
+
+    def __getattr__(self, name):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __bool__(self):
+        return False
+
+    def __iter__(self):
+        return iter(())
+
+
+class _SessionState(dict):
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+    def __delattr__(self, name):
+        del self[name]
+
+
+def _passthrough(func=None, **options):
+    """st.cache_data / st.fragment as plain decorators"""
+    return func if callable(func) else (lambda f: f)
+
+
+def stub_streamlit():
+    """A `streamlit` module whose widgets return their defaults (or the session state
+    value of their key) and draw nothing, so the app's data preparation runs on its own"""
+    st = types.ModuleType("streamlit")
+    st.session_state = _SessionState()
+
+    def choice(label, options=(), index=0, key=None, **kw):
+        if key in st.session_state:
+            return st.session_state[key]
+        return list(options)[index] if options else None
+
+    st.columns = lambda spec, **kw: [_Stub() for _ in range(spec if isinstance(spec, int) else len(spec))]
+    st.tabs = lambda labels: [_Stub() for _ in labels]
+    st.button = st.form_submit_button = st.checkbox = st.toggle = lambda *args, **kw: False
+    st.text_input = st.text_area = lambda label, value="", **kw: value
+    st.selectbox = st.radio = choice
+    st.multiselect = lambda label, options=(), default=None, **kw: list(default or [])
+    st.slider = lambda label, min_value=0, max_value=100, value=None, **kw: min_value if value is None else value
+    st.date_input = lambda label, value=None, **kw: value or date.today()
+    st.time_input = lambda label, value=None, **kw: value or datetime.now().time()
+    st.chat_input = lambda *args, **kw: None
+    st.cache_data = st.cache_resource = st.fragment = _passthrough
+    st.__getattr__ = lambda name: _Stub()
+    return st
+
+
+def bench_matching(users, sample, brute_sample):
+    from matching import MatchEngine, calculate_match_score
+
+    def brute_force(username):
+        me = users[username]
+        heapq.nlargest(5, ((calculate_match_score(me, profile), other)
+                           for other, profile in users.items() if other != username))
+
+    started = time.perf_counter()
+    engine = MatchEngine(users)
+    build_seconds = time.perf_counter() - started
+    return {
+        "calculate_match_score_top5": timed(brute_force, sample[:brute_sample]),
+        "engine_build_ms": build_seconds * 1000,
+        "engine_top5": timed(lambda username: engine.top_matches(username, 5), sample),
+    }
+
+
+def bench_app(app, store, sample):
+    """Buddy and unread lookups as the app makes them, and one full rerun of the
+    logged-in page per sample user and view"""
+    buddies = {username: app.get_accepted_buddies(username, store) for username in sample}
+    pairs = [(username, buddy) for username in sample for buddy in buddies[username]]
+
+    def rerun(username, view):
+        app.st.session_state.clear()
+        app.st.session_state.update(logged_in=True, current_user=username, view=view)
+        app.main()
+
+    return {
+        "get_accepted_buddies": timed(lambda username: app.get_accepted_buddies(username, store), sample),
+        "get_unread_count": timed(lambda pair: app.get_unread_count(*pair, store), pairs),
+        "views": {view.split(" ", 1)[-1]: timed(lambda username: rerun(username, view), sample) for view in app.VIEWS},
+    }
+
+
+def bench_search(store, sample, seed=0):
+    """Full-text queries over one subject each: building the index, then scoped to a
+    sample user's conversations and across every conversation"""
+    rng = random.Random(seed)
+    queries = [(username, rng.choice(SUBJECTS)) for username in sample]
+    started = time.perf_counter()
+    store.search_messages("warm up")
+    report = {"index_build_ms": (time.perf_counter() - started) * 1000}
+    report["user_messages"] = timed(lambda query: store.search_messages(query[1], query[0], 0, 10), queries)
+    report["all_messages"] = timed(lambda query: store.search_messages(query[1], None, 0, 10), queries[:10])
+    report["user_feedback"] = timed(lambda query: store.search_feedback("session", query[0], 0, 10), queries)
+    return report
+
+
+def bench_persistence(path):
+    from storage import DataStore, load_persistent_data, save_persistent_data
+
+    if path.endswith(".shards"):
+        from sharding import ShardedStore
+
+        report = {"file_bytes": sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))}
+        report["store_open"] = timed(lambda _: ShardedStore(path), range(3))
+        return report
+    report = {"file_bytes": os.path.getsize(path)}
+    if path.endswith((".db", ".sqlite")):
+        from sqlite_storage import SQLiteStore
+
+        report["store_open"] = timed(lambda _: SQLiteStore(path), range(3))
+        return report
+    loaded = []
+    report["load"] = timed(lambda _: loaded.append(load_persistent_data(path)), range(3))
+    copy_path = path + ".bench"
+    report["save"] = timed(lambda _: save_persistent_data(loaded[-1], copy_path), range(3))
+    os.remove(copy_path)
+    report["store_open"] = timed(lambda _: DataStore(path), range(3))
+    return report
+
+
+def run(users=1000, path=None, backend="pickle", seed=0, sample=SAMPLE_USERS, brute_sample=BRUTE_FORCE_SAMPLE,
+        workdir=None):
+    """Generate (or reuse) a data file and time every benchmark against it; returns the report"""
+    workdir = os.path.abspath(workdir) if workdir else tempfile.mkdtemp(prefix="study_buddy_bench_")
+    os.makedirs(workdir, exist_ok=True)
+    path = os.path.abspath(path) if path else None
+    previous = os.getcwd()
+    # Match caches and weight files are looked up relative to the working directory
+    os.chdir(workdir)
+    try:
+        return _run(users, path, backend, seed, sample, brute_sample, workdir)
+    finally:
+        os.chdir(previous)
+
+
+def _run(users, path, backend, seed, sample, brute_sample, workdir):
+    report = {"meta": {"python": platform.python_version(), "started_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+                       "seed": seed, "backend": backend, "workdir": workdir}}
+
+    if path is None:
+        path = os.path.join(workdir, "study_buddy_data.pkl")
+        started = time.perf_counter()
+        report["meta"]["records"] = generate(users, path, seed)
+        report["meta"]["generate_seconds"] = time.perf_counter() - started
+        if backend == "sqlite":
+            from sqlite_storage import migrate
+
+            db_path = os.path.join(workdir, "study_buddy_data.db")
+            started = time.perf_counter()
+            migrate(path, db_path)
+            report["meta"]["migrate_seconds"] = time.perf_counter() - started
+            path = db_path
+        elif backend == "sharded":
+            from sharding import migrate
+
+            shards_path = os.path.join(workdir, "study_buddy_data.shards")
+            started = time.perf_counter()
+            migrate(path, shards_path)
+            report["meta"]["migrate_seconds"] = time.perf_counter() - started
+            path = shards_path
+    report["meta"]["data"] = path
+
+    sys.modules["streamlit"] = stub_streamlit()
+    sys.modules["streamlit.errors"] = types.ModuleType("streamlit.errors")
+    sys.modules["streamlit.errors"].StreamlitAPIException = type("StreamlitAPIException", (Exception,), {})
+    import app_complete
+    from storage import get_store
+
+    app_complete.DATA_FILE = path
+    store = get_store(path)
+    data_users = store.data["users"]
+    report["meta"]["users"] = len(data_users)
+    sample_users = random.Random(seed).sample(sorted(data_users), min(sample, len(data_users)))
+
+    report["matching"] = bench_matching(data_users, sample_users, brute_sample)
+    report["app"] = bench_app(app_complete, store, sample_users)
+    report["search"] = bench_search(store, sample_users, seed)
+    report["persistence"] = bench_persistence(path)
+    return report
+
+
+def _latencies(report, prefix=""):
+    """Flatten a report to {"section.metric": mean milliseconds}"""
+    flat = {}
+    for key, value in report.items():
+        if key == "meta" or not isinstance(value, dict):
+            continue
+        if "mean_ms" in value:
+            flat[prefix + key] = value["mean_ms"]
+        else:
+            flat.update(_latencies(value, f"{prefix}{key}."))
+    return flat
+
+
+def compare(report, baseline, ratio=REGRESSION_RATIO):
+    """Metrics whose mean latency grew by more than `ratio` since the baseline report"""
+    before, after = _latencies(baseline), _latencies(report)
+    return {metric: {"baseline_ms": before[metric], "current_ms": after[metric],
+                     "ratio": after[metric] / before[metric]}
+            for metric in sorted(before.keys() & after.keys())
+            if before[metric] > 0 and after[metric] / before[metric] > ratio}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time matching, chat, sessions and persistence on synthetic data")
+    parser.add_argument("--users", type=int, default=1000, help="synthetic students to generate (1k to 1M)")
+    parser.add_argument("--data", help="benchmark an existing data file instead of generating one")
+    parser.add_argument("--backend", choices=("pickle", "sqlite", "sharded"), default="pickle")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--sample", type=int, default=SAMPLE_USERS)
+    parser.add_argument("--brute-force-sample", type=int, default=BRUTE_FORCE_SAMPLE)
+    parser.add_argument("--workdir", help="where generated files go (default: a new temporary directory)")
+    parser.add_argument("--output", help="also write the report to this file")
+    parser.add_argument("--compare", help="baseline report; exits with status 1 if anything got slower")
+    parser.add_argument("--ratio", type=float, default=REGRESSION_RATIO)
+    args = parser.parse_args()
+
+    data_path = os.path.abspath(args.data) if args.data else None
+    output = os.path.abspath(args.output) if args.output else None
+    baseline_path = os.path.abspath(args.compare) if args.compare else None
+    report = run(args.users, data_path, args.backend, args.seed, args.sample, args.brute_force_sample,
+                 os.path.abspath(args.workdir) if args.workdir else None)
+    if baseline_path:
+        with open(baseline_path, 'r', encoding='utf-8') as f:
+            report["regressions"] = compare(report, json.load(f), args.ratio)
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+    print(text)
+    if report.get("regressions"):
+        sys.exit(1)
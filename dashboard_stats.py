@@ -0,0 +1,114 @@
+import argparse
+import json
+from collections import defaultdict
+
+
+class UserStats:
+    """Dashboard counters of one user"""
+
+    __slots__ = ("sent", "received", "connections", "completed", "buddy_sessions",
+                 "feedback", "rating_total", "productivity_total", "would_study_again")
+
+    def __init__(self):
+        self.sent = self.received = self.connections = self.completed = 0
+        self.buddy_sessions = {}
+        self.feedback = self.rating_total = self.productivity_total = self.would_study_again = 0
+
+    def add(self, other):
+        for name in ("sent", "received", "connections", "completed", "feedback", "rating_total",
+                     "productivity_total", "would_study_again"):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for buddy, count in other.buddy_sessions.items():
+            self.buddy_sessions[buddy] = self.buddy_sessions.get(buddy, 0) + count
+
+    def as_dict(self):
+        return {
+            "sent": self.sent,
+            "received": self.received,
+            "connections": self.connections,
+            "completed": self.completed,
+            "buddy_sessions": {buddy: count for buddy, count in self.buddy_sessions.items() if count},
+            "feedback": self.feedback,
+            "avg_rating": self.rating_total / self.feedback if self.feedback else None,
+            "avg_productivity": self.productivity_total / self.feedback if self.feedback else None,
+            "would_study_again": self.would_study_again / self.feedback if self.feedback else None,
+        }
+
+
+class DashboardStats:
+    """Per-user dashboard aggregates, adjusted by a constant amount on every
+    invitation, session and feedback write instead of recounted per page view.
+    `base` holds the contributions of records no longer in the data (archived).
+    """
+
+    def __init__(self, base=None):
+        self.users = defaultdict(UserStats)
+        if base is not None:
+            for username, stats in base.users.items():
+                self.users[username].add(stats)
+
+    def for_user(self, username):
+        return (self.users[username] if username in self.users else UserStats()).as_dict()
+
+    def invitation_added(self, invitation):
+        self.users[invitation["from_username"]].sent += 1
+        self.users[invitation["to_username"]].received += 1
+        if invitation["status"] == "accepted":
+            self.users[invitation["from_username"]].connections += 1
+
+    def invitation_status_changed(self, invitation, old_status):
+        change = (invitation["status"] == "accepted") - (old_status == "accepted")
+        self.users[invitation["from_username"]].connections += change
+
+    def session_added(self, session):
+        if session["status"] == "completed":
+            self._completed(session, 1)
+
+    def session_status_changed(self, session, old_status):
+        change = (session["status"] == "completed") - (old_status == "completed")
+        if change:
+            self._completed(session, change)
+
+    def _completed(self, session, change):
+        user1, user2 = session["user1"], session["user2"]
+        self.users[user1].completed += change
+        if user2 != user1:
+            self.users[user2].completed += change
+            for me, buddy in ((user1, user2), (user2, user1)):
+                counts = self.users[me].buddy_sessions
+                counts[buddy] = counts.get(buddy, 0) + change
+
+    def feedback_added(self, feedback, sign=1):
+        stats = self.users[feedback["from_username"]]
+        stats.feedback += sign
+        stats.rating_total += sign * feedback["rating"]
+        stats.productivity_total += sign * feedback["productivity"]
+        stats.would_study_again += sign * (feedback["would_study_again"] == "Yes")
+
+    def feedback_changed(self, feedback, old_fields):
+        old = {key: feedback.get(key) for key in ("from_username", "rating", "productivity", "would_study_again")}
+        old.update(old_fields)
+        self.feedback_added(old, sign=-1)
+        self.feedback_added(feedback)
+
+
+def rebuild(data):
+    """Recompute the aggregates from the raw record lists (plus what was archived)"""
+    stats = DashboardStats(data.get("archived_stats"))
+    for invitation in data.get("invitations", []):
+        stats.invitation_added(invitation)
+    for session in data.get("sessions", []):
+        stats.session_added(session)
+    for feedback in data.get("feedback", []):
+        stats.feedback_added(feedback)
+    return stats
+
+
+if __name__ == "__main__":
+    from storage import STORAGE_FILE, get_store
+
+    parser = argparse.ArgumentParser(description="Recompute the materialized dashboard statistics from the raw data")
+    parser.add_argument("--data", default=STORAGE_FILE)
+    args = parser.parse_args()
+
+    print(json.dumps({"users_changed": get_store(args.data).rebuild_stats()}, indent=2))
@@ -0,0 +1,81 @@
+import threading
+from collections import defaultdict
+
+# Event kind and the fields naming the users concerned, for each collection that publishes
+COLLECTION_EVENTS = {
+    "invitations": ("invitation", ("from_username", "to_username")),
+    "messages": ("message", ("from_username", "to_username")),
+    "sessions": ("session", ("user1", "user2")),
+}
+
+
+class EventBus:
+    """In-process publish/subscribe of the writes a store applies.
+
+    Every invitation, message, session and read mark the store applies,
+    written by this process or replayed from another process's log, is
+    published to the users it concerns. Views compare `version()` with the
+    one they last drew to tell whether anything changed; callbacks from
+    `subscribe()` run on the publishing thread and must be quick.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.sequence = 0
+        # Sequence of the last reload, which may have changed anything for anyone
+        self.reset = 0
+        # (username, kind) and (username, None) -> sequence of the user's last event
+        self.latest = {}
+        self.subscribers = defaultdict(list)
+
+    def publish(self, kind, record_id, usernames):
+        with self.condition:
+            self.sequence += 1
+            for username in usernames:
+                self.latest[(username, kind)] = self.latest[(username, None)] = self.sequence
+            event = {"kind": kind, "id": record_id, "users": tuple(usernames), "sequence": self.sequence}
+            callbacks = [callback for username in dict.fromkeys(usernames)
+                         for callback in self.subscribers.get(username, ())]
+            self.condition.notify_all()
+        for callback in callbacks:
+            callback(event)
+
+    def written(self, collection, record):
+        """Publish a record added or changed in `collection`, if anyone follows that collection"""
+        if collection in COLLECTION_EVENTS:
+            kind, fields = COLLECTION_EVENTS[collection]
+            self.publish(kind, record.get("id"), [record[field] for field in fields])
+
+    def publish_all(self):
+        """Tell every user that anything may have changed, after a reload"""
+        with self.condition:
+            self.sequence += 1
+            self.reset = self.sequence
+            event = {"kind": None, "id": None, "users": (), "sequence": self.sequence}
+            callbacks = [callback for callbacks in self.subscribers.values() for callback in callbacks]
+            self.condition.notify_all()
+        for callback in callbacks:
+            callback(event)
+
+    def version(self, username, kind=None):
+        """Sequence number of the last event concerning a user, of one kind or of any"""
+        return max(self.latest.get((username, kind), 0), self.reset)
+
+    def subscribe(self, username, callback):
+        """Call `callback(event)` on every event concerning the user; returns the function that unsubscribes"""
+        with self.condition:
+            self.subscribers[username].append(callback)
+
+        def unsubscribe():
+            with self.condition:
+                if callback in self.subscribers.get(username, ()):
+                    self.subscribers[username].remove(callback)
+                    if not self.subscribers[username]:
+                        del self.subscribers[username]
+        return unsubscribe
+
+    def wait(self, username, version, kind=None, timeout=None):
+        """Block until the user's version moves past `version` or `timeout` seconds pass; returns the version"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.version(username, kind) > version, timeout)
+            return self.version(username, kind)
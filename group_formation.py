@@ -0,0 +1,236 @@
+import argparse
+import heapq
+import json
+import multiprocessing
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+
+from matching import MatchEngine, calculate_match_score, top_k
+from storage import STORAGE_FILE, get_store
+
+# Neighbours kept per student; the score graph has at most users * NEIGHBOURS edges
+NEIGHBOURS = 20
+CHUNK_ROWS = 2000
+# Rows scored together in one matrix product; bounds the dense block at users x BLOCK_ROWS
+BLOCK_ROWS = 128
+
+_worker_engine = None
+
+
+def _init_worker(users):
+    global _worker_engine
+    _worker_engine = MatchEngine(users)
+
+
+def _neighbour_chunk(rows, k):
+    """Top-k neighbour rows and scores for a slice of users, run inside a worker"""
+    engine = _worker_engine
+    neighbours = np.zeros((len(rows), k), dtype=np.int64)
+    scores = np.full((len(rows), k), -np.inf)
+    for lo in range(0, len(rows), BLOCK_ROWS):
+        block = rows[lo:lo + BLOCK_ROWS]
+        block_scores = engine.block_scores(block)
+        block_scores[block, np.arange(len(block))] = -np.inf
+        for j in range(len(block)):
+            best = top_k(block_scores[:, j], k)
+            neighbours[lo + j, :len(best)] = best
+            scores[lo + j, :len(best)] = block_scores[best, j]
+    return rows, neighbours, scores
+
+
+def score_graph(users, k=NEIGHBOURS, workers=None, chunk_rows=CHUNK_ROWS):
+    """Sparse all-pairs score graph: each user's k best neighbours, computed on a process pool.
+
+    Returns (usernames, neighbours, scores) where row i of `neighbours` holds
+    the row numbers of user i's best partners and `scores` their scores.
+    """
+    usernames = list(users)
+    k = min(k, max(len(usernames) - 1, 0))
+    neighbours = np.zeros((len(usernames), k), dtype=np.int64)
+    scores = np.full((len(usernames), k), -np.inf)
+    chunks = [np.arange(lo, min(lo + chunk_rows, len(usernames))) for lo in range(0, len(usernames), chunk_rows)]
+    workers = workers or os.cpu_count() or 1
+
+    if workers == 1 or len(chunks) <= 1:
+        _init_worker(users)
+        results = (_neighbour_chunk(rows, k) for rows in chunks)
+        for rows, chunk_neighbours, chunk_scores in results:
+            neighbours[rows], scores[rows] = chunk_neighbours, chunk_scores
+    else:
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(users,)) as pool:
+            for rows, chunk_neighbours, chunk_scores in pool.starmap(_neighbour_chunk, [(rows, k) for rows in chunks]):
+                neighbours[rows], scores[rows] = chunk_neighbours, chunk_scores
+    return usernames, neighbours, scores
+
+
+def _edges(neighbours, scores, blocked):
+    """Undirected edges (score, a, b) with a < b, best first, skipping blocked pairs"""
+    edges = {}
+    for a in range(len(neighbours)):
+        for b, score in zip(neighbours[a], scores[a]):
+            b = int(b)
+            if not np.isfinite(score) or a == b:
+                continue
+            pair = (a, b) if a < b else (b, a)
+            if pair not in blocked:
+                edges[pair] = float(score)
+    return sorted(((score, a, b) for (a, b), score in edges.items()), key=lambda e: (-e[0], e[1], e[2]))
+
+
+def pair_students(neighbours, scores, blocked=frozenset()):
+    """Pairs on the sparse graph: a greedy approximation of maximum-weight matching
+    (heaviest free edge first), improved by pairwise swaps between matched pairs
+    while they raise the total. A local search, so not guaranteed optimal."""
+    edges = _edges(neighbours, scores, blocked)
+    weight = {(a, b): score for score, a, b in edges}
+    partner = {}
+    for score, a, b in edges:
+        if a not in partner and b not in partner:
+            partner[a], partner[b] = b, a
+
+    def w(x, y):
+        return weight.get((x, y) if x < y else (y, x))
+
+    improved = True
+    while improved:
+        improved = False
+        for a in list(partner):
+            b = partner[a]
+            for c in neighbours[a]:
+                c = int(c)
+                d = partner.get(c)
+                if d is None or c in (a, b) or d in (a, b):
+                    continue
+                current = w(a, b) + w(c, d)
+                ac, bd = w(a, c), w(b, d)
+                if ac is not None and bd is not None and ac + bd > current + 1e-12:
+                    partner[a], partner[c], partner[b], partner[d] = c, a, d, b
+                    improved = True
+                    break
+    return sorted({(min(a, b), max(a, b)) for a, b in partner.items()})
+
+
+def form_groups(users, usernames, neighbours, scores, size):
+    """Fixed-size groups: start from the strongest free edge and keep adding the
+    free neighbour with the best total score with the members. Students left
+    over at the end form one smaller group, or a single one joins the group
+    they score best with on average."""
+    free = set(range(len(usernames)))
+    # Every student number, as a heap; numbers no longer free are dropped when they reach the top
+    order = list(range(len(usernames)))
+    groups = []
+
+    def lowest_free(count):
+        found = []
+        while order and len(found) < count:
+            c = heapq.heappop(order)
+            if c in free:
+                found.append(c)
+        for c in found:
+            heapq.heappush(order, c)
+        return found
+
+    def grow(group):
+        while len(group) < size:
+            options = {int(c) for member in group for c in neighbours[member] if int(c) in free}
+            if not options:
+                options = set(lowest_free(NEIGHBOURS))
+            best = max(options, key=lambda c: (sum(calculate_match_score(users[usernames[c]], users[usernames[m]])
+                                                   for m in group), -c))
+            group.append(best)
+            free.discard(best)
+        groups.append(sorted(group))
+
+    for score, a, b in _edges(neighbours, scores, frozenset()):
+        if len(free) < size:
+            break
+        if a in free and b in free:
+            free -= {a, b}
+            grow([a, b])
+    # Students whose neighbours were all taken
+    while len(free) >= size:
+        seed = lowest_free(1)[0]
+        free.discard(seed)
+        grow([seed])
+    if len(free) == 1 and groups:
+        student = free.pop()
+
+        def average(group):
+            return sum(calculate_match_score(users[usernames[student]], users[usernames[m]]) for m in group) / len(group)
+        best = max(groups, key=average)
+        best.append(student)
+        best.sort()
+    elif free:
+        groups.append(sorted(free))
+    return [[usernames[i] for i in group] for group in groups]
+
+
+def write_invitations(store, pairs):
+    """Record each proposed pair as a pending invitation, skipping pairs invited meanwhile"""
+    users = store.data["users"]
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with store.transaction():
+        for from_username, to_username in pairs:
+            if store.has_sent_invitation(from_username, to_username) or store.has_sent_invitation(to_username, from_username):
+                continue
+            store.append("invitations", {
+                "from_username": from_username,
+                "to_username": to_username,
+                "match_score": calculate_match_score(users[from_username], users[to_username]),
+                "status": "pending",
+                "timestamp": timestamp
+            }, counter="invitation_counter")
+
+
+def run(path=STORAGE_FILE, group_size=2, k=NEIGHBOURS, workers=None, dry_run=False):
+    """Pair or group the whole cohort and write pending invitations; returns a throughput report"""
+    store = get_store(path)
+    store.refresh()
+    users = store.data["users"]
+    report = {"users": len(users), "group_size": group_size, "neighbours": k, "workers": workers or os.cpu_count()}
+
+    started = time.perf_counter()
+    usernames, neighbours, scores = score_graph(users, k=k, workers=workers)
+    elapsed = time.perf_counter() - started
+    report["score_seconds"] = elapsed
+    report["pairs_scored_per_second"] = len(users) * max(len(users) - 1, 0) / elapsed if elapsed else 0
+
+    started = time.perf_counter()
+    row = {u: i for i, u in enumerate(usernames)}
+    if group_size == 2:
+        # Pairs that already have an invitation either way are left alone
+        blocked = {(min(row[a], row[b]), max(row[a], row[b]))
+                   for a, b in store.invitation_pairs() if a in row and b in row}
+        groups = [[usernames[a], usernames[b]] for a, b in pair_students(neighbours, scores, blocked)]
+    else:
+        groups = form_groups(users, usernames, neighbours, scores, group_size)
+    report["solve_seconds"] = time.perf_counter() - started
+
+    pairs = [(group[i], group[j]) for group in groups for i in range(len(group)) for j in range(i + 1, len(group))
+             if not store.has_sent_invitation(group[i], group[j]) and not store.has_sent_invitation(group[j], group[i])]
+    report["groups"] = len(groups)
+    report["students_placed"] = sum(len(group) for group in groups)
+    report["invitations"] = len(pairs)
+    report["total_score"] = sum(calculate_match_score(users[a], users[b]) for a, b in pairs)
+
+    if not dry_run:
+        started = time.perf_counter()
+        write_invitations(store, pairs)
+        report["write_seconds"] = time.perf_counter() - started
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pair or group the whole cohort and send pending invitations")
+    parser.add_argument("--data", default=STORAGE_FILE)
+    parser.add_argument("--group-size", type=int, default=2)
+    parser.add_argument("--neighbours", type=int, default=NEIGHBOURS)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.data, group_size=args.group_size, k=args.neighbours,
+                         workers=args.workers, dry_run=args.dry_run), indent=2))
@@ -0,0 +1,150 @@
+from array import array
+from collections import defaultdict
+
+from dashboard_stats import DashboardStats
+from scheduling import ScheduleIndex
+
+
+def pair_key(user_a, user_b):
+    """Order-independent key for a pair of users"""
+    return (user_a, user_b) if user_a <= user_b else (user_b, user_a)
+
+
+class DataIndex:
+    """Secondary indexes over the record lists in the data dict.
+
+    Built once from the raw lists, then kept current by calling `added` and
+    `updated` for every write, so lookups cost the size of the answer
+    instead of a scan of the whole platform. Messages are referred to by
+    their row in the message log, kept in compact arrays.
+    """
+
+    def __init__(self, data):
+        self.by_id = defaultdict(dict)
+        self.invitations_from = defaultdict(list)
+        self.invitations_to = defaultdict(list)
+        self.invitations_between = defaultdict(list)
+        self.buddies = defaultdict(dict)
+        self.messages = data["messages"]
+        self.messages_between = defaultdict(lambda: array("q"))
+        # user -> everyone they exchanged messages with
+        self.conversations = defaultdict(dict)
+        # (recipient, sender) -> rows of unread messages, oldest first; everything up to
+        # the read mark (last read message id) of that conversation counts as read
+        self.unread = defaultdict(lambda: array("q"))
+        self.read_marks = data.setdefault("read_marks", {})
+        self.sessions_of = defaultdict(list)
+        self.feedback_from = defaultdict(list)
+        self.feedback_for_session = {}
+        self.stats = DashboardStats(data.get("archived_stats"))
+        self.schedule = ScheduleIndex()
+
+        for collection in ("invitations", "sessions", "feedback"):
+            for record in data.get(collection, []):
+                self.added(collection, record)
+        for row in range(len(self.messages)):
+            self.message_added(row)
+
+    def added(self, collection, record):
+        if "id" in record:
+            self.by_id[collection][record["id"]] = record
+
+        if collection == "invitations":
+            self.invitations_from[record["from_username"]].append(record)
+            self.invitations_to[record["to_username"]].append(record)
+            self.invitations_between[(record["from_username"], record["to_username"])].append(record)
+            if record["status"] == "accepted":
+                self._connect(record["from_username"], record["to_username"])
+            self.stats.invitation_added(record)
+
+        elif collection == "sessions":
+            self.sessions_of[record["user1"]].append(record)
+            if record["user2"] != record["user1"]:
+                self.sessions_of[record["user2"]].append(record)
+            if record["status"] == "scheduled":
+                self.schedule.add(record)
+            self.stats.session_added(record)
+
+        elif collection == "feedback":
+            self.feedback_from[record["from_username"]].append(record)
+            self.feedback_for_session[(record["session_id"], record["from_username"])] = record
+            self.stats.feedback_added(record)
+
+    def updated(self, collection, record, old_fields):
+        """Adjust the indexes after `record` changed; `old_fields` holds the previous values"""
+        if collection == "invitations" and "status" in old_fields:
+            was_accepted = old_fields["status"] == "accepted"
+            is_accepted = record["status"] == "accepted"
+            if is_accepted and not was_accepted:
+                self._connect(record["from_username"], record["to_username"])
+            elif was_accepted and not is_accepted:
+                self._disconnect(record["from_username"], record["to_username"])
+            self.stats.invitation_status_changed(record, old_fields["status"])
+
+        elif collection == "sessions":
+            if {"status", "date", "time", "duration"} & set(old_fields):
+                old = dict(record.items())
+                old.update(old_fields)
+                if old["status"] == "scheduled":
+                    self.schedule.remove(old)
+                if record["status"] == "scheduled":
+                    self.schedule.add(record)
+            if "status" in old_fields:
+                self.stats.session_status_changed(record, old_fields["status"])
+
+        elif collection == "feedback" and {"rating", "productivity", "would_study_again"} & set(old_fields):
+            self.stats.feedback_changed(record, old_fields)
+
+    def message_added(self, row):
+        message = self.messages[row]
+        rows = self.messages_between[pair_key(message["from_username"], message["to_username"])]
+        rows.append(row)
+        if len(rows) == 1:
+            self.conversations[message["from_username"]][message["to_username"]] = None
+            self.conversations[message["to_username"]][message["from_username"]] = None
+        if not message.get("read", False):
+            key = (message["to_username"], message["from_username"])
+            if message["id"] > self.read_marks.get(key, 0):
+                self.unread[key].append(row)
+            else:
+                message["read"] = True
+
+    def message_updated(self, row, old_fields):
+        if "read" not in old_fields:
+            return
+        message = self.messages[row]
+        key = (message["to_username"], message["from_username"])
+        pending = self.unread.get(key, ())
+        if message["read"] and not old_fields["read"] and row in pending:
+            pending.remove(row)
+        elif old_fields["read"] and not message["read"]:
+            self.unread[key] = array("q", sorted([*pending, row]))
+
+    def mark_read(self, recipient, sender, upto_id):
+        """Move the read mark of a conversation forward and flag the messages it passes"""
+        key = (recipient, sender)
+        self.read_marks[key] = max(self.read_marks.get(key, 0), upto_id)
+        pending = self.unread.get(key, ())
+        read = 0
+        while read < len(pending) and self.messages.message_id(pending[read]) <= upto_id:
+            self.messages[pending[read]]["read"] = True
+            read += 1
+        del pending[:read]
+
+    def _connect(self, user_a, user_b):
+        self.buddies[user_a][user_b] = None
+        self.buddies[user_b][user_a] = None
+
+    def _disconnect(self, user_a, user_b):
+        still_accepted = any(inv["status"] == "accepted"
+                             for key in ((user_a, user_b), (user_b, user_a))
+                             for inv in self.invitations_between.get(key, []))
+        if not still_accepted:
+            self.buddies[user_a].pop(user_b, None)
+            self.buddies[user_b].pop(user_a, None)
+
+    def get(self, collection, record_id):
+        if collection == "messages":
+            row = self.messages.find(record_id)
+            return None if row is None else self.messages[row]
+        return self.by_id[collection].get(record_id)
@@ -0,0 +1,669 @@
+import os
+import heapq
+import json
+import pickle
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+
+import metrics
+
+# Weighted Jaccard similarity: share of the score each profile field contributes
+SUBJECT_WEIGHT = 0.4
+AVAILABILITY_WEIGHT = 0.3
+INTEREST_WEIGHT = 0.2
+STYLE_MATCH = 0.1
+STYLE_MISMATCH = 0.05
+
+SET_FIELDS = ("subjects", "availability", "interests")
+
+# Weights in force until a trained set is published to MATCH_WEIGHTS_FILE (see weight_training.py)
+DEFAULT_WEIGHTS = {
+    "subjects": SUBJECT_WEIGHT,
+    "availability": AVAILABILITY_WEIGHT,
+    "interests": INTEREST_WEIGHT,
+    "style_match": STYLE_MATCH,
+    "style_mismatch": STYLE_MISMATCH,
+}
+MATCH_WEIGHTS_FILE = "match_weights.json"
+# A newly published weight set is picked up at most this many seconds after it is written
+WEIGHTS_CHECK_INTERVAL = 5
+
+MATCH_CACHE_FILE = "match_cache.pkl"
+# Cached recommendations are written back to disk at most this often
+CACHE_SAVE_INTERVAL = 30
+# Cache misses use the posting-list shortlist when it covers less than this share of all users
+SHORTLIST_SHARE = 0.25
+
+_engine_lock = threading.Lock()
+_engine = None
+_cache_lock = threading.Lock()
+_cache = None
+_weights_lock = threading.Lock()
+_weights = {"version": 0, "weights": dict(DEFAULT_WEIGHTS)}
+_weights_mtime = None
+_weights_checked = -WEIGHTS_CHECK_INTERVAL
+
+
+def load_weights(path=MATCH_WEIGHTS_FILE):
+    """Published weight set as {"version", "weights"}; the defaults (version 0) if none was published"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return {"version": 0, "weights": dict(DEFAULT_WEIGHTS)}
+    # Pruning bounds in CandidateIndex rely on no component lowering a score
+    # A state file saved before any feedback could be used holds no weights yet
+    learned = saved.get("weights", {})
+    weights = {name: max(0.0, float(learned.get(name, default))) for name, default in DEFAULT_WEIGHTS.items()}
+    return {"version": saved["version"], "weights": weights}
+
+
+def match_weights(path=MATCH_WEIGHTS_FILE):
+    """The weight set in use, re-read when the published file changes"""
+    global _weights, _weights_mtime, _weights_checked
+    now = time.monotonic()
+    if now - _weights_checked >= WEIGHTS_CHECK_INTERVAL:
+        with _weights_lock:
+            _weights_checked = now
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+            if mtime != _weights_mtime:
+                _weights_mtime = mtime
+                _weights = load_weights(path)
+    return _weights
+
+
+def calculate_match_score(user1, user2, weights=None):
+    weights = weights or match_weights()["weights"]
+    score = 0
+    common_subjects = len(set(user1["subjects"]) & set(user2["subjects"]))
+    total_subjects = len(set(user1["subjects"]) | set(user2["subjects"]))
+    score += (common_subjects / total_subjects) * weights["subjects"] if total_subjects > 0 else 0
+
+    common_times = len(set(user1["availability"]) & set(user2["availability"]))
+    total_times = len(set(user1["availability"]) | set(user2["availability"]))
+    score += (common_times / total_times) * weights["availability"] if total_times > 0 else 0
+
+    common_interests = len(set(user1["interests"]) & set(user2["interests"]))
+    total_interests = len(set(user1["interests"]) | set(user2["interests"]))
+    score += (common_interests / total_interests) * weights["interests"] if total_interests > 0 else 0
+
+    score += weights["style_match"] if user1["study_style"] == user2["study_style"] else weights["style_mismatch"]
+
+    return score
+
+
+def top_k(scores, k):
+    """Indices of the k highest scores, best first; ties keep the original order"""
+    if k <= 0 or len(scores) == 0:
+        return np.empty(0, dtype=np.intp)
+    if k < len(scores):
+        kth = np.partition(scores, len(scores) - k)[len(scores) - k]
+        candidates = np.flatnonzero(scores >= kth)
+    else:
+        candidates = np.arange(len(scores))
+    order = np.lexsort((candidates, -scores[candidates]))
+    return candidates[order[:k]]
+
+
+class MatchEngine:
+    """All user profiles encoded as 0/1 matrices, one column per subject,
+    time slot or interest, so a single query scores every user at once.
+    """
+
+    def __init__(self, users):
+        self.users = users
+        self.usernames = list(users)
+        self.row = {username: i for i, username in enumerate(self.usernames)}
+        self.vocab = {}
+        self.matrix = {}
+        self.sizes = {}
+        for field in SET_FIELDS:
+            vocab = {}
+            for profile in users.values():
+                for value in profile[field]:
+                    vocab.setdefault(value, len(vocab))
+            matrix = np.zeros((len(self.usernames), max(len(vocab), 1)), dtype=np.float32)
+            for i, username in enumerate(self.usernames):
+                for value in users[username][field]:
+                    matrix[i, vocab[value]] = 1
+            self.vocab[field] = vocab
+            self.matrix[field] = matrix
+            self.sizes[field] = matrix.sum(axis=1, dtype=np.float64)
+
+        styles = {}
+        self.style_vocab = styles
+        self.styles = np.array([styles.setdefault(users[u]["study_style"], len(styles)) for u in self.usernames],
+                               dtype=np.int32)
+        self.active = np.ones(len(self.usernames), dtype=bool)
+
+    def update_user(self, username, profile):
+        """Re-encode one profile in place, adding a row or columns if needed"""
+        if username not in self.row:
+            self.row[username] = len(self.usernames)
+            self.usernames.append(username)
+            for field in SET_FIELDS:
+                self.matrix[field] = np.vstack([self.matrix[field],
+                                                np.zeros((1, self.matrix[field].shape[1]), dtype=np.float32)])
+                self.sizes[field] = np.append(self.sizes[field], 0.0)
+            self.styles = np.append(self.styles, -1).astype(np.int32)
+            self.active = np.append(self.active, True)
+        i = self.row[username]
+
+        for field in SET_FIELDS:
+            vocab = self.vocab[field]
+            new_values = [v for v in set(profile[field]) if v not in vocab]
+            for value in new_values:
+                vocab[value] = len(vocab)
+            if len(vocab) > self.matrix[field].shape[1]:
+                grow = len(vocab) - self.matrix[field].shape[1]
+                self.matrix[field] = np.hstack([self.matrix[field],
+                                                np.zeros((len(self.usernames), grow), dtype=np.float32)])
+            self.matrix[field][i, :] = 0
+            for value in profile[field]:
+                self.matrix[field][i, vocab[value]] = 1
+            self.sizes[field][i] = self.matrix[field][i].sum(dtype=np.float64)
+
+        self.styles[i] = self.style_vocab.setdefault(profile["study_style"], len(self.style_vocab))
+        self.active[i] = True
+
+    def remove_user(self, username):
+        if username in self.row:
+            self.active[self.row[username]] = False
+
+    def _encode(self, profile, field):
+        vector = np.zeros(self.matrix[field].shape[1], dtype=np.float32)
+        extra = 0
+        for value in set(profile[field]):
+            column = self.vocab[field].get(value)
+            if column is None:
+                extra += 1
+            else:
+                vector[column] = 1
+        return vector, extra
+
+    def _jaccard(self, profile, field):
+        vector, extra = self._encode(profile, field)
+        common = (self.matrix[field] @ vector).astype(np.float64)
+        total = self.sizes[field] + (vector.sum(dtype=np.float64) + extra) - common
+        return np.divide(common, total, out=np.zeros_like(common), where=total > 0)
+
+    def scores(self, profile, weights=None):
+        """Score of `profile` against every user, in `usernames` order"""
+        weights = weights or match_weights()["weights"]
+        score = self._jaccard(profile, "subjects") * weights["subjects"]
+        score += self._jaccard(profile, "availability") * weights["availability"]
+        score += self._jaccard(profile, "interests") * weights["interests"]
+        style = self.style_vocab.get(profile["study_style"], -1)
+        score += np.where(self.styles == style, weights["style_match"], weights["style_mismatch"])
+        score[~self.active] = -np.inf
+        return score
+
+    def block_scores(self, rows, weights=None):
+        """Scores of the users at `rows` against every user, one column per row"""
+        weights = weights or match_weights()["weights"]
+        score = None
+        for field in SET_FIELDS:
+            matrix, sizes = self.matrix[field], self.sizes[field]
+            common = (matrix @ matrix[rows].T).astype(np.float64)
+            total = sizes[:, None] + sizes[rows][None, :] - common
+            part = np.divide(common, total, out=np.zeros_like(common), where=total > 0) * weights[field]
+            score = part if score is None else score + part
+        score += np.where(self.styles[:, None] == self.styles[rows][None, :],
+                          weights["style_match"], weights["style_mismatch"])
+        score[~self.active] = -np.inf
+        return score
+
+    def pair_features(self, rows_a, rows_b):
+        """Match score components of the pairs (rows_a[i], rows_b[i]), one row per pair, in
+        DEFAULT_WEIGHTS order: the three Jaccard shares, then same style and different style"""
+        columns = []
+        for field in SET_FIELDS:
+            matrix, sizes = self.matrix[field], self.sizes[field]
+            common = np.einsum("ij,ij->i", matrix[rows_a], matrix[rows_b]).astype(np.float64)
+            total = sizes[rows_a] + sizes[rows_b] - common
+            columns.append(np.divide(common, total, out=np.zeros_like(common), where=total > 0))
+        same_style = (self.styles[rows_a] == self.styles[rows_b]).astype(np.float64)
+        return np.column_stack(columns + [same_style, 1 - same_style])
+
+    def top_matches(self, username, k=5):
+        """Best k partners for a user as (username, score) pairs"""
+        scores = self.scores(self.users[username])
+        if username in self.row:
+            scores[self.row[username]] = -np.inf
+        k = min(k, int(np.isfinite(scores).sum()))
+        return [(self.usernames[i], float(scores[i])) for i in top_k(scores, k)]
+
+
+def get_engine(users):
+    """Engine for the current users dict, rebuilt when the dict is replaced or grows"""
+    global _engine
+    with _engine_lock:
+        if _engine is None or _engine.users is not users or len(_engine.usernames) != len(users):
+            _engine = MatchEngine(users)
+        return _engine
+
+
+def find_matches(username, users, k=5):
+    """Top k matches as (username, profile, score), best first"""
+    engine = get_engine(users)
+    return [(other, users[other], score) for other, score in engine.top_matches(username, k)]
+
+
+class CandidateIndex:
+    """Posting lists (value -> rows of the users who have it) for subjects,
+    time slots and interests.
+
+    A query first scores only users sharing a subject or time slot with the
+    student, best upper bound first, and stops once no remaining bound can beat
+    the current k-th score. Users sharing nothing can score at most the
+    interests weight plus the larger style weight and are only looked at when
+    that could matter.
+    """
+
+    def __init__(self, users):
+        self.users = users
+        self.usernames = []
+        self.row = {}
+        self.indexed = {}
+        self.style_of = {}
+        self.postings = {field: defaultdict(set) for field in SET_FIELDS}
+        self.styles = defaultdict(set)
+        self.sizes = {field: np.zeros(len(users)) for field in SET_FIELDS}
+        self._arrays = {field: {} for field in SET_FIELDS}
+        self.last_candidates = 0
+        self.last_scored = 0
+        for username, profile in users.items():
+            self.update_user(username, profile)
+
+    def update_user(self, username, profile):
+        if username in self.row:
+            self.remove_user(username)
+        else:
+            self.row[username] = len(self.usernames)
+            self.usernames.append(username)
+            for field in SET_FIELDS:
+                if len(self.sizes[field]) < len(self.usernames):
+                    self.sizes[field] = np.append(self.sizes[field], np.zeros(len(self.sizes[field]) + 1))
+        row = self.row[username]
+        values = {field: set(profile[field]) for field in SET_FIELDS}
+        for field in SET_FIELDS:
+            for value in values[field]:
+                self.postings[field][value].add(row)
+                self._arrays[field].pop(value, None)
+            self.sizes[field][row] = len(values[field])
+        self.styles[profile["study_style"]].add(row)
+        self.indexed[username] = values
+        self.style_of[username] = profile["study_style"]
+
+    def remove_user(self, username):
+        row = self.row.get(username)
+        for field, values in self.indexed.pop(username, {}).items():
+            for value in values:
+                self.postings[field][value].discard(row)
+                self._arrays[field].pop(value, None)
+        if username in self.style_of:
+            self.styles[self.style_of.pop(username)].discard(row)
+
+    def shortlist_size(self, profile):
+        """Upper estimate of how many users share a subject or time slot with `profile`"""
+        return sum(len(self.postings[field].get(value, ()))
+                   for field in ("subjects", "availability") for value in set(profile[field]))
+
+    def _posting(self, field, value):
+        rows = self._arrays[field].get(value)
+        if rows is None:
+            rows = np.fromiter(self.postings[field].get(value, ()), dtype=np.int64)
+            self._arrays[field][value] = rows
+        return rows
+
+    def _overlap(self, values, field, rows):
+        """How many of `values` each of `rows` shares in one field"""
+        postings = [self._posting(field, value) for value in values]
+        shared, counts = np.unique(np.concatenate(postings or [np.empty(0, dtype=np.int64)]), return_counts=True)
+        if len(shared) == 0 or len(rows) == 0:
+            return np.zeros(len(rows))
+        positions = np.searchsorted(shared, rows)
+        positions[positions == len(shared)] = 0
+        return np.where(shared[positions] == rows, counts[positions], 0).astype(np.float64)
+
+    def _jaccard(self, values, field, rows):
+        common = self._overlap(values, field, rows)
+        total = self.sizes[field][rows] + len(values) - common
+        return np.divide(common, total, out=np.zeros_like(common), where=total > 0)
+
+    def _candidates(self, values, fields, exclude):
+        postings = [self._posting(field, value) for field in fields for value in values[field]]
+        if not postings:
+            return np.empty(0, dtype=np.int64)
+        rows = np.unique(np.concatenate(postings))
+        if len(exclude):
+            rows = rows[~np.isin(rows, exclude)]
+        return rows
+
+    def _score_in_order(self, profile, rows, bounds, best, k, prune, weights):
+        """Score `rows` best bound first into the `best` heap; stops early when pruning"""
+        for i in np.argsort(-bounds, kind="stable"):
+            if prune and len(best) == k and bounds[i] < best[0][0]:
+                break
+            username = self.usernames[rows[i]]
+            if username not in self.indexed:
+                continue
+            item = (calculate_match_score(profile, self.users[username], weights), -int(rows[i]), username)
+            self.last_scored += 1
+            if len(best) < k:
+                heapq.heappush(best, item)
+            elif item[:2] > best[0][:2]:
+                heapq.heapreplace(best, item)
+
+    def top_matches(self, username, k=5, prune=True):
+        """Best k partners as (username, score), scoring only the overlapping shortlist"""
+        profile = self.users[username]
+        weights = match_weights()["weights"]
+        best_style = max(weights["style_match"], weights["style_mismatch"])
+        values = {field: set(profile[field]) for field in SET_FIELDS}
+        me = np.array([self.row[username]] if username in self.row else [], dtype=np.int64)
+        best = []
+        self.last_scored = 0
+
+        # Stage 1: users sharing a subject or a time slot, bounded by their exact share of those two
+        shortlist = self._candidates(values, ("subjects", "availability"), me)
+        self.last_candidates = len(shortlist)
+        bounds = (self._jaccard(values["subjects"], "subjects", shortlist) * weights["subjects"]
+                  + self._jaccard(values["availability"], "availability", shortlist) * weights["availability"]
+                  + weights["interests"] + best_style + 1e-9)
+        self._score_in_order(profile, shortlist, bounds, best, k, prune, weights)
+
+        # Stage 2: users sharing only interests can reach the interests weight plus the best style weight
+        seen = np.concatenate([me, shortlist])
+        if len(best) < k or best[0][0] <= weights["interests"] + best_style + 1e-9:
+            extra = self._candidates(values, ("interests",), seen)
+            self.last_candidates += len(extra)
+            bounds = self._jaccard(values["interests"], "interests", extra) * weights["interests"] + best_style + 1e-9
+            self._score_in_order(profile, extra, bounds, best, k, prune, weights)
+            seen = np.concatenate([seen, extra])
+
+        # Stage 3: everyone else scores exactly one of the two style weights, so the
+        # first k of each kind (in user order) are the only ones that can make the list
+        if len(best) < k or best[0][0] <= best_style + 1e-9:
+            rest = np.setdiff1d(np.arange(len(self.usernames)), seen)
+            same_style = np.isin(rest, np.fromiter(self.styles.get(profile["study_style"], ()), dtype=np.int64))
+            rest = np.concatenate([rest[same_style][:k], rest[~same_style][:k]])
+            self.last_candidates += len(rest)
+            self._score_in_order(profile, rest, np.zeros(len(rest)), best, k, False, weights)
+
+        return [(other, score) for score, _, other in sorted(best, reverse=True)]
+
+
+def profile_fingerprint(profile):
+    return tuple(tuple(sorted(set(profile[field]))) for field in SET_FIELDS) + (profile["study_style"],)
+
+
+class MatchCache:
+    """Persistent top-k recommendations for every user who has asked for matches.
+
+    A query is a dictionary lookup. When a profile changes, that user's list is
+    recomputed with one vectorized pass, and the same pass tells which other
+    users' lists the changed profile enters, moves within or drops out of; only
+    the lists whose k-th place becomes unknown are marked for recomputation.
+    """
+
+    def __init__(self, path=MATCH_CACHE_FILE, k=5):
+        self.path = path
+        self.k = k
+        self.lock = threading.RLock()
+        self.entries = {}
+        self.fingerprints = {}
+        self.held_by = defaultdict(set)
+        self.dirty = set()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.engine = None
+        self.candidates = None
+        self.shortlist_queries = 0
+        # Per engine row: score and row of the last place in that user's list, +inf if not cached
+        self.worst_scores = np.empty(0)
+        self.worst_rows = np.empty(0, dtype=np.int64)
+        self._synced = (None, 0)
+        self.weights_version = match_weights()["version"]
+        self._unsaved = False
+        self._saved_at = time.monotonic()
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                saved = pickle.load(f)
+        except Exception:
+            return
+        if saved.get("k") != self.k or saved.get("weights_version", 0) != self.weights_version:
+            return
+        self.entries = saved["entries"]
+        self.fingerprints = saved["fingerprints"]
+        for username, entry in self.entries.items():
+            for other, score in entry:
+                self.held_by[other].add(username)
+
+    def save(self):
+        with self.lock:
+            entries = {u: entry for u, entry in self.entries.items() if u not in self.dirty}
+            payload = pickle.dumps({"k": self.k, "weights_version": self.weights_version, "entries": entries,
+                                    "fingerprints": self.fingerprints}, protocol=pickle.HIGHEST_PROTOCOL)
+            self._unsaved = False
+            self._saved_at = time.monotonic()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(payload)
+        os.replace(tmp_path, self.path)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "shortlist_queries": self.shortlist_queries,
+            "cached_users": len(self.entries),
+            "dirty_users": len(self.dirty),
+        }
+
+    def sync(self, users, changed=None):
+        """Bring the cache in line with `users`; `changed` lists the usernames
+        whose profile may differ, or None to compare every profile."""
+        with self.lock:
+            if self.engine is None or self.engine.users is not users:
+                self.engine = MatchEngine(users)
+                self.candidates = CandidateIndex(users)
+                self.worst_scores = np.full(len(self.engine.usernames), np.inf)
+                self.worst_rows = np.zeros(len(self.engine.usernames), dtype=np.int64)
+                for username in self.entries:
+                    if username in self.engine.row:
+                        self._update_worst(username)
+                changed = None
+            if changed is None:
+                changed = [u for u in users if self.fingerprints.get(u) != profile_fingerprint(users[u])]
+                changed += [u for u in self.fingerprints if u not in users]
+                if len(changed) > max(50, len(users) // 100):
+                    # Too much changed (or a first run): start over and refill lazily
+                    self._reset(users)
+                    return
+            for username in dict.fromkeys(changed):
+                self._profile_changed(username, users)
+
+    def sync_store(self, store):
+        """Catch up with the profile changes recorded by a DataStore since the last call"""
+        with self.lock:
+            reloads, seen = self._synced
+            users = store.data["users"]
+            if reloads != store.reloads or self.engine is None or self.engine.users is not users:
+                self.sync(users)
+            elif seen < len(store.user_changes):
+                self.sync(users, store.user_changes[seen:])
+            self._synced = (store.reloads, len(store.user_changes))
+            version = match_weights()["version"]
+            if version != self.weights_version:
+                # Every cached score was computed with the old weights
+                self.weights_version = version
+                self._reset(users)
+
+    def _reset(self, users):
+        self.entries = {}
+        self.held_by = defaultdict(set)
+        self.dirty = set()
+        self.fingerprints = {u: profile_fingerprint(profile) for u, profile in users.items()}
+        self.worst_scores[:] = np.inf
+        self.invalidations += 1
+        self._unsaved = True
+
+    def _sort_key(self, item):
+        return (-item[1], self.engine.row[item[0]])
+
+    def _update_worst(self, username):
+        row = self.engine.row[username]
+        entry = self.entries.get(username)
+        if entry is None or username in self.dirty:
+            self.worst_scores[row] = np.inf
+        elif len(entry) < self.k:
+            self.worst_scores[row] = -np.inf
+        else:
+            self.worst_scores[row] = entry[-1][1]
+            self.worst_rows[row] = self.engine.row[entry[-1][0]]
+
+    def _set_entry(self, username, entry):
+        for other, score in self.entries.get(username, []):
+            self.held_by[other].discard(username)
+        self.entries[username] = entry
+        for other, score in entry:
+            self.held_by[other].add(username)
+        self.dirty.discard(username)
+        self._update_worst(username)
+        self._unsaved = True
+
+    def _mark_dirty(self, username):
+        self.dirty.add(username)
+        if username in self.engine.row:
+            self.worst_scores[self.engine.row[username]] = np.inf
+
+    def _compute(self, username):
+        profile = self.engine.users[username]
+        if self.candidates.shortlist_size(profile) < SHORTLIST_SHARE * len(self.engine.usernames):
+            self.shortlist_queries += 1
+            entry = self.candidates.top_matches(username, self.k)
+            metrics.observe("match_scan_rows", self.candidates.last_candidates, method="shortlist")
+        else:
+            entry = self.engine.top_matches(username, self.k)
+            metrics.observe("match_scan_rows", len(self.engine.usernames), method="full")
+        self._set_entry(username, entry)
+
+    def _profile_changed(self, username, users):
+        if username not in users:
+            self.engine.remove_user(username)
+            self.candidates.remove_user(username)
+            self.fingerprints.pop(username, None)
+            for holder in self.held_by.pop(username, set()):
+                self._mark_dirty(holder)
+            for other, score in self.entries.pop(username, []):
+                self.held_by[other].discard(username)
+            self.dirty.discard(username)
+            self.invalidations += 1
+            self._unsaved = True
+            return
+
+        fingerprint = profile_fingerprint(users[username])
+        if self.fingerprints.get(username) == fingerprint and username in self.engine.row:
+            return
+        self.fingerprints[username] = fingerprint
+        self.engine.update_user(username, users[username])
+        self.candidates.update_user(username, users[username])
+        missing = len(self.engine.usernames) - len(self.worst_scores)
+        if missing > 0:
+            self.worst_scores = np.append(self.worst_scores, np.full(missing, np.inf))
+            self.worst_rows = np.append(self.worst_rows, np.zeros(missing, dtype=np.int64))
+        self.invalidations += 1
+        self._unsaved = True
+
+        scores = self.engine.scores(users[username])
+        row = self.engine.row[username]
+        scores[row] = -np.inf
+
+        if username in self.entries:
+            self._set_entry(username, [(self.engine.usernames[i], float(scores[i])) for i in top_k(
+                scores, min(self.k, int(np.isfinite(scores).sum())))])
+
+        for holder in list(self.held_by.get(username, ())):
+            entry = self.entries.get(holder)
+            if holder in self.dirty or entry is None:
+                continue
+            new_item = (username, float(scores[self.engine.row[holder]]))
+            worst = entry[-1]
+            others = [item for item in entry if item[0] != username]
+            if len(entry) < self.k or self._sort_key(new_item) <= self._sort_key(worst):
+                # Everything outside the list ranks below its old last place, so the new score still fits
+                self._set_entry(holder, sorted(others + [new_item], key=self._sort_key)[:self.k])
+            else:
+                self._set_entry(holder, others)
+                self._mark_dirty(holder)
+
+        # Lists the changed profile now breaks into: it beats their current last place
+        beats = (scores > self.worst_scores) | ((scores == self.worst_scores) & (row < self.worst_rows))
+        for i in np.flatnonzero(beats):
+            holder = self.engine.usernames[i]
+            entry = self.entries.get(holder)
+            if entry is None or holder == username or holder in self.held_by.get(username, ()):
+                continue
+            new_item = (username, float(scores[i]))
+            self._set_entry(holder, sorted(entry + [new_item], key=self._sort_key)[:self.k])
+
+    def top_matches(self, username, k=None):
+        """Cached best partners as (username, score); computed on a miss"""
+        k = self.k if k is None else k
+        with self.lock:
+            if username in self.entries and username not in self.dirty and k <= self.k:
+                self.hits += 1
+                metrics.count("match_cache_lookups", result="hit")
+                result = self.entries[username][:k]
+            else:
+                self.misses += 1
+                metrics.count("match_cache_lookups", result="miss")
+                if username not in self.engine.row:
+                    return []
+                if k > self.k:
+                    return self.engine.top_matches(username, k)
+                self._compute(username)
+                result = self.entries[username][:k]
+            if self._unsaved and time.monotonic() - self._saved_at >= CACHE_SAVE_INTERVAL:
+                self.save()
+            return result
+
+
+def get_match_cache(path=MATCH_CACHE_FILE):
+    global _cache
+    with _cache_lock:
+        if _cache is None or _cache.path != path:
+            _cache = MatchCache(path)
+        return _cache
+
+
+@metrics.timed("match_seconds", method="exact")
+def recommend(username, store, k=5):
+    """Top k matches for a user from the shared cache, as (username, profile, score)"""
+    cache = get_match_cache()
+    cache.sync_store(store)
+    users = store.data["users"]
+    return [(other, users[other], score) for other, score in cache.top_matches(username, k)]
+
+
+def profile_options(store, field):
+    """Every value of a profile field seen so far, for the profile form"""
+    cache = get_match_cache()
+    cache.sync_store(store)
+    return sorted(cache.engine.vocab[field])
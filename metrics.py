@@ -0,0 +1,273 @@
+import argparse
+import bisect
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+# Off unless switched on from the admin page or with STUDY_BUDDY_METRICS=1; every
+# timer below costs one flag check while it is off
+ENABLED = os.environ.get("STUDY_BUDDY_METRICS") == "1"
+
+METRICS_FILE = "metrics.prom"
+PREFIX = "study_buddy_"
+
+# Upper bounds of the histogram buckets, in seconds and in bytes or rows
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 10, 100, 1000, 10_000, 100_000, 1_000_000, 10_000_000, 100_000_000)
+
+# Seconds between stack samples of the sampling profiler, and functions listed in its report
+PROFILE_INTERVAL = 0.005
+PROFILE_TOP = 25
+
+_APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class Histogram:
+    """Counts of observed values per bucket, plus their count, sum and maximum"""
+
+    __slots__ = ("buckets", "counts", "count", "total", "max")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile (the maximum for the last bucket)"""
+        rank, seen = q * self.count, 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = Counter()
+_profiler = None
+
+
+def enable(on=True):
+    global ENABLED
+    ENABLED = on
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def observe(name, value, buckets=SIZE_BUCKETS, **labels):
+    """Record a value (payload bytes, rows scanned) in a histogram"""
+    if not ENABLED:
+        return
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+
+def count(name, amount=1, **labels):
+    if ENABLED:
+        with _lock:
+            _counters[_key(name, labels)] += amount
+
+
+@contextmanager
+def timer(name, **labels):
+    """Time the block into the `name` latency histogram"""
+    if not ENABLED:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, LATENCY_BUCKETS, **labels)
+
+
+def timed(name, **labels):
+    """Decorator form of `timer`"""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - started, LATENCY_BUCKETS, **labels)
+        return wrapper
+    return decorate
+
+
+def summary():
+    """Every histogram and counter as plain rows, for display"""
+    with _lock:
+        histograms = [{"metric": name, **dict(labels), "count": h.count, "mean": h.total / h.count,
+                       "p50": h.quantile(0.5), "p95": h.quantile(0.95), "max": h.max, "sum": h.total}
+                      for (name, labels), h in sorted(_histograms.items()) if h.count]
+        counters = [{"metric": name, **dict(labels), "value": value} for (name, labels), value in sorted(_counters.items())]
+    return {"histograms": histograms, "counters": counters}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels, extra=()):
+    pairs = [*labels, *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def prometheus_text():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    with _lock:
+        typed = set()
+        for (name, labels), h in sorted(_histograms.items()):
+            metric = PREFIX + name
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(h.buckets, h.counts):
+                cumulative += bucket_count
+                lines.append(f"{metric}_bucket{_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{metric}_bucket{_labels(labels, [('le', '+Inf')])} {h.count}")
+            lines.append(f"{metric}_sum{_labels(labels)} {h.total}")
+            lines.append(f"{metric}_count{_labels(labels)} {h.count}")
+        for (name, labels), value in sorted(_counters.items()):
+            metric = PREFIX + name + "_total"
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path=METRICS_FILE):
+    """Write the metrics for a node-exporter textfile collector; returns the path"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(prometheus_text())
+    os.replace(tmp_path, path)
+    return path
+
+
+class SamplingProfiler:
+    """Samples the stacks of the other threads every `interval` seconds.
+
+    Only stacks that pass through this app's modules count, so idle server
+    threads do not drown out the request threads. `self` is the innermost
+    function of a sample; `total` is every function on its stack.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.samples = 0
+        self.leaf = Counter()
+        self.inclusive = Counter()
+        self.started_at = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident != me:
+                    self._sample(frame)
+
+    def _sample(self, frame):
+        stack = []
+        in_app = False
+        while frame is not None:
+            code = frame.f_code
+            in_app = in_app or code.co_filename.startswith(_APP_DIR)
+            stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        if not in_app:
+            return
+        self.samples += 1
+        self.leaf[stack[0]] += 1
+        self.inclusive.update(set(stack))
+
+    def report(self, top=PROFILE_TOP):
+        share = (lambda n: n / self.samples) if self.samples else (lambda n: 0.0)
+        return {
+            "samples": self.samples,
+            "seconds": time.time() - self.started_at if self.started_at else 0,
+            "self": [{"function": f, "samples": n, "share": share(n)} for f, n in self.leaf.most_common(top)],
+            "total": [{"function": f, "samples": n, "share": share(n)} for f, n in self.inclusive.most_common(top)],
+        }
+
+
+def start_profiler(interval=PROFILE_INTERVAL):
+    """Start a fresh process-wide sampling profiler, replacing a running one"""
+    global _profiler
+    stop_profiler()
+    _profiler = SamplingProfiler(interval)
+    _profiler.start()
+
+
+def stop_profiler():
+    if _profiler is not None:
+        _profiler.stop()
+
+
+def profiler_running():
+    return _profiler is not None and _profiler._thread is not None and not _profiler._stop.is_set()
+
+
+def profiler_report(top=PROFILE_TOP):
+    return _profiler.report(top) if _profiler is not None else None
+
+
+if __name__ == "__main__":
+    # The storage modules record into the imported module, not into this __main__ copy
+    import metrics
+    from storage import STORAGE_FILE, get_store
+
+    parser = argparse.ArgumentParser(description="Time a load of the data file and print the metrics it produced")
+    parser.add_argument("--data", default=STORAGE_FILE)
+    parser.add_argument("--prometheus", action="store_true", help="print the Prometheus text format instead of JSON")
+    args = parser.parse_args()
+
+    metrics.enable()
+    get_store(args.data).refresh()
+    print(metrics.prometheus_text() if args.prometheus else json.dumps(metrics.summary(), indent=2))
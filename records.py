@@ -0,0 +1,347 @@
+import bisect
+import calendar
+import sys
+import time
+from array import array
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Keep the message log as parallel arrays instead of one slotted object per message
+COLUMNAR_MESSAGES = True
+
+STATUSES = ("pending", "accepted", "declined", "scheduled", "completed", "cancelled")
+STATUS_CODES = {name: code for code, name in enumerate(STATUSES)}
+
+USERNAME_FIELDS = {"from_username", "to_username", "user1", "user2", "partner_username"}
+TIME_FIELDS = {"timestamp", "created_at"}
+# Fields with a handful of distinct values share one string object per value
+SHARED_FIELDS = {"duration", "location", "study_style", "would_study_again"}
+LIST_FIELDS = {"subjects", "interests", "availability"}
+# Display names copied into older records; they are looked up from users now
+DROPPED_FIELDS = {"from_name", "to_name"}
+
+
+def to_epoch(text):
+    """Seconds since the epoch for a timestamp string; other values are kept as they are"""
+    try:
+        return calendar.timegm(time.strptime(text, TIMESTAMP_FORMAT))
+    except (TypeError, ValueError):
+        return text
+
+
+def from_epoch(seconds):
+    return time.strftime(TIMESTAMP_FORMAT, time.gmtime(seconds)) if isinstance(seconds, int) else seconds
+
+
+def pack(key, value):
+    """Compact stored form of a field value"""
+    if key in USERNAME_FIELDS or key in SHARED_FIELDS:
+        return sys.intern(value) if isinstance(value, str) else value
+    if key in TIME_FIELDS:
+        return to_epoch(value)
+    if key == "status":
+        return STATUS_CODES.get(value, value)
+    if key in LIST_FIELDS:
+        return [sys.intern(v) if isinstance(v, str) else v for v in value]
+    return value
+
+
+def unpack(key, value):
+    if key in TIME_FIELDS:
+        return from_epoch(value)
+    if key == "status" and isinstance(value, int):
+        return STATUSES[value]
+    return value
+
+
+class DictAccess:
+    """Read and write a record like the plain dict it replaces"""
+
+    __slots__ = ()
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def update(self, fields=(), **more):
+        for key, value in (fields.items() if hasattr(fields, "items") else fields):
+            self[key] = value
+        for key, value in more.items():
+            self[key] = value
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self.items())!r})"
+
+
+class Record(DictAccess):
+    """A record kept in slots with packed values; fields outside FIELDS go to `extra`"""
+
+    FIELDS = ()
+    __slots__ = ("extra",)
+
+    def __init__(self, fields=()):
+        self.extra = None
+        self.update(fields)
+
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            try:
+                return unpack(key, getattr(self, key))
+            except AttributeError:
+                raise KeyError(key) from None
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.FIELDS:
+            setattr(self, key, pack(key, value))
+        elif key not in DROPPED_FIELDS:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def keys(self):
+        return [field for field in self.FIELDS if hasattr(self, field)] + list(self.extra or ())
+
+    def __reduce__(self):
+        # A tuple of values per record instead of a dict of slot names
+        values = {field: getattr(self, field) for field in self.FIELDS if hasattr(self, field)}
+        if len(values) == len(self.FIELDS):
+            values = tuple(values.values())
+        return _restore, (type(self), values, self.extra)
+
+
+def _restore(cls, values, extra):
+    record = cls.__new__(cls)
+    pairs = values.items() if isinstance(values, dict) else zip(cls.FIELDS, values)
+    for field, value in pairs:
+        setattr(record, field, value)
+    record.extra = extra
+    return record
+
+
+class Profile(Record):
+    FIELDS = ("name", "subjects", "interests", "study_style", "availability")
+    __slots__ = FIELDS
+
+
+class Invitation(Record):
+    FIELDS = ("id", "from_username", "to_username", "match_score", "status", "timestamp")
+    __slots__ = FIELDS
+
+
+class Message(Record):
+    FIELDS = ("id", "from_username", "to_username", "message", "timestamp", "read")
+    __slots__ = FIELDS
+
+
+class Session(Record):
+    FIELDS = ("id", "user1", "user2", "date", "time", "duration", "location", "subject", "notes", "status",
+              "created_at")
+    __slots__ = FIELDS
+
+
+class Feedback(Record):
+    FIELDS = ("session_id", "from_username", "partner_username", "rating", "productivity", "would_study_again",
+              "comments", "timestamp")
+    __slots__ = FIELDS
+
+
+RECORD_TYPES = {"invitations": Invitation, "sessions": Session, "feedback": Feedback}
+
+
+def make_record(collection, fields):
+    """Compact record for a collection; collections without a record type keep plain dicts"""
+    record_type = RECORD_TYPES.get(collection)
+    if record_type is None or isinstance(fields, record_type):
+        return fields
+    return record_type(fields)
+
+
+class MessageLog:
+    """All messages in id order, one slotted Message each, addressed by row number.
+
+    Ids only grow with the row since they are handed out under the write lock,
+    so an id is found by bisection.
+    """
+
+    def __init__(self, messages=()):
+        self.messages = []
+        for message in messages:
+            self.append(message)
+
+    def append(self, fields):
+        """Add a message; returns its row"""
+        self.messages.append(fields if isinstance(fields, Message) else Message(fields))
+        return len(self.messages) - 1
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __getitem__(self, row):
+        return self.messages[row]
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def message_id(self, row):
+        return self.messages[row].id
+
+    def find(self, message_id):
+        """Row of a message id, or None"""
+        row = bisect.bisect_left(range(len(self)), message_id, key=self.message_id)
+        return row if row < len(self) and self.message_id(row) == message_id else None
+
+
+class MessageColumns(MessageLog):
+    """The message log as parallel arrays: ids, sender and recipient codes, epoch
+    timestamps and read flags, plus one list of texts. Rows are read through
+    MessageView objects created on access.
+    """
+
+    def __init__(self, messages=()):
+        self.ids = array("q")
+        self.senders = array("i")
+        self.recipients = array("i")
+        self.timestamps = array("q")
+        self.read = bytearray()
+        self.texts = []
+        self.usernames = []
+        self.user_codes = {}
+        # row -> fields outside the columns, including timestamps that are not in TIMESTAMP_FORMAT
+        self.extra = {}
+        for message in messages:
+            self.append(message)
+
+    def _code(self, username):
+        code = self.user_codes.get(username)
+        if code is None:
+            code = self.user_codes[username] = len(self.usernames)
+            self.usernames.append(sys.intern(username))
+        return code
+
+    def append(self, fields):
+        row = len(self.ids)
+        self.ids.append(fields["id"])
+        self.senders.append(self._code(fields["from_username"]))
+        self.recipients.append(self._code(fields["to_username"]))
+        self.timestamps.append(0)
+        self.read.append(0)
+        self.texts.append(fields.get("message"))
+        for key, value in fields.items():
+            if key not in ("id", "from_username", "to_username", "message"):
+                self.set_field(row, key, value)
+        return row
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, row):
+        return MessageView(self, row)
+
+    def __iter__(self):
+        return (MessageView(self, row) for row in range(len(self.ids)))
+
+    def message_id(self, row):
+        return self.ids[row]
+
+    def field(self, row, key):
+        extra = self.extra.get(row)
+        if extra and key in extra:
+            return extra[key]
+        if key == "id":
+            return self.ids[row]
+        if key == "from_username":
+            return self.usernames[self.senders[row]]
+        if key == "to_username":
+            return self.usernames[self.recipients[row]]
+        if key == "message":
+            return self.texts[row]
+        if key == "timestamp":
+            return from_epoch(self.timestamps[row])
+        if key == "read":
+            return bool(self.read[row])
+        raise KeyError(key)
+
+    def set_field(self, row, key, value):
+        if key == "id":
+            self.ids[row] = value
+        elif key == "from_username":
+            self.senders[row] = self._code(value)
+        elif key == "to_username":
+            self.recipients[row] = self._code(value)
+        elif key == "message":
+            self.texts[row] = value
+        elif key == "read":
+            self.read[row] = bool(value)
+        elif key == "timestamp" and isinstance(to_epoch(value), int):
+            self.timestamps[row] = to_epoch(value)
+            self.extra.get(row, {}).pop(key, None)
+        else:
+            self.extra.setdefault(row, {})[key] = value
+
+    def fields(self, row):
+        return list(Message.FIELDS) + [key for key in self.extra.get(row, ()) if key not in Message.FIELDS]
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["user_codes"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.user_codes = {username: code for code, username in enumerate(self.usernames)}
+
+
+class MessageView(DictAccess):
+    """One row of a MessageColumns log, read and written like a message dict"""
+
+    __slots__ = ("log", "row")
+
+    def __init__(self, log, row):
+        self.log = log
+        self.row = row
+
+    def __getitem__(self, key):
+        return self.log.field(self.row, key)
+
+    def __setitem__(self, key, value):
+        self.log.set_field(self.row, key, value)
+
+    def keys(self):
+        return self.log.fields(self.row)
+
+
+def compact_data(data):
+    """Convert plain-dict records (seed data, older snapshots) to the compact types in place"""
+    users = data.setdefault("users", {})
+    for username, profile in users.items():
+        if not isinstance(profile, Profile):
+            users[username] = Profile(profile)
+    for collection, record_type in RECORD_TYPES.items():
+        records = data.setdefault(collection, [])
+        if not all(isinstance(record, record_type) for record in records):
+            data[collection] = [make_record(collection, record) for record in records]
+    log_type = MessageColumns if COLUMNAR_MESSAGES else MessageLog
+    if type(data.get("messages")) is not log_type:
+        data["messages"] = log_type(data.get("messages", []))
+    return data
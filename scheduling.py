@@ -0,0 +1,147 @@
+import bisect
+import re
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+# Longest session the scheduler handles; bounds how far back an overlap search has to look
+MAX_SESSION_MINUTES = 12 * 60
+# Used for older sessions whose duration cannot be read
+DEFAULT_SESSION_MINUTES = 60
+
+# Weekday hours of each availability bucket; "Weekend" covers Saturday and Sunday
+AVAILABILITY_HOURS = {"Morning": (6, 12), "Afternoon": (12, 17), "Evening": (17, 22)}
+WEEKEND_HOURS = (8, 22)
+
+# Suggested start times are multiples of this many minutes
+SLOT_STEP_MINUTES = 30
+# How far ahead free slots are searched
+SEARCH_DAYS = 28
+
+_EPOCH = datetime(1970, 1, 1)
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)\s*(hours?|hrs?|h|minutes?|mins?|m)\b", re.IGNORECASE)
+
+
+def parse_duration(text):
+    """Minutes in a duration such as "30 min", "1 hour" or "1.5 hours"; ValueError if there are none"""
+    parts = _DURATION.findall(str(text))
+    minutes = sum(float(amount) * (60 if unit[0].lower() == "h" else 1) for amount, unit in parts)
+    if minutes <= 0:
+        raise ValueError(f"Cannot read a duration from {text!r}")
+    return int(round(minutes))
+
+
+def to_minutes(moment):
+    """Minutes since the epoch of a naive datetime"""
+    return int((moment - _EPOCH).total_seconds() // 60)
+
+
+def from_minutes(minutes):
+    return _EPOCH + timedelta(minutes=minutes)
+
+
+def session_interval(session):
+    """(start, end) of a session in minutes since the epoch, or None if its date or time cannot be read"""
+    try:
+        start = to_minutes(datetime.strptime(f"{session['date']} {session['time']}", "%Y-%m-%d %H:%M"))
+    except (KeyError, TypeError, ValueError):
+        return None
+    try:
+        length = parse_duration(session.get("duration"))
+    except ValueError:
+        length = DEFAULT_SESSION_MINUTES
+    return start, start + min(length, MAX_SESSION_MINUTES)
+
+
+class ScheduleIndex:
+    """Scheduled sessions of each user as a sorted list of (start, end, session id).
+
+    No session is longer than MAX_SESSION_MINUTES, so every session that can
+    overlap [start, end) begins in [start - MAX_SESSION_MINUTES, end): two
+    bisections find them, however many sessions the user has.
+    """
+
+    def __init__(self):
+        self.intervals = defaultdict(list)
+
+    def add(self, session):
+        interval = session_interval(session)
+        if interval is None:
+            return
+        for username in {session["user1"], session["user2"]}:
+            bisect.insort(self.intervals[username], (*interval, session["id"]))
+
+    def remove(self, session):
+        interval = session_interval(session)
+        if interval is None:
+            return
+        item = (*interval, session["id"])
+        for username in {session["user1"], session["user2"]}:
+            intervals = self.intervals.get(username, [])
+            i = bisect.bisect_left(intervals, item)
+            if i < len(intervals) and intervals[i] == item:
+                del intervals[i]
+
+    def conflicts(self, username, start, end):
+        """(start, end, session id) of the user's sessions overlapping [start, end)"""
+        intervals = self.intervals.get(username, [])
+        lo = bisect.bisect_left(intervals, (start - MAX_SESSION_MINUTES,))
+        hi = bisect.bisect_left(intervals, (end,))
+        return [item for item in intervals[lo:hi] if item[1] > start]
+
+
+def availability_windows(profile, day):
+    """Merged minute ranges (from midnight) of `day` covered by a profile's availability"""
+    buckets = set(profile.get("availability") or ()) or set(AVAILABILITY_HOURS) | {"Weekend"}
+    if day.weekday() >= 5:
+        hours = [WEEKEND_HOURS] if "Weekend" in buckets else []
+    else:
+        hours = sorted(AVAILABILITY_HOURS[b] for b in buckets if b in AVAILABILITY_HOURS)
+    windows = []
+    for first, last in hours:
+        if windows and windows[-1][1] >= first * 60:
+            windows[-1][1] = max(windows[-1][1], last * 60)
+        else:
+            windows.append([first * 60, last * 60])
+    return windows
+
+
+def _intersect(windows_a, windows_b):
+    both, i, j = [], 0, 0
+    while i < len(windows_a) and j < len(windows_b):
+        lo, hi = max(windows_a[i][0], windows_b[j][0]), min(windows_a[i][1], windows_b[j][1])
+        if lo < hi:
+            both.append((lo, hi))
+        if windows_a[i][1] < windows_b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return both
+
+
+def free_slots(profile1, profile2, busy, duration, after, count=5, step=SLOT_STEP_MINUTES, days=SEARCH_DAYS):
+    """The next `count` start times (datetimes) from `after` on when both users are
+    available for `duration` minutes and neither has a session.
+
+    `busy(start, end)` returns the (start, end, session id) intervals of either
+    user overlapping [start, end); after a clash the search jumps to its end.
+    """
+    slots = []
+    earliest = to_minutes(after)
+    first_day = after.date()
+    for offset in range(days + 1):
+        day = first_day + timedelta(days=offset)
+        midnight = to_minutes(datetime.combine(day, datetime.min.time()))
+        for lo, hi in _intersect(availability_windows(profile1, day), availability_windows(profile2, day)):
+            start = max(midnight + lo, earliest)
+            start += -(start - midnight) % step
+            while start + duration <= midnight + hi:
+                clashes = busy(start, start + duration)
+                if not clashes:
+                    slots.append(from_minutes(start))
+                    if len(slots) == count:
+                        return slots
+                    start += step
+                else:
+                    start = max(end for _, end, _ in clashes)
+                    start += -(start - midnight) % step
+    return slots
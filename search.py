@@ -0,0 +1,133 @@
+import bisect
+import math
+import re
+from array import array
+from collections import Counter
+
+# Words too common to narrow a search down; they are neither indexed nor searched for
+STOP_WORDS = frozenset("""a an and are as at be but by do for from has have i if in is it me my no not of on or
+so that the this to was we were what with you your""".split())
+
+# Matches ranked per query; a broader query is ranked over its newest MAX_MATCHES matches only
+MAX_MATCHES = 1000
+
+# BM25 term-frequency saturation and length normalization
+K1 = 1.2
+B = 0.75
+
+_WORD = re.compile(r"\w+")
+_EMPTY = array("q")
+
+
+def tokenize(text):
+    """Lowercased words of a text, stop words left out"""
+    return [word for word in _WORD.findall(str(text or "").casefold()) if word not in STOP_WORDS]
+
+
+def highlight(text, query):
+    """Markdown of `text` with the words of `query` in bold"""
+    words = set(tokenize(query))
+    return _WORD.sub(lambda m: f"**{m.group()}**" if m.group().casefold() in words else m.group(), str(text or ""))
+
+
+def _contains(postings, doc):
+    i = bisect.bisect_left(postings, doc)
+    return i < len(postings) and postings[i] == doc
+
+
+class TextIndex:
+    """Inverted index of one text field: word -> ids of the documents holding it,
+    in ascending order.
+
+    Documents are added in id order, so every posting list stays sorted and an
+    add is an append per distinct word. A search walks the shortest list
+    among the query's posting lists (and the scope, a user's own documents),
+    newest first, and bisects the others.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.documents = 0
+        self.words = 0
+
+    def add(self, doc, text):
+        words = tokenize(text)
+        self.documents += 1
+        self.words += len(words)
+        for word in dict.fromkeys(words):
+            postings = self.postings.get(word)
+            if postings is None:
+                postings = self.postings[word] = array("q")
+            postings.append(doc)
+
+    def statistics(self, query):
+        """(documents, words, {word: documents holding it}) for the words of `query`;
+        what BM25 needs to know about the whole corpus"""
+        return self.documents, self.words, {word: len(self.postings.get(word, _EMPTY)) for word in tokenize(query)}
+
+    def search(self, query, text_of, scope=None, offset=0, limit=20, corpus=None):
+        """One page of (doc, score) for the documents holding every word of `query`,
+        best first, and the number of matches (at most MAX_MATCHES); `text_of(doc)`
+        returns a document's text. Only documents in `scope`, a sorted sequence of
+        ids, when it is given. `corpus` replaces this index's own `statistics()`
+        when it is one part of a larger corpus."""
+        words = list(dict.fromkeys(tokenize(query)))
+        if not words:
+            return [], 0
+        lists = [self.postings.get(word, _EMPTY) for word in words]
+        if scope is not None:
+            lists.append(scope)
+        lists.sort(key=len)
+        shortest, others = lists[0], lists[1:]
+        matches = []
+        for i in range(len(shortest) - 1, -1, -1):
+            if all(_contains(postings, shortest[i]) for postings in others):
+                matches.append(shortest[i])
+                if len(matches) == MAX_MATCHES:
+                    break
+
+        documents, total_words, frequencies = corpus or self.statistics(query)
+        average = total_words / documents if documents else 1
+        idf = {}
+        for word in words:
+            df = frequencies[word]
+            idf[word] = math.log(1 + (documents - df + 0.5) / (df + 0.5))
+        scored = []
+        for doc in matches:
+            counts = Counter(tokenize(text_of(doc)))
+            norm = K1 * (1 - B + B * sum(counts.values()) / average)
+            scored.append((doc, sum(idf[w] * counts[w] * (K1 + 1) / (counts[w] + norm) for w in words)))
+        # Newer documents first among equal scores
+        scored.sort(key=lambda hit: (-hit[1], -hit[0]))
+        return scored[offset:offset + limit], len(matches)
+
+
+def combine(statistics):
+    """Corpus statistics of several indexes added up, as if they were one index"""
+    documents, words, frequencies = 0, 0, Counter()
+    for part_documents, part_words, part_frequencies in statistics:
+        documents += part_documents
+        words += part_words
+        frequencies.update(part_frequencies)
+    return documents, words, frequencies
+
+
+class SearchIndex:
+    """Text indexes over message text (by message id) and feedback comments (by
+    position in the feedback list, with the positions of each author's feedback)"""
+
+    def __init__(self, data):
+        self.messages = TextIndex()
+        self.feedback = TextIndex()
+        self.feedback_by = {}
+        for message in data.get("messages", []):
+            self.added("messages", message)
+        for feedback in data.get("feedback", []):
+            self.added("feedback", feedback)
+
+    def added(self, collection, record):
+        if collection == "messages":
+            self.messages.add(record["id"], record.get("message"))
+        elif collection == "feedback":
+            self.feedback_by.setdefault(record["from_username"], array("q")).append(self.feedback.documents)
+            self.feedback.add(self.feedback.documents, record.get("comments"))
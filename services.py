@@ -0,0 +1,216 @@
+import time
+
+from approximate_matching import recommend_approximate
+from matching import profile_options, recommend
+from records import TIMESTAMP_FORMAT
+from scheduling import parse_duration, session_interval
+
+DURATIONS = ["30 min", "1 hour", "1.5 hours", "2 hours", "3 hours"]
+LOCATIONS = ["Library", "Online (Zoom)", "Online (Google Meet)", "Cafe", "Study Room", "Other"]
+
+
+def now():
+    return time.strftime(TIMESTAMP_FORMAT)
+
+
+def display_name(store, username):
+    profile = store.data["users"].get(username)
+    return profile["name"] if profile else username
+
+
+def events_version(store, username, kind=None):
+    """Changes whenever a message, invitation, session or read mark ("message",
+    "invitation", "session", "read") concerning the user is written"""
+    return store.events.version(username, kind)
+
+
+def profile_version(store):
+    """Changes whenever any profile changes; a cache key for data derived from profiles"""
+    return store.reloads, len(store.user_changes)
+
+
+# Matching
+
+def find_partners(store, username, k=5, approximate=False):
+    """Best k partners as (username, profile, score)"""
+    return recommend_approximate(username, store, k) if approximate else recommend(username, store, k)
+
+
+def profile_choices(store, field, current=()):
+    """Every value of a profile field in use, plus the user's own"""
+    return sorted(set(profile_options(store, field)) | set(current))
+
+
+def update_profile(store, username, **fields):
+    store.update_user(username, **fields)
+
+
+# Invitations
+
+def send_invitation(store, from_username, to_username, score):
+    """Invite a partner; False if an invitation between them was already sent"""
+    with store.transaction(from_username, to_username):
+        # Another tab may have sent it since the page was drawn
+        if store.has_sent_invitation(from_username, to_username):
+            return False
+        store.append("invitations", {
+            "from_username": from_username,
+            "to_username": to_username,
+            "match_score": score,
+            "status": "pending",
+            "timestamp": now(),
+        }, counter="invitation_counter")
+    return True
+
+
+def respond_to_invitation(store, invitation_id, accept):
+    """Accept or decline; False if the invitation is no longer pending"""
+    return store.update("invitations", invitation_id, expected={"status": "pending"},
+                        status="accepted" if accept else "declined")
+
+
+def invitations(store, username):
+    """(received, sent) invitations of a user"""
+    return store.received_invitations(username), store.sent_invitations(username)
+
+
+def archived_invitations(store, username):
+    """Declined invitations of a user moved to the archive, newest first"""
+    return store.archived("invitations", username)
+
+
+# Chat
+
+def buddies(store, username):
+    return store.accepted_buddies(username)
+
+
+def chat_list(store, username):
+    """(buddy, unread message count) for every buddy"""
+    return [(buddy, store.unread_count(username, buddy)) for buddy in store.accepted_buddies(username)]
+
+
+def open_chat(store, username, buddy_username):
+    """Mark everything the buddy sent so far as read"""
+    store.mark_read(username, buddy_username)
+
+
+def chat_messages(store, username, buddy_username, pages=1, page_size=20):
+    """The newest `pages` pages of a conversation, oldest first, and whether older messages exist"""
+    return store.conversation_page(username, buddy_username, limit=pages * page_size)
+
+
+def new_messages(store, username, buddy_username, after_id):
+    """Messages of a conversation written after the one with id `after_id`"""
+    return store.messages_since(username, buddy_username, after_id)
+
+
+def send_message(store, username, buddy_username, text):
+    return store.append("messages", {
+        "from_username": username,
+        "to_username": buddy_username,
+        "message": text,
+        "timestamp": now(),
+        "read": False,
+    }, counter="message_counter")
+
+
+# Sessions
+
+def upcoming_sessions(store, username):
+    return sorted(store.user_sessions(username, status="scheduled"), key=lambda s: (s["date"], s["time"]))
+
+
+def archived_sessions(store, username):
+    """Completed and cancelled sessions of a user moved to the archive, newest first"""
+    return store.archived("sessions", username)
+
+
+def schedule_session(store, username, buddy_username, date, start_time, duration, location, subject, notes=""):
+    """Book a session unless it overlaps one either user has; returns (session, clashes)
+    with session None when it was refused"""
+    session = {
+        "user1": username,
+        "user2": buddy_username,
+        "date": date.strftime("%Y-%m-%d"),
+        "time": start_time.strftime("%H:%M"),
+        "duration": duration,
+        "location": location,
+        "subject": subject,
+        "notes": notes,
+        "status": "scheduled",
+        "created_at": now(),
+    }
+    # Check and write under one lock so two tabs cannot double-book the same time
+    with store.transaction(username, buddy_username):
+        clashes = store.session_conflicts([username, buddy_username], *session_interval(session))
+        if clashes:
+            return None, clashes
+        store.append("sessions", session, counter="session_counter")
+    return session, []
+
+
+def suggest_slots(store, username, buddy_username, duration, after, count=3):
+    """Next start times free for both users, for a duration such as "1 hour" """
+    return store.free_slots(username, buddy_username, parse_duration(duration), after, count=count)
+
+
+def finish_session(store, session_id, status):
+    """Mark a scheduled session completed or cancelled; False if it is no longer scheduled"""
+    return store.update("sessions", session_id, expected={"status": "scheduled"}, status=status)
+
+
+def partner_of(session, username):
+    return session["user2"] if session["user1"] == username else session["user1"]
+
+
+# Feedback
+
+def sessions_to_rate(store, username):
+    """(completed sessions, the ones the user has not rated yet)"""
+    completed = store.user_sessions(username, status="completed")
+    return completed, [s for s in completed if not store.has_feedback(s["id"], username)]
+
+
+def submit_feedback(store, username, session, rating, productivity, would_study_again, comments=""):
+    """Rate a completed session; False if the user already rated it"""
+    with store.transaction(username):
+        if store.has_feedback(session["id"], username):
+            return False
+        store.append("feedback", {
+            "session_id": session["id"],
+            "from_username": username,
+            "partner_username": partner_of(session, username),
+            "rating": rating,
+            "productivity": productivity,
+            "would_study_again": would_study_again,
+            "comments": comments,
+            "timestamp": now(),
+        })
+    return True
+
+
+def feedback_history(store, username):
+    return store.user_feedback(username)
+
+
+# Search
+
+def search_messages(store, username, query, page=1, page_size=10):
+    """One page of (message, score) from the user's conversations (everyone's for
+    username None), best match first, and the number of matches"""
+    return store.search_messages(query, username, (page - 1) * page_size, page_size)
+
+
+def search_feedback(store, username, query, page=1, page_size=10):
+    """One page of (feedback, score) from the comments the user wrote (everyone's for
+    username None), best match first, and the number of matches"""
+    return store.search_feedback(query, username, (page - 1) * page_size, page_size)
+
+
+# Dashboard
+
+def dashboard(store, username):
+    """Dashboard counters plus (buddy, completed sessions together) for every buddy"""
+    stats = store.dashboard_stats(username)
+    return stats, [(buddy, stats["buddy_sessions"].get(buddy, 0)) for buddy in store.accepted_buddies(username)]
@@ -0,0 +1,377 @@
+import argparse
+import bisect
+import json
+import os
+import threading
+import zlib
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
+
+import archive
+import scheduling
+import search
+from events import EventBus
+from indexes import pair_key
+from storage import (DataStore, StorageError, default_data, file_lock, load_persistent_data, next_id,
+                     save_persistent_data)
+
+SHARDED_FILE = "study_buddy_data.shards"
+
+# Shards of a new sharded store; fixed once the store exists (it is recorded in the manifest)
+SHARDS = 8
+MANIFEST = "shards.json"
+
+COUNTERS = {"invitations": "invitation_counter", "messages": "message_counter", "sessions": "session_counter"}
+
+
+def shard_of(username, shards):
+    """Shard holding a user's account, profile, invitations, sessions and feedback"""
+    return zlib.crc32(username.encode("utf-8")) % shards
+
+
+def pair_shard(user_a, user_b, shards):
+    """Shard holding the conversation of two users"""
+    first, second = pair_key(user_a, user_b)
+    return zlib.crc32(f"{first}\n{second}".encode("utf-8")) % shards
+
+
+def record_shards(collection, record, shards):
+    """Shards keeping a copy of a record, the primary one first.
+
+    Invitations and sessions are copied to the shard of each user so every
+    per-user query reads one shard; the primary shard numbers the record,
+    so `id % shards` names it.
+    """
+    if collection == "messages":
+        return [pair_shard(record["from_username"], record["to_username"], shards)]
+    if collection == "feedback":
+        return [shard_of(record["from_username"], shards)]
+    users = (record["from_username"], record["to_username"]) if collection == "invitations" else (record["user1"], record["user2"])
+    return list(dict.fromkeys(shard_of(username, shards) for username in users))
+
+
+def shard_path(path, index):
+    return os.path.join(path, f"shard-{index:03d}.pkl")
+
+
+def split_data(data, shards):
+    """Partition data into `shards` plain data dicts.
+
+    Ids are renumbered so each record's id names its primary shard; the
+    session ids in feedback and the message ids in read marks follow.
+    """
+    parts = [{"accounts": {}, "users": {}, "feedback": [], "read_marks": {}} for _ in range(shards)]
+    for username, password in data.get("accounts", {}).items():
+        parts[shard_of(username, shards)]["accounts"][username] = password
+    for username, profile in data.get("users", {}).items():
+        parts[shard_of(username, shards)]["users"][username] = dict(profile.items())
+
+    new_ids = {}
+    # (recipient, sender) -> [(old id, new id)] in message order
+    received = defaultdict(list)
+    for collection, counter in COUNTERS.items():
+        renumbered = new_ids[collection] = {}
+        for part in parts:
+            part[collection] = []
+            part[counter] = 0
+        for record in data.get(collection, []):
+            record = dict(record.items())
+            targets = record_shards(collection, record, shards)
+            primary = parts[targets[0]]
+            primary[counter] = next_id(primary[counter], shards, targets[0])
+            renumbered[record.get("id")] = primary[counter]
+            if collection == "messages":
+                received[(record["to_username"], record["from_username"])].append((record.get("id", 0), primary[counter]))
+            record["id"] = primary[counter]
+            for i in targets:
+                parts[i][collection].append(dict(record))
+
+    for feedback in data.get("feedback", []):
+        feedback = dict(feedback.items())
+        feedback["session_id"] = new_ids["sessions"].get(feedback.get("session_id"), feedback.get("session_id"))
+        parts[shard_of(feedback["from_username"], shards)]["feedback"].append(feedback)
+
+    for (recipient, sender), upto in data.get("read_marks", {}).items():
+        # A conversation lives in one shard, so renumbering kept its messages in order
+        messages = received.get((recipient, sender), [])
+        read = bisect.bisect_right([old for old, _ in messages], upto)
+        if read:
+            parts[pair_shard(recipient, sender, shards)]["read_marks"][(recipient, sender)] = messages[read - 1][1]
+    return parts
+
+
+def write_shards(path, data, shards):
+    """Write the shard snapshots of `data`, then the manifest that makes them a store"""
+    os.makedirs(path, exist_ok=True)
+    parts = split_data(data, shards)
+    for i, part in enumerate(parts):
+        save_persistent_data(part, shard_path(path, i))
+    tmp_path = os.path.join(path, MANIFEST + ".tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"shards": shards}, f)
+    os.replace(tmp_path, os.path.join(path, MANIFEST))
+    return parts
+
+
+def migrate(pickle_path, shards_path=SHARDED_FILE, shards=SHARDS):
+    """One-shot split of the pickle data (snapshot plus unfolded log) into a new sharded store;
+    returns the number of records in each shard"""
+    if os.path.exists(shards_path):
+        raise StorageError(f"{shards_path} already exists; migrate into a new directory")
+    data = archive.restore(load_persistent_data(pickle_path), pickle_path)
+    parts = write_shards(shards_path, data, shards)
+    return [{key: len(part[key]) for key in ("users", "invitations", "messages", "sessions", "feedback")}
+            for part in parts]
+
+
+class ShardedStore:
+    """Drop-in replacement for DataStore that partitions the data by user over
+    several DataStore shards in one directory.
+
+    A user's account, profile, invitations, sessions and feedback live in the
+    shard their username hashes to, and a conversation in the shard its pair
+    of users hashes to, so each read and write takes only the locks and log
+    files of the shards it concerns and server processes writing for
+    different users do not wait on each other. Profiles are still merged into
+    `data` since the matcher scores every profile anyway.
+    """
+
+    def __init__(self, path=SHARDED_FILE, shards=SHARDS):
+        self.path = path
+        self.lock = threading.RLock()
+        self.reloads = 0
+        os.makedirs(path, exist_ok=True)
+        manifest = os.path.join(path, MANIFEST)
+        with file_lock(os.path.join(path, MANIFEST + ".lock")):
+            if not os.path.exists(manifest):
+                write_shards(path, default_data(), shards)
+        with open(manifest, 'r', encoding='utf-8') as f:
+            count = json.load(f)["shards"]
+        # One bus for all shards; a record copied to two shards is published by both
+        self.events = EventBus()
+        self.shards = [DataStore(shard_path(path, i), id_stride=count, id_offset=i, events=self.events)
+                       for i in range(count)]
+        self._merge()
+
+    def _merge(self):
+        with self.lock:
+            self.data = {"accounts": {}, "users": {}}
+            for shard in self.shards:
+                self.data["accounts"].update(shard.data["accounts"])
+                self.data["users"].update(shard.data["users"])
+            # Profiles changed since the last reload, in order; lets caches catch up incrementally
+            self.user_changes = []
+            self.reloads += 1
+            self._synced = [(shard.reloads, len(shard.user_changes)) for shard in self.shards]
+
+    def _sync(self):
+        """Bring the merged accounts and profiles in line with the shards"""
+        with self.lock:
+            users = self.data["users"]
+            for i, shard in enumerate(self.shards):
+                reloads, seen = self._synced[i]
+                if reloads != shard.reloads:
+                    # Only this shard's users are announced as changed, so caches over
+                    # the other shards' profiles survive a reload of one shard
+                    self.data["accounts"].update(shard.data["accounts"])
+                    changed = list(shard.data["users"])
+                else:
+                    changed = shard.user_changes[seen:]
+                for username in changed:
+                    users[username] = shard.data["users"][username]
+                self.user_changes.extend(changed)
+                self._synced[i] = (shard.reloads, len(shard.user_changes))
+
+    def _shard(self, username):
+        return self.shards[shard_of(username, len(self.shards))]
+
+    def _pair_shard(self, user_a, user_b):
+        return self.shards[pair_shard(user_a, user_b, len(self.shards))]
+
+    def reload(self):
+        for shard in self.shards:
+            shard.reload()
+        self._merge()
+
+    def refresh(self):
+        """Bring every shard, and the merged profiles, up to date with the files on disk"""
+        for shard in self.shards:
+            shard.refresh()
+        self._sync()
+
+    @contextmanager
+    def _hold(self, indexes):
+        # Always in index order, so two transactions over overlapping shards cannot deadlock
+        with ExitStack() as stack:
+            for i in sorted(set(indexes)):
+                stack.enter_context(self.shards[i].transaction())
+            self._sync()
+            yield self
+
+    def transaction(self, *usernames):
+        """Hold the shards of `usernames`, and of their conversations, for a
+        read-check-write sequence; every shard when no user is named"""
+        count = len(self.shards)
+        if not usernames:
+            return self._hold(range(count))
+        return self._hold([shard_of(u, count) for u in usernames] +
+                          [pair_shard(a, b, count) for i, a in enumerate(usernames) for b in usernames[i + 1:]])
+
+    def append(self, collection, record, counter=None):
+        """Add a record to its primary shard, which numbers it, and copy it to the others"""
+        targets = record_shards(collection, record, len(self.shards))
+        with self._hold(targets):
+            self.shards[targets[0]].append(collection, record, counter)
+            for i in targets[1:]:
+                self.shards[i].append(collection, dict(record))
+        return record
+
+    def update(self, collection, record_id, expected=None, **fields):
+        """Change a record in every shard holding a copy; `expected` is checked on the primary copy"""
+        record = self.get(collection, record_id)
+        targets = record_shards(collection, record, len(self.shards)) if record is not None else [record_id % len(self.shards)]
+        with self._hold(targets):
+            if not self.shards[targets[0]].update(collection, record_id, expected, **fields):
+                return False
+            for i in targets[1:]:
+                self.shards[i].update(collection, record_id, **fields)
+        return True
+
+    def update_user(self, username, **fields):
+        self._shard(username).update_user(username, **fields)
+        self._sync()
+
+    def mark_read(self, username, buddy_username):
+        self._pair_shard(username, buddy_username).mark_read(username, buddy_username)
+
+    def compact(self):
+        for shard in self.shards:
+            shard.compact()
+
+    def archive(self, now=None, session_days=archive.SESSION_DAYS, invitation_days=archive.INVITATION_DAYS,
+                message_days=archive.MESSAGE_DAYS):
+        """Archive each shard in turn next to its own file; returns the records moved in all shards"""
+        # A session's ratings live in each rater's shard; a rating written meanwhile only keeps a session hot
+        rated = set()
+        for shard in self.shards:
+            shard.refresh()
+            rated |= archive.rated_sessions(shard.data)
+        moved = defaultdict(int)
+        for shard in self.shards:
+            for collection, count in shard.archive(now, session_days, invitation_days, message_days,
+                                                   rated).items():
+                moved[collection] += count
+        return dict(moved)
+
+    # Queries, each answered by one shard unless it spans users
+
+    def get(self, collection, record_id):
+        return self.shards[record_id % len(self.shards)].get(collection, record_id)
+
+    def accepted_buddies(self, username):
+        return self._shard(username).accepted_buddies(username)
+
+    def received_invitations(self, username):
+        return self._shard(username).received_invitations(username)
+
+    def sent_invitations(self, username):
+        return self._shard(username).sent_invitations(username)
+
+    def has_sent_invitation(self, from_username, to_username):
+        return self._shard(from_username).has_sent_invitation(from_username, to_username)
+
+    def invitation_pairs(self):
+        """Every (from_username, to_username) with an invitation in any status"""
+        return list(dict.fromkeys(pair for shard in self.shards for pair in shard.invitation_pairs()))
+
+    def conversation(self, username, buddy_username):
+        return self._pair_shard(username, buddy_username).conversation(username, buddy_username)
+
+    def conversation_page(self, username, buddy_username, before_id=None, limit=20):
+        return self._pair_shard(username, buddy_username).conversation_page(username, buddy_username, before_id, limit)
+
+    def messages_since(self, username, buddy_username, after_id):
+        return self._pair_shard(username, buddy_username).messages_since(username, buddy_username, after_id)
+
+    def _search(self, shards, collection, query, username, offset, limit):
+        # Every shard ranks with the statistics of the whole corpus, so scores from different
+        # shards compare and rank as one store would; the best offset + limit of each cover the page
+        corpus = search.combine(shard.search_statistics(collection, query) for shard in self.shards)
+        hits, total = [], 0
+        for shard in shards:
+            found, matches = getattr(shard, "search_" + collection)(query, username, 0, offset + limit, corpus)
+            hits.extend(found)
+            total += matches
+        hits.sort(key=lambda hit: (-hit[1], -hit[0].get("id", 0)))
+        return hits[offset:offset + limit], total
+
+    def search_messages(self, query, username=None, offset=0, limit=20):
+        """One page of (message, score) holding every word of `query`, best first, and the
+        number of matches; a user's conversations are spread over the shards, so all are asked"""
+        return self._search(self.shards, "messages", query, username, offset, limit)
+
+    def search_feedback(self, query, username=None, offset=0, limit=20):
+        shards = [self._shard(username)] if username is not None else self.shards
+        return self._search(shards, "feedback", query, username, offset, limit)
+
+    def unread_count(self, username, buddy_username):
+        return self._pair_shard(username, buddy_username).unread_count(username, buddy_username)
+
+    def archived(self, collection, username):
+        return self._shard(username).archived(collection, username)
+
+    def user_sessions(self, username, status=None):
+        return self._shard(username).user_sessions(username, status)
+
+    def user_feedback(self, username):
+        return self._shard(username).user_feedback(username)
+
+    def has_feedback(self, session_id, username):
+        return self._shard(username).has_feedback(session_id, username)
+
+    def feedback_since(self, cursor=0):
+        """Feedback written after `cursor` (0 for all of it), and the cursor to pass next time;
+        the cursor holds a position per shard"""
+        positions = cursor or [0] * len(self.shards)
+        feedback, cursor = [], []
+        for shard, position in zip(self.shards, positions):
+            written, end = shard.feedback_since(position)
+            feedback.extend(written)
+            cursor.append(end)
+        return feedback, cursor
+
+    def session_conflicts(self, usernames, start, end):
+        """Scheduled sessions of any of `usernames` overlapping [start, end), in minutes since the epoch"""
+        sessions = {}
+        for username in usernames:
+            for session in self._shard(username).session_conflicts([username], start, end):
+                sessions.setdefault(session["id"], session)
+        return list(sessions.values())
+
+    def free_slots(self, username, buddy_username, duration, after, count=5):
+        """The next `count` start times when both users are available and free for `duration` minutes"""
+        users = self.data["users"]
+        mine, theirs = self._shard(username).index.schedule, self._shard(buddy_username).index.schedule
+        return scheduling.free_slots(
+            users[username], users[buddy_username],
+            lambda start, end: mine.conflicts(username, start, end) + theirs.conflicts(buddy_username, start, end),
+            duration, after, count)
+
+    def dashboard_stats(self, username):
+        return self._shard(username).dashboard_stats(username)
+
+    def rebuild_stats(self):
+        """Recompute the dashboard aggregates of every shard; returns how many users' stats were off"""
+        return sum(shard.rebuild_stats() for shard in self.shards)
+
+
+if __name__ == "__main__":
+    from storage import STORAGE_FILE
+
+    parser = argparse.ArgumentParser(description="Split the pickle data into a new sharded store")
+    parser.add_argument("--from", dest="source", default=STORAGE_FILE)
+    parser.add_argument("--to", dest="target", default=SHARDED_FILE)
+    parser.add_argument("--shards", type=int, default=SHARDS)
+    args = parser.parse_args()
+
+    print(json.dumps(migrate(args.source, args.target, args.shards), indent=2))
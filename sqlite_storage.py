@@ -0,0 +1,736 @@
+import argparse
+import functools
+import json
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import archive
+import metrics
+import scheduling
+import search
+from dashboard_stats import UserStats
+from events import EventBus
+from storage import STORAGE_FILE, StorageError, default_data, load_persistent_data
+
+SQLITE_FILE = "study_buddy_data.db"
+
+# Connections kept open per store; one is held for the length of each query or transaction
+POOL_SIZE = 8
+
+# Columns of each record table besides the id; any other field is kept in the `extra` JSON column
+COLUMNS = {
+    "invitations": ("from_username", "from_name", "to_username", "to_name", "match_score", "status", "timestamp"),
+    "messages": ("from_username", "to_username", "message", "timestamp", "read"),
+    "sessions": ("user1", "user2", "date", "time", "duration", "location", "subject", "notes", "status", "created_at"),
+    "feedback": ("session_id", "from_username", "partner_username", "rating", "productivity",
+                 "would_study_again", "comments", "timestamp"),
+}
+BOOLEAN_COLUMNS = {"read"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS accounts (username TEXT PRIMARY KEY, password TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, profile TEXT NOT NULL);
+
+CREATE TABLE IF NOT EXISTS invitations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    from_username TEXT NOT NULL,
+    from_name TEXT,
+    to_username TEXT NOT NULL,
+    to_name TEXT,
+    match_score REAL,
+    status TEXT NOT NULL,
+    timestamp TEXT,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS invitations_from ON invitations (from_username, to_username);
+CREATE INDEX IF NOT EXISTS invitations_from_status ON invitations (from_username, status);
+CREATE INDEX IF NOT EXISTS invitations_to_status ON invitations (to_username, status);
+
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    from_username TEXT NOT NULL,
+    to_username TEXT NOT NULL,
+    message TEXT,
+    timestamp TEXT,
+    read INTEGER NOT NULL DEFAULT 0,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_pair ON messages (from_username, to_username, id);
+CREATE INDEX IF NOT EXISTS messages_unread ON messages (to_username, from_username, id) WHERE read = 0;
+CREATE TABLE IF NOT EXISTS read_marks (
+    recipient TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    upto INTEGER NOT NULL,
+    PRIMARY KEY (recipient, sender)
+);
+
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user1 TEXT NOT NULL,
+    user2 TEXT NOT NULL,
+    date TEXT,
+    time TEXT,
+    duration TEXT,
+    location TEXT,
+    subject TEXT,
+    notes TEXT,
+    status TEXT NOT NULL,
+    created_at TEXT,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS sessions_user1_status ON sessions (user1, status);
+CREATE INDEX IF NOT EXISTS sessions_user2_status ON sessions (user2, status);
+-- Time span of each scheduled session per participant, in minutes since the epoch
+CREATE TABLE IF NOT EXISTS session_intervals (
+    username TEXT NOT NULL,
+    starts INTEGER NOT NULL,
+    ends INTEGER NOT NULL,
+    session_id INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS session_intervals_user ON session_intervals (username, starts);
+CREATE INDEX IF NOT EXISTS session_intervals_session ON session_intervals (session_id);
+
+CREATE TABLE IF NOT EXISTS feedback (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id INTEGER,
+    from_username TEXT NOT NULL,
+    partner_username TEXT,
+    rating INTEGER,
+    productivity INTEGER,
+    would_study_again TEXT,
+    comments TEXT,
+    timestamp TEXT,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS feedback_from ON feedback (from_username);
+CREATE INDEX IF NOT EXISTS feedback_session ON feedback (session_id, from_username);
+
+-- Materialized dashboard counters, kept current by the triggers below
+CREATE TABLE IF NOT EXISTS user_stats (
+    username TEXT PRIMARY KEY,
+    sent INTEGER NOT NULL DEFAULT 0,
+    received INTEGER NOT NULL DEFAULT 0,
+    connections INTEGER NOT NULL DEFAULT 0,
+    completed INTEGER NOT NULL DEFAULT 0,
+    feedback INTEGER NOT NULL DEFAULT 0,
+    rating_total INTEGER NOT NULL DEFAULT 0,
+    productivity_total INTEGER NOT NULL DEFAULT 0,
+    would_study_again INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS buddy_sessions (
+    username TEXT NOT NULL,
+    buddy TEXT NOT NULL,
+    completed INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (username, buddy)
+);
+
+CREATE TRIGGER IF NOT EXISTS invitation_stats AFTER INSERT ON invitations BEGIN
+    INSERT INTO user_stats (username, sent, connections) VALUES (NEW.from_username, 1, NEW.status = 'accepted')
+        ON CONFLICT (username) DO UPDATE SET sent = sent + 1, connections = connections + excluded.connections;
+    INSERT INTO user_stats (username, received) VALUES (NEW.to_username, 1)
+        ON CONFLICT (username) DO UPDATE SET received = received + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS invitation_status_stats AFTER UPDATE OF status ON invitations BEGIN
+    UPDATE user_stats SET connections = connections + (NEW.status = 'accepted') - (OLD.status = 'accepted')
+        WHERE username = NEW.from_username;
+END;
+CREATE TRIGGER IF NOT EXISTS session_stats AFTER INSERT ON sessions WHEN NEW.status = 'completed' BEGIN
+    INSERT INTO user_stats (username, completed) VALUES (NEW.user1, 1)
+        ON CONFLICT (username) DO UPDATE SET completed = completed + 1;
+    INSERT INTO user_stats (username, completed) SELECT NEW.user2, 1 WHERE NEW.user2 != NEW.user1
+        ON CONFLICT (username) DO UPDATE SET completed = completed + 1;
+    INSERT INTO buddy_sessions
+        SELECT NEW.user1, NEW.user2, 1 WHERE NEW.user2 != NEW.user1
+        UNION ALL
+        SELECT NEW.user2, NEW.user1, 1 WHERE NEW.user2 != NEW.user1
+        ON CONFLICT (username, buddy) DO UPDATE SET completed = completed + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS session_status_stats AFTER UPDATE OF status ON sessions
+WHEN (NEW.status = 'completed') != (OLD.status = 'completed') BEGIN
+    INSERT INTO user_stats (username, completed) VALUES (NEW.user1, (NEW.status = 'completed') - (OLD.status = 'completed'))
+        ON CONFLICT (username) DO UPDATE SET completed = completed + excluded.completed;
+    INSERT INTO user_stats (username, completed)
+        SELECT NEW.user2, (NEW.status = 'completed') - (OLD.status = 'completed') WHERE NEW.user2 != NEW.user1
+        ON CONFLICT (username) DO UPDATE SET completed = completed + excluded.completed;
+    INSERT INTO buddy_sessions
+        SELECT NEW.user1, NEW.user2, (NEW.status = 'completed') - (OLD.status = 'completed') WHERE NEW.user2 != NEW.user1
+        UNION ALL
+        SELECT NEW.user2, NEW.user1, (NEW.status = 'completed') - (OLD.status = 'completed') WHERE NEW.user2 != NEW.user1
+        ON CONFLICT (username, buddy) DO UPDATE SET completed = completed + excluded.completed;
+END;
+CREATE TRIGGER IF NOT EXISTS feedback_stats AFTER INSERT ON feedback BEGIN
+    INSERT INTO user_stats (username, feedback, rating_total, productivity_total, would_study_again)
+        VALUES (NEW.from_username, 1, NEW.rating, NEW.productivity, NEW.would_study_again = 'Yes')
+        ON CONFLICT (username) DO UPDATE SET feedback = feedback + 1,
+            rating_total = rating_total + excluded.rating_total,
+            productivity_total = productivity_total + excluded.productivity_total,
+            would_study_again = would_study_again + excluded.would_study_again;
+END;
+-- Word indexes over message text and feedback comments; `users` holds the words of the
+-- usernames who may see a row, which narrows a search scoped to one user before the exact
+-- check on the base table
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_text USING fts5(message, users, content='');
+CREATE VIRTUAL TABLE IF NOT EXISTS feedback_text USING fts5(comments, users, content='');
+CREATE TRIGGER IF NOT EXISTS messages_text_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_text (rowid, message, users) VALUES (NEW.id, NEW.message, NEW.from_username || ' ' || NEW.to_username);
+END;
+CREATE TRIGGER IF NOT EXISTS feedback_text_insert AFTER INSERT ON feedback BEGIN
+    INSERT INTO feedback_text (rowid, comments, users) VALUES (NEW.id, NEW.comments, NEW.from_username);
+END;
+
+CREATE TRIGGER IF NOT EXISTS feedback_update_stats AFTER UPDATE OF rating, productivity, would_study_again ON feedback BEGIN
+    UPDATE user_stats SET rating_total = rating_total + NEW.rating - OLD.rating,
+            productivity_total = productivity_total + NEW.productivity - OLD.productivity,
+            would_study_again = would_study_again + (NEW.would_study_again = 'Yes') - (OLD.would_study_again = 'Yes')
+        WHERE username = NEW.from_username;
+END;
+"""
+
+REBUILD_STATS = """
+DELETE FROM user_stats;
+DELETE FROM buddy_sessions;
+INSERT INTO user_stats (username) SELECT from_username FROM invitations UNION SELECT to_username FROM invitations
+    UNION SELECT user1 FROM sessions UNION SELECT user2 FROM sessions UNION SELECT from_username FROM feedback;
+UPDATE user_stats SET
+    sent = (SELECT COUNT(*) FROM invitations WHERE from_username = user_stats.username),
+    received = (SELECT COUNT(*) FROM invitations WHERE to_username = user_stats.username),
+    connections = (SELECT COUNT(*) FROM invitations WHERE from_username = user_stats.username AND status = 'accepted'),
+    completed = (SELECT COUNT(*) FROM sessions WHERE status = 'completed' AND (user1 = user_stats.username OR user2 = user_stats.username)),
+    feedback = (SELECT COUNT(*) FROM feedback WHERE from_username = user_stats.username),
+    rating_total = (SELECT COALESCE(SUM(rating), 0) FROM feedback WHERE from_username = user_stats.username),
+    productivity_total = (SELECT COALESCE(SUM(productivity), 0) FROM feedback WHERE from_username = user_stats.username),
+    would_study_again = (SELECT COUNT(*) FROM feedback WHERE from_username = user_stats.username AND would_study_again = 'Yes');
+INSERT INTO buddy_sessions
+    SELECT user1, user2, COUNT(*) FROM sessions WHERE status = 'completed' AND user1 != user2 GROUP BY user1, user2
+    UNION ALL
+    SELECT user2, user1, COUNT(*) FROM sessions WHERE status = 'completed' AND user1 != user2 GROUP BY user1, user2
+    ON CONFLICT (username, buddy) DO UPDATE SET completed = completed + excluded.completed;
+"""
+
+# Fixed SQL text, so sqlite3's statement cache reuses each prepared statement
+INSERT = {c: f"INSERT INTO {c} ({', '.join(cols)}, extra) VALUES ({', '.join('?' * (len(cols) + 1))})"
+          for c, cols in COLUMNS.items()}
+INSERT_WITH_ID = {c: f"INSERT INTO {c} (id, {', '.join(cols)}, extra) VALUES ({', '.join('?' * (len(cols) + 2))})"
+                  for c, cols in COLUMNS.items()}
+UPDATE = {c: f"UPDATE {c} SET {', '.join(f'{col} = ?' for col in cols)}, extra = ? WHERE id = ?"
+          for c, cols in COLUMNS.items()}
+SELECT_BY_ID = {c: f"SELECT * FROM {c} WHERE id = ?" for c in COLUMNS}
+
+ACCEPTED_BUDDIES = """
+    SELECT to_username AS buddy, id FROM invitations WHERE from_username = ? AND status = 'accepted'
+    UNION ALL
+    SELECT from_username AS buddy, id FROM invitations WHERE to_username = ? AND status = 'accepted'
+    ORDER BY id"""
+CONVERSATION = """
+    SELECT * FROM messages WHERE from_username = ? AND to_username = ? AND id < ?
+    UNION ALL
+    SELECT * FROM messages WHERE from_username = ? AND to_username = ? AND id < ?
+    ORDER BY id DESC LIMIT ?"""
+MESSAGES_SINCE = """
+    SELECT * FROM messages WHERE from_username = ? AND to_username = ? AND id > ?
+    UNION ALL
+    SELECT * FROM messages WHERE from_username = ? AND to_username = ? AND id > ?
+    ORDER BY id"""
+# Ranked over the newest search.MAX_MATCHES matches only, like the in-memory index
+SEARCH = """
+    SELECT {table}.*, -bm25({table}_text, 1.0, 0.0) AS score FROM {table}_text JOIN {table} ON {table}.id = {table}_text.rowid
+    WHERE {table}_text MATCH :match AND {owner} AND {table}_text.rowid >= (
+        SELECT coalesce(min(id), 0) FROM (
+            SELECT {table}.id FROM {table}_text JOIN {table} ON {table}.id = {table}_text.rowid
+            WHERE {table}_text MATCH :match AND {owner} ORDER BY {table}_text.rowid DESC LIMIT :matches))
+    ORDER BY bm25({table}_text, 1.0, 0.0), {table}.id DESC LIMIT :limit OFFSET :offset"""
+SEARCH_COUNT = """
+    SELECT COUNT(*) FROM (
+        SELECT {table}.id FROM {table}_text JOIN {table} ON {table}.id = {table}_text.rowid
+        WHERE {table}_text MATCH :match AND {owner} ORDER BY {table}_text.rowid DESC LIMIT :matches)"""
+# Rows a user may see, checked on the base table: usernames are only words in the text index
+SEARCH_OWNERS = {
+    "messages": "(messages.from_username = :user OR messages.to_username = :user)",
+    "feedback": "feedback.from_username = :user",
+}
+USER_SESSIONS = """
+    SELECT * FROM sessions WHERE user1 = ?
+    UNION
+    SELECT * FROM sessions WHERE user2 = ?
+    ORDER BY id"""
+USER_SESSIONS_WITH_STATUS = """
+    SELECT * FROM sessions WHERE user1 = ? AND status = ?
+    UNION
+    SELECT * FROM sessions WHERE user2 = ? AND status = ?
+    ORDER BY id"""
+# Sessions are at most MAX_SESSION_MINUTES long, so only those starting that far back can overlap
+SESSION_CONFLICTS = """
+    SELECT starts, ends, session_id FROM session_intervals
+    WHERE username = ? AND starts >= ? AND starts < ? AND ends > ?
+    ORDER BY starts"""
+
+
+def _row(collection, record):
+    """Column values of a record for INSERT/UPDATE, with the extra fields last"""
+    values = [int(record.get(column, False)) if column in BOOLEAN_COLUMNS else record.get(column)
+              for column in COLUMNS[collection]]
+    extra = {k: v for k, v in record.items() if k != "id" and k not in COLUMNS[collection]}
+    values.append(json.dumps(extra) if extra else None)
+    return values
+
+
+def _record(collection, row):
+    record = {"id": row["id"]}
+    for column in COLUMNS[collection]:
+        record[column] = bool(row[column]) if column in BOOLEAN_COLUMNS else row[column]
+    if row["extra"]:
+        record.update(json.loads(row["extra"]))
+    return record
+
+
+class ConnectionPool:
+    """Up to `size` WAL-mode connections shared by the threads of one process"""
+
+    def __init__(self, path, size=POOL_SIZE):
+        self.path = path
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self):
+        # Autocommit mode; transactions are started explicitly with BEGIN IMMEDIATE
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        with self._slots:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+            try:
+                yield conn
+            finally:
+                self._idle.put(conn)
+
+
+class SQLiteStore:
+    """Drop-in replacement for DataStore that keeps the records in SQLite.
+
+    Accounts and profiles are still held in `data` (the matcher scores every
+    profile anyway) and reloaded when another process changes them; every
+    record query is an indexed lookup.
+    """
+
+    def __init__(self, path=SQLITE_FILE, pool_size=POOL_SIZE):
+        self.path = path
+        self.pool = ConnectionPool(path, pool_size)
+        self.lock = threading.RLock()
+        self._local = threading.local()
+        self.version = 0
+        self.reloads = 0
+        self.events = EventBus()
+        with self.pool.connection() as conn:
+            conn.executescript(SCHEMA)
+            conn.execute("BEGIN IMMEDIATE")
+            if conn.execute("SELECT COUNT(*) FROM meta").fetchone()[0] == 0:
+                seed = default_data()
+                conn.executemany("INSERT INTO accounts VALUES (?, ?)", seed["accounts"].items())
+                conn.executemany("INSERT INTO users VALUES (?, ?)",
+                                 [(u, json.dumps(profile)) for u, profile in seed["users"].items()])
+                conn.execute("INSERT INTO meta VALUES ('users_version', 1)")
+            # Counts record writes so other processes know to tell their event subscribers
+            conn.execute("INSERT OR IGNORE INTO meta VALUES ('records_version', 0)")
+            if conn.execute("SELECT 1 FROM user_stats LIMIT 1").fetchone() is None:
+                # Database from before the dashboard tables existed
+                self._rebuild_stats(conn)
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'text_indexed'").fetchone() is None:
+                # Database from before the word indexes existed
+                _rebuild_text(conn)
+            if (conn.execute("SELECT 1 FROM session_intervals LIMIT 1").fetchone() is None
+                    and conn.execute("SELECT 1 FROM sessions WHERE status = 'scheduled' LIMIT 1").fetchone()):
+                # Database from before the interval table existed
+                _rebuild_intervals(conn)
+            conn.execute("COMMIT")
+        self.reload()
+
+    @contextmanager
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            yield conn
+        else:
+            with self.pool.connection() as conn:
+                yield conn
+
+    def _users_version(self, conn):
+        return conn.execute("SELECT value FROM meta WHERE key = 'users_version'").fetchone()[0]
+
+    def _records_version(self, conn):
+        return conn.execute("SELECT value FROM meta WHERE key = 'records_version'").fetchone()[0]
+
+    def _written(self, conn, publish):
+        """Count a record write and publish it on the event bus once the transaction commits"""
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'records_version'")
+        self.records_version = self._records_version(conn)
+        self._local.published.append(publish)
+
+    @metrics.timed("store_reload_seconds")
+    def reload(self):
+        with self.lock, self._connection() as conn:
+            self.data = {
+                "accounts": dict(conn.execute("SELECT username, password FROM accounts").fetchall()),
+                "users": {u: json.loads(p) for u, p in conn.execute("SELECT username, profile FROM users")},
+            }
+            self.users_version = self._users_version(conn)
+            self.records_version = self._records_version(conn)
+            # Profiles changed since the last reload, in order; lets caches catch up incrementally
+            self.user_changes = []
+            self.reloads += 1
+            self.version += 1
+
+    @metrics.timed("store_refresh_seconds")
+    def refresh(self):
+        """Reload accounts and profiles if another process changed them, and tell the
+        event subscribers when another process wrote records"""
+        with self._connection() as conn:
+            version = self._users_version(conn)
+            records_version = self._records_version(conn)
+        with self.lock:
+            if version != self.users_version:
+                self.reload()
+            if records_version != self.records_version:
+                # Which records changed is not known here
+                self.records_version = records_version
+                self.events.publish_all()
+
+    @contextmanager
+    def transaction(self, *usernames):
+        """Hold the write lock of the database for a read-check-write sequence;
+        `usernames` are accepted for parity with the sharded store"""
+        if getattr(self._local, "conn", None) is not None:
+            yield self
+            return
+        with self.pool.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._local.conn = conn
+            self._local.published = []
+            try:
+                self.refresh()
+                yield self
+            except BaseException:
+                conn.execute("ROLLBACK")
+                self._local.conn = None
+                # Profile changes made in the block are gone from the database too
+                self.reload()
+                raise
+            else:
+                conn.execute("COMMIT")
+                # Subscribers fetch what changed, so they are only told once it is visible
+                for publish in self._local.published:
+                    publish()
+            finally:
+                self._local.conn = None
+
+    def append(self, collection, record, counter=None):
+        """Insert a record; sets its id when a counter is given, like DataStore"""
+        with self.transaction(), self._connection() as conn:
+            cursor = conn.execute(INSERT[collection], _row(collection, record))
+            if counter:
+                record["id"] = cursor.lastrowid
+            if collection == "sessions":
+                _store_interval(conn, dict(record, id=cursor.lastrowid))
+            self._written(conn, functools.partial(self.events.written, collection, dict(record, id=cursor.lastrowid)))
+        self.version += 1
+        return record
+
+    def update(self, collection, record_id, expected=None, **fields):
+        """Change fields of an existing record; with `expected`, only while it still
+        holds those values (returns False otherwise)"""
+        with self.transaction(), self._connection() as conn:
+            row = conn.execute(SELECT_BY_ID[collection], (record_id,)).fetchone()
+            record = _record(collection, row) if row else None
+            if expected and (record is None or any(record.get(key) != value for key, value in expected.items())):
+                return False
+            if record is not None:
+                record.update(fields)
+                conn.execute(UPDATE[collection], _row(collection, record) + [record_id])
+                if collection == "sessions":
+                    _store_interval(conn, record)
+                self._written(conn, functools.partial(self.events.written, collection, record))
+                self.version += 1
+        return True
+
+    def update_user(self, username, **fields):
+        """Change profile fields of a user"""
+        with self.transaction(), self._connection() as conn:
+            with self.lock:
+                profile = self.data["users"].setdefault(username, {})
+                profile.update(fields)
+                conn.execute("INSERT INTO users VALUES (?, ?) ON CONFLICT (username) DO UPDATE SET profile = excluded.profile",
+                             (username, json.dumps(profile)))
+                conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'users_version'")
+                self.users_version = self._users_version(conn)
+                self.user_changes.append(username)
+                self.version += 1
+
+    def mark_read(self, username, buddy_username):
+        """Mark everything a buddy sent so far as read"""
+        with self.transaction(), self._connection() as conn:
+            upto = conn.execute("SELECT MAX(id) FROM messages WHERE to_username = ? AND from_username = ? AND read = 0",
+                                (username, buddy_username)).fetchone()[0]
+            if upto is None:
+                return
+            conn.execute("UPDATE messages SET read = 1 WHERE to_username = ? AND from_username = ? AND read = 0 AND id <= ?",
+                         (username, buddy_username, upto))
+            conn.execute("INSERT INTO read_marks VALUES (?, ?, ?) "
+                         "ON CONFLICT (recipient, sender) DO UPDATE SET upto = max(upto, excluded.upto)",
+                         (username, buddy_username, upto))
+            self._written(conn, functools.partial(self.events.publish, "read", upto, (username, buddy_username)))
+            self.version += 1
+
+    def compact(self):
+        """Fold the write-ahead log back into the database file"""
+        with self._connection() as conn:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def compact_in_background(self):
+        threading.Thread(target=self.compact, name="storage-compaction", daemon=True).start()
+
+    def archive(self, now=None, session_days=archive.SESSION_DAYS, invitation_days=archive.INVITATION_DAYS,
+                message_days=archive.MESSAGE_DAYS, rated=None):
+        """Nothing to move: queries read only the rows they need, so old rows cost
+        disk space but no load time"""
+        return {"sessions": 0, "invitations": 0, "messages": 0}
+
+    # Queries, each served by an index
+
+    def _select(self, collection, sql, params):
+        with self._connection() as conn:
+            return [_record(collection, row) for row in conn.execute(sql, params)]
+
+    def _exists(self, sql, params):
+        with self._connection() as conn:
+            return conn.execute(sql, params).fetchone() is not None
+
+    def get(self, collection, record_id):
+        found = self._select(collection, SELECT_BY_ID[collection], (record_id,))
+        return found[0] if found else None
+
+    def accepted_buddies(self, username):
+        with self._connection() as conn:
+            return list(dict.fromkeys(row["buddy"] for row in conn.execute(ACCEPTED_BUDDIES, (username, username))))
+
+    def invitation_pairs(self):
+        """Every (from_username, to_username) with an invitation in any status"""
+        with self._connection() as conn:
+            return conn.execute("SELECT DISTINCT from_username, to_username FROM invitations").fetchall()
+
+    def received_invitations(self, username):
+        return self._select("invitations", "SELECT * FROM invitations WHERE to_username = ? ORDER BY id", (username,))
+
+    def sent_invitations(self, username):
+        return self._select("invitations", "SELECT * FROM invitations WHERE from_username = ? ORDER BY id", (username,))
+
+    def has_sent_invitation(self, from_username, to_username):
+        return self._exists("SELECT 1 FROM invitations WHERE from_username = ? AND to_username = ? LIMIT 1",
+                            (from_username, to_username))
+
+    def conversation(self, username, buddy_username):
+        """Messages between two users, oldest first"""
+        return self.conversation_page(username, buddy_username, limit=-1)[0]
+
+    @metrics.timed("chat_page_seconds")
+    def conversation_page(self, username, buddy_username, before_id=None, limit=20):
+        """The `limit` newest messages older than `before_id` (or overall), oldest first,
+        and whether there are older ones left"""
+        before_id = before_id if before_id is not None else 1 << 62
+        fetch = limit + 1 if limit >= 0 else -1
+        rows = self._select("messages", CONVERSATION, (username, buddy_username, before_id,
+                                                       buddy_username, username, before_id, fetch))
+        more = limit >= 0 and len(rows) > limit
+        metrics.observe("chat_page_rows", len(rows) - more)
+        return rows[:limit][::-1] if limit >= 0 else rows[::-1], more
+
+    def messages_since(self, username, buddy_username, after_id):
+        """Messages between two users with ids above `after_id`, oldest first"""
+        return self._select("messages", MESSAGES_SINCE, (username, buddy_username, after_id,
+                                                         buddy_username, username, after_id))
+
+    def _search(self, table, column, query, username, offset, limit):
+        match = _match(query, column, username)
+        if match is None:
+            return [], 0
+        owner = "1" if username is None else SEARCH_OWNERS[table]
+        params = {"match": match, "user": username, "matches": search.MAX_MATCHES, "limit": limit, "offset": offset}
+        with self._connection() as conn:
+            rows = conn.execute(SEARCH.format(table=table, owner=owner), params).fetchall()
+            total = conn.execute(SEARCH_COUNT.format(table=table, owner=owner), params).fetchone()[0]
+        return [(_record(table, row), row["score"]) for row in rows], total
+
+    @metrics.timed("search_seconds", collection="messages")
+    def search_messages(self, query, username=None, offset=0, limit=20):
+        """One page of (message, score) holding every word of `query`, best first, and
+        the number of matches; only the user's own conversations when `username` is given"""
+        return self._search("messages", "message", query, username, offset, limit)
+
+    @metrics.timed("search_seconds", collection="feedback")
+    def search_feedback(self, query, username=None, offset=0, limit=20):
+        """One page of (feedback, score) whose comments hold every word of `query`, best first,
+        and the number of matches; only the feedback the user wrote when `username` is given"""
+        return self._search("feedback", "comments", query, username, offset, limit)
+
+    def unread_count(self, username, buddy_username):
+        with self._connection() as conn:
+            return conn.execute("SELECT COUNT(*) FROM messages WHERE to_username = ? AND from_username = ? AND read = 0",
+                                (username, buddy_username)).fetchone()[0]
+
+    def archived(self, collection, username):
+        return []
+
+    def user_sessions(self, username, status=None):
+        if status is None:
+            return self._select("sessions", USER_SESSIONS, (username, username))
+        return self._select("sessions", USER_SESSIONS_WITH_STATUS, (username, status, username, status))
+
+    def user_feedback(self, username):
+        return self._select("feedback", "SELECT * FROM feedback WHERE from_username = ? ORDER BY id", (username,))
+
+    def has_feedback(self, session_id, username):
+        return self._exists("SELECT 1 FROM feedback WHERE session_id = ? AND from_username = ? LIMIT 1",
+                            (session_id, username))
+
+    def feedback_since(self, cursor=0):
+        """Feedback written after `cursor` (0 for all of it), and the cursor to pass next time"""
+        feedback = self._select("feedback", "SELECT * FROM feedback WHERE id > ? ORDER BY id", (cursor,))
+        return feedback, feedback[-1]["id"] if feedback else cursor
+
+    def _busy(self, usernames, start, end):
+        with self._connection() as conn:
+            return [tuple(row) for username in usernames
+                    for row in conn.execute(SESSION_CONFLICTS, (username, start - scheduling.MAX_SESSION_MINUTES,
+                                                                end, start))]
+
+    def session_conflicts(self, usernames, start, end):
+        """Scheduled sessions of any of `usernames` overlapping [start, end), in minutes since the epoch"""
+        ids = dict.fromkeys(item[2] for item in self._busy(usernames, start, end))
+        return [self.get("sessions", session_id) for session_id in ids]
+
+    def free_slots(self, username, buddy_username, duration, after, count=5):
+        """The next `count` start times when both users are available and free for `duration` minutes"""
+        users = self.data["users"]
+        return scheduling.free_slots(users[username], users[buddy_username],
+                                     lambda start, end: self._busy((username, buddy_username), start, end),
+                                     duration, after, count)
+
+    def dashboard_stats(self, username):
+        """Materialized dashboard counters and averages of a user"""
+        stats = UserStats()
+        with self._connection() as conn:
+            row = conn.execute("SELECT * FROM user_stats WHERE username = ?", (username,)).fetchone()
+            if row:
+                for field in row.keys()[1:]:
+                    setattr(stats, field, row[field])
+            stats.buddy_sessions = dict(conn.execute(
+                "SELECT buddy, completed FROM buddy_sessions WHERE username = ? AND completed != 0", (username,)))
+        return stats.as_dict()
+
+    def _rebuild_stats(self, conn):
+        for statement in REBUILD_STATS.split(";"):
+            if statement.strip():
+                conn.execute(statement)
+
+    def rebuild_stats(self):
+        """Recompute the dashboard tables from the records; returns how many users' stats were off"""
+        with self.transaction(), self._connection() as conn:
+            users = [u for (u,) in conn.execute("SELECT username FROM user_stats")]
+            before = {u: self.dashboard_stats(u) for u in users}
+            self._rebuild_stats(conn)
+            users = set(users) | {u for (u,) in conn.execute("SELECT username FROM user_stats")}
+            return sum(1 for u in users if before.get(u, UserStats().as_dict()) != self.dashboard_stats(u))
+
+
+def _store_interval(conn, session):
+    """Replace the interval rows of a session; only scheduled sessions have any"""
+    conn.execute("DELETE FROM session_intervals WHERE session_id = ?", (session["id"],))
+    interval = scheduling.session_interval(session) if session["status"] == "scheduled" else None
+    if interval is not None:
+        conn.executemany("INSERT INTO session_intervals VALUES (?, ?, ?, ?)",
+                         [(username, *interval, session["id"]) for username in {session["user1"], session["user2"]}])
+
+
+def _rebuild_text(conn):
+    for table in ("messages_text", "feedback_text"):
+        conn.execute(f"INSERT INTO {table} ({table}) VALUES ('delete-all')")
+    conn.execute("INSERT INTO messages_text (rowid, message, users) "
+                 "SELECT id, message, from_username || ' ' || to_username FROM messages")
+    conn.execute("INSERT INTO feedback_text (rowid, comments, users) SELECT id, comments, from_username FROM feedback")
+    conn.execute("INSERT OR REPLACE INTO meta VALUES ('text_indexed', 1)")
+
+
+def _match(query, column, username):
+    """FTS5 query for rows whose `column` holds every word of `query`, narrowed to rows
+    whose users hold the words of `username` if given (the caller checks the exact user)"""
+    terms = [f'{column}:"{word}"' for word in dict.fromkeys(search.tokenize(query))]
+    if not terms:
+        return None
+    # A username without letters or digits has no words in the index
+    if username is not None and any(ch.isalnum() for ch in username):
+        terms.append('users:"{}"'.format(username.replace('"', '""')))
+    return " AND ".join(terms)
+
+
+def _rebuild_intervals(conn):
+    conn.execute("DELETE FROM session_intervals")
+    for row in conn.execute("SELECT * FROM sessions WHERE status = 'scheduled'").fetchall():
+        _store_interval(conn, _record("sessions", row))
+
+
+def migrate(pickle_path=STORAGE_FILE, db_path=SQLITE_FILE):
+    """One-shot copy of the pickle data (snapshot plus unfolded log) into a new database;
+    returns the number of rows copied per table"""
+    if os.path.exists(db_path):
+        raise StorageError(f"{db_path} already exists; migrate into a new file")
+    data = archive.restore(load_persistent_data(pickle_path), pickle_path)
+    marks = data.get("read_marks", {})
+    for msg in data.get("messages", []):
+        # The log only records read marks; message flags catch up here as they do in DataIndex
+        if msg["id"] <= marks.get((msg["to_username"], msg["from_username"]), 0):
+            msg["read"] = True
+    counts = {}
+    with ConnectionPool(db_path, 1).connection() as conn:
+        conn.executescript(SCHEMA)
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany("INSERT INTO accounts VALUES (?, ?)", data["accounts"].items())
+        conn.executemany("INSERT INTO users VALUES (?, ?)",
+                         [(u, json.dumps(dict(profile.items()))) for u, profile in data["users"].items()])
+        conn.execute("INSERT INTO meta VALUES ('users_version', 1)")
+        counts["accounts"], counts["users"] = len(data["accounts"]), len(data["users"])
+        for collection in COLUMNS:
+            records = data.get(collection, [])
+            conn.executemany(INSERT_WITH_ID[collection], [[r.get("id")] + _row(collection, r) for r in records])
+            counts[collection] = len(records)
+        conn.executemany("INSERT INTO read_marks VALUES (?, ?, ?)",
+                         [(recipient, sender, upto) for (recipient, sender), upto in data.get("read_marks", {}).items()])
+        _rebuild_intervals(conn)
+        # The insert triggers filled the word indexes
+        conn.execute("INSERT INTO meta VALUES ('text_indexed', 1)")
+        for collection in ("invitations", "messages", "sessions"):
+            # New ids continue after the pickle counters even if the last records were removed
+            counter = data.get(collection.rstrip("s") + "_counter", 0)
+            if not conn.execute("UPDATE sqlite_sequence SET seq = max(seq, ?) WHERE name = ?",
+                                (counter, collection)).rowcount and counter:
+                conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (collection, counter))
+        conn.execute("COMMIT")
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Copy the pickle data into a new SQLite database")
+    parser.add_argument("--from", dest="source", default=STORAGE_FILE)
+    parser.add_argument("--to", dest="target", default=SQLITE_FILE)
+    args = parser.parse_args()
+
+    print(json.dumps(migrate(args.source, args.target), indent=2))
@@ -0,0 +1,624 @@
+import bisect
+import glob
+import json
+import os
+import pickle
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+import archive
+import dashboard_stats
+import metrics
+import scheduling
+import search
+from events import EventBus
+from indexes import DataIndex, pair_key
+from records import Profile, compact_data, make_record
+
+STORAGE_FILE = "study_buddy_data.pkl"
+
+# A log segment is sealed and folded into the snapshot once it grows past this size
+COMPACT_BYTES = 256 * 1024
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class StorageError(Exception):
+    """The data files exist but cannot be read"""
+
+
+def default_data():
+    return {
+        "accounts": {
+            "admin": "password123",
+            "alice": "alice123",
+            "bob": "bob123",
+            "carol": "carol123",
+            "david": "david123",
+            "emma": "emma123"
+        },
+        "users": {
+            "alice": {"name": "Alice Chen", "subjects": ["Math", "Physics"], "interests": ["Technology", "Reading"], "study_style": "Visual", "availability": ["Morning", "Evening"]},
+            "bob": {"name": "Bob Martinez", "subjects": ["Computer Science", "Math"], "interests": ["Gaming", "Technology"], "study_style": "Kinesthetic", "availability": ["Afternoon", "Evening"]},
+            "carol": {"name": "Carol Johnson", "subjects": ["Biology", "Chemistry"], "interests": ["Sports", "Music"], "study_style": "Auditory", "availability": ["Morning", "Weekend"]},
+            "david": {"name": "David Kim", "subjects": ["Physics", "Math"], "interests": ["Technology", "Movies"], "study_style": "Visual", "availability": ["Evening", "Weekend"]},
+            "emma": {"name": "Emma Wilson", "subjects": ["Literature", "History"], "interests": ["Reading", "Art"], "study_style": "Reading/Writing", "availability": ["Morning", "Afternoon"]}
+        },
+        "invitations": [],
+        "invitation_counter": 0,
+        "messages": [],
+        "message_counter": 0,
+        "sessions": [],
+        "session_counter": 0,
+        "feedback": []
+    }
+
+
+def log_segments(path=STORAGE_FILE):
+    """List (generation, file) for every log segment next to the snapshot, oldest first"""
+    segments = []
+    for name in glob.glob(glob.escape(path) + ".log.*"):
+        suffix = name.rsplit(".", 1)[1]
+        if suffix.isdigit():
+            segments.append((int(suffix), name))
+    return sorted(segments)
+
+
+def segment_path(path, generation):
+    return f"{path}.log.{generation}"
+
+
+@metrics.timed("snapshot_load_seconds")
+def load_snapshot(path=STORAGE_FILE):
+    """Snapshot data with compact records; the seed data if there is no snapshot yet"""
+    if not os.path.exists(path):
+        return compact_data(default_data())
+    try:
+        with open(path, 'rb') as f:
+            metrics.observe("snapshot_bytes", os.fstat(f.fileno()).st_size, op="load")
+            return compact_data(pickle.load(f))
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError) as e:
+        # Falling back to the seed data here would let the next compaction overwrite the real data
+        raise StorageError(f"Cannot read {path}: {e}") from e
+
+
+@contextmanager
+def file_lock(lock_path, blocking=True):
+    """Exclusive lock on `lock_path` shared by all processes; yields whether it
+    was acquired (always True when blocking)"""
+    with open(lock_path, 'a+b') as f:
+        acquired = False
+        while not acquired:
+            try:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                acquired = True
+            except OSError:
+                if not blocking:
+                    break
+                time.sleep(0.01)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def apply_entry(data, entry, lookup=None):
+    """Apply one log record to the in-memory data"""
+    if entry["op"] == "set_user":
+        data["users"].setdefault(entry["username"], Profile()).update(entry["fields"])
+        return
+    if entry["op"] == "mark_read":
+        # Message flags are brought in line with the read mark when the index is built
+        marks = data.setdefault("read_marks", {})
+        key = (entry["username"], entry["buddy"])
+        marks[key] = max(marks.get(key, 0), entry["upto"])
+        return
+
+    collection = entry["collection"]
+    records = data.setdefault(collection, [])
+
+    if entry["op"] == "append":
+        record = make_record(collection, entry["record"])
+        records.append(record)
+        counter = entry.get("counter")
+        if counter:
+            data[counter] = max(data.get(counter, 0), record["id"])
+        if lookup is not None and collection in lookup:
+            lookup[collection][record["id"]] = record
+
+    elif entry["op"] == "update":
+        if collection == "messages":
+            row = records.find(entry["id"])
+            target = None if row is None else records[row]
+        elif lookup is None:
+            target = next((r for r in records if r.get("id") == entry["id"]), None)
+        else:
+            if collection not in lookup:
+                lookup[collection] = {r["id"]: r for r in records if "id" in r}
+            target = lookup[collection].get(entry["id"])
+        if target is not None:
+            target.update(entry["fields"])
+
+
+def replay_segment(data, segment_file, lookup=None):
+    with open(segment_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            # A torn last line from a crash mid-write is skipped
+            if not line.endswith("\n"):
+                break
+            apply_entry(data, json.loads(line), lookup)
+
+
+def load_persistent_data(path=STORAGE_FILE):
+    data = load_snapshot(path)
+    folded = data.get("log_generation", 0)
+    lookup = {}
+    for generation, segment_file in log_segments(path):
+        if generation > folded:
+            replay_segment(data, segment_file, lookup)
+    return data
+
+
+@metrics.timed("snapshot_save_seconds")
+def save_persistent_data(data, path=STORAGE_FILE):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+        metrics.observe("snapshot_bytes", f.tell(), op="save")
+    os.replace(tmp_path, path)
+
+
+def next_id(last, stride=1, offset=0):
+    """Smallest id above `last` that is `offset` modulo `stride`"""
+    return last + 1 + (offset - last - 1) % stride
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def get_store(path=STORAGE_FILE):
+    """Return the process-wide store for a data file, creating it on first use;
+    a .db file selects the SQLite backend and a .shards directory the sharded one"""
+    with _stores_lock:
+        if path not in _stores:
+            if path.endswith((".db", ".sqlite")):
+                from sqlite_storage import SQLiteStore
+                _stores[path] = SQLiteStore(path)
+            elif path.endswith(".shards"):
+                from sharding import ShardedStore
+                _stores[path] = ShardedStore(path)
+            else:
+                _stores[path] = DataStore(path)
+        return _stores[path]
+
+
+def compact_storage(path=STORAGE_FILE):
+    """Fold every log segment written so far into a fresh snapshot"""
+    get_store(path).compact()
+
+
+class DataStore:
+    """In-memory copy of the data shared by every session of the server process.
+
+    Reads come straight from `data`. `refresh()` is cheap when nothing changed:
+    it only replays log lines appended since the last call, and reloads
+    everything only if another process rewrote the snapshot.
+
+    New ids are the ones that are `id_offset` modulo `id_stride`, so the
+    shards of a sharded store never hand out the same id. Every applied
+    invitation, message, session and read mark is published on `events`.
+    """
+
+    def __init__(self, path=STORAGE_FILE, compact_bytes=COMPACT_BYTES, id_stride=1, id_offset=0, events=None):
+        self.path = path
+        self.compact_bytes = compact_bytes
+        self.id_stride = id_stride
+        self.id_offset = id_offset
+        self.events = events if events is not None else EventBus()
+        self.lock = threading.RLock()
+        self.lock_path = path + ".lock"
+        self._transactions = 0
+        self.version = 0
+        self._compacting = False
+        self._search = None
+        self.reload()
+
+    @metrics.timed("store_reload_seconds")
+    def reload(self):
+        with self.lock:
+            self._snapshot_mtime = _mtime(self.path)
+            self.data = load_snapshot(self.path)
+            self.index = DataIndex(self.data)
+            # Rebuilt on the next search; most processes never search
+            self._search = None
+            # Profiles changed since the last reload, in order; lets caches catch up incrementally
+            self.user_changes = []
+            self.reloads = getattr(self, "reloads", 0) + 1
+            self._generation = self.data.get("log_generation", 0) + 1
+            self._offset = 0
+            self._catch_up()
+            self.version += 1
+        self.events.publish_all()
+
+    @metrics.timed("store_refresh_seconds")
+    def refresh(self):
+        """Bring the in-memory data up to date with the files on disk"""
+        with self.lock:
+            if _mtime(self.path) != self._snapshot_mtime:
+                self.reload()
+            else:
+                try:
+                    self._catch_up()
+                except FileNotFoundError:
+                    # Another process compacted the segment away while we read it
+                    self.reload()
+
+    def _catch_up(self):
+        while True:
+            segment_file = segment_path(self.path, self._generation)
+            size = os.path.getsize(segment_file) if os.path.exists(segment_file) else 0
+            if size > self._offset:
+                self._read_segment(segment_file, size)
+            if not os.path.exists(segment_path(self.path, self._generation + 1)):
+                break
+            self._generation += 1
+            self._offset = 0
+
+    def _read_segment(self, segment_file, end):
+        with open(segment_file, 'rb') as f:
+            f.seek(self._offset)
+            chunk = f.read(end - self._offset)
+        # A line still being written by another process is picked up next time
+        complete = chunk[:chunk.rfind(b"\n") + 1]
+        metrics.observe("log_read_bytes", len(complete))
+        for line in complete.splitlines():
+            self._apply(json.loads(line))
+        self._offset += len(complete)
+        if complete:
+            self.version += 1
+
+    @contextmanager
+    def transaction(self, *usernames):
+        """Hold the store for a read-check-write sequence: no other thread or
+        process writes between the refresh at the start and the end of the block.
+
+        `usernames` name the users the block touches; only a sharded store uses them.
+        """
+        with self.lock:
+            outermost = self._transactions == 0
+            self._transactions += 1
+            try:
+                with file_lock(self.lock_path) if outermost else nullcontext():
+                    self.refresh()
+                    yield self
+            finally:
+                self._transactions -= 1
+
+    def _write(self, entry):
+        """Append one record to the current segment; only called inside a transaction"""
+        line = (json.dumps(entry, separators=(",", ":")) + "\n").encode("utf-8")
+        metrics.observe("log_write_bytes", len(line), op=entry["op"])
+        segment_file = segment_path(self.path, self._generation)
+        with open(segment_file, 'ab') as f:
+            if f.tell() > self._offset:
+                # Torn line left by a writer that crashed mid-write; drop it so ours starts on a fresh line
+                f.truncate(self._offset)
+            f.write(line)
+            f.flush()
+            end = f.tell()
+        self._offset = end
+        self._apply(entry)
+        self.version += 1
+
+        if end >= self.compact_bytes:
+            self.compact_in_background()
+
+    def _apply(self, entry):
+        if entry["op"] == "set_user":
+            self.data["users"].setdefault(entry["username"], Profile()).update(entry["fields"])
+            self.user_changes.append(entry["username"])
+            return
+        if entry["op"] == "mark_read":
+            self.index.mark_read(entry["username"], entry["buddy"], entry["upto"])
+            self.events.publish("read", entry["upto"], (entry["username"], entry["buddy"]))
+            return
+
+        collection = entry["collection"]
+        if entry["op"] == "append":
+            record = make_record(collection, entry["record"])
+            counter = entry.get("counter")
+            if counter:
+                self.data[counter] = max(self.data.get(counter, 0), record["id"])
+            if collection == "messages":
+                self.index.message_added(self.data["messages"].append(record))
+            else:
+                self.data.setdefault(collection, []).append(record)
+                self.index.added(collection, record)
+            if self._search is not None:
+                self._search.added(collection, record)
+            self.events.written(collection, record)
+
+        elif entry["op"] == "update" and collection == "messages":
+            row = self.data["messages"].find(entry["id"])
+            if row is None:
+                return
+            message = self.data["messages"][row]
+            old_fields = {key: message.get(key) for key in entry["fields"]}
+            message.update(entry["fields"])
+            self.index.message_updated(row, old_fields)
+            self.events.written(collection, message)
+
+        elif entry["op"] == "update":
+            record = self.index.get(collection, entry["id"])
+            if record is None:
+                return
+            old_fields = {key: record.get(key) for key in entry["fields"]}
+            record.update(entry["fields"])
+            self.index.updated(collection, record, old_fields)
+            self.events.written(collection, record)
+
+    def append(self, collection, record, counter=None):
+        """Add a record and write it to the log; assigns the next id when a counter is given"""
+        with self.transaction():
+            if counter:
+                record["id"] = next_id(self.data.get(counter, 0), self.id_stride, self.id_offset)
+            self._write({"op": "append", "collection": collection, "record": record, "counter": counter})
+        return record
+
+    def update(self, collection, record_id, expected=None, **fields):
+        """Change fields of an existing record and write only the change to the log.
+
+        Changes to different fields of the same record merge. With `expected`,
+        the change is only made while the record still holds those values;
+        returns False when another writer changed them first.
+        """
+        with self.transaction():
+            if expected:
+                record = self.index.get(collection, record_id)
+                if record is None or any(record.get(key) != value for key, value in expected.items()):
+                    return False
+            self._write({"op": "update", "collection": collection, "id": record_id, "fields": fields})
+        return True
+
+    def update_user(self, username, **fields):
+        """Change profile fields of a user"""
+        with self.transaction():
+            self._write({"op": "set_user", "username": username, "fields": fields})
+
+    def mark_read(self, username, buddy_username):
+        """Mark everything a buddy sent so far as read with one small log record"""
+        with self.transaction():
+            pending = self.index.unread.get((username, buddy_username))
+            if pending:
+                self._write({"op": "mark_read", "username": username, "buddy": buddy_username,
+                             "upto": self.data["messages"].message_id(pending[-1])})
+
+    def compact(self):
+        # One compaction at a time across processes; a busy lock means one is already running
+        with file_lock(self.path + ".compact.lock", blocking=False) as acquired:
+            if acquired:
+                self._compact()
+
+    def _compact(self):
+        with self.transaction():
+            sealed = self._generation
+            if not os.path.exists(segment_path(self.path, sealed)):
+                return
+            # New writes go to the next segment while the sealed ones are folded in
+            open(segment_path(self.path, sealed + 1), 'a').close()
+            self._generation, self._offset = sealed + 1, 0
+
+        segments = [(g, f) for g, f in log_segments(self.path) if g <= sealed]
+        data = load_snapshot(self.path)
+        folded = data.get("log_generation", 0)
+        lookup = {}
+        for generation, segment_file in segments:
+            if generation > folded:
+                replay_segment(data, segment_file, lookup)
+        data["log_generation"] = sealed
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        with self.transaction():
+            os.replace(tmp_path, self.path)
+            self._snapshot_mtime = _mtime(self.path)
+            for generation, segment_file in segments:
+                os.remove(segment_file)
+
+    def archive(self, now=None, session_days=archive.SESSION_DAYS, invitation_days=archive.INVITATION_DAYS,
+                message_days=archive.MESSAGE_DAYS, rated=None):
+        """Move the records past their retention into the archive files and fold the whole
+        log into a snapshot without them; returns how many records of each collection moved"""
+        with file_lock(self.path + ".compact.lock"):
+            # Writers wait until the smaller snapshot is in place
+            with self.transaction():
+                segments = log_segments(self.path)
+                data = load_persistent_data(self.path)
+                moved = archive.split_off(data, self.path, now, session_days, invitation_days, message_days, rated)
+                data["log_generation"] = max([data.get("log_generation", 0)] + [g for g, _ in segments])
+                save_persistent_data(compact_data(data), self.path)
+                for generation, segment_file in segments:
+                    os.remove(segment_file)
+                self.reload()
+        return moved
+
+    def compact_in_background(self):
+        with self.lock:
+            if self._compacting:
+                return
+            self._compacting = True
+
+        def run():
+            try:
+                self.compact()
+            finally:
+                with self.lock:
+                    self._compacting = False
+
+        threading.Thread(target=run, name="storage-compaction", daemon=True).start()
+
+    # Queries served from the indexes
+
+    def get(self, collection, record_id):
+        return self.index.get(collection, record_id)
+
+    def accepted_buddies(self, username):
+        return list(self.index.buddies.get(username, {}))
+
+    def received_invitations(self, username):
+        return list(self.index.invitations_to.get(username, []))
+
+    def sent_invitations(self, username):
+        return list(self.index.invitations_from.get(username, []))
+
+    def has_sent_invitation(self, from_username, to_username):
+        pair = (from_username, to_username)
+        return bool(self.index.invitations_between.get(pair)) or pair in self.data.get("archived_pairs", ())
+
+    def invitation_pairs(self):
+        """Every (from_username, to_username) with an invitation in any status, archived ones included"""
+        pairs = {pair for pair, invitations in self.index.invitations_between.items() if invitations}
+        return list(pairs | self.data.get("archived_pairs", set()))
+
+    def conversation(self, username, buddy_username):
+        """Messages between two users, oldest first"""
+        messages = self.data["messages"]
+        return [messages[row] for row in self.index.messages_between.get(pair_key(username, buddy_username), ())]
+
+    @metrics.timed("chat_page_seconds")
+    def conversation_page(self, username, buddy_username, before_id=None, limit=20):
+        """The `limit` newest messages older than `before_id` (or overall), oldest first,
+        and whether there are older ones left"""
+        messages = self.data["messages"]
+        rows = self.index.messages_between.get(pair_key(username, buddy_username), ())
+        end = len(rows) if before_id is None else bisect.bisect_left(rows, before_id, key=messages.message_id)
+        start = max(0, end - limit)
+        metrics.observe("chat_page_rows", end - start)
+        page = [messages[row] for row in rows[start:end]]
+        if start > 0:
+            return page, True
+        # Past the oldest hot message; the archive is only read when the page needs more
+        if len(page) < limit:
+            older, more = archive.archived_messages(self.path, self.data, username, buddy_username, before_id,
+                                                    limit - len(page))
+            return older + page, more
+        return page, archive.has_archived_messages(self.data, username, buddy_username)
+
+    def messages_since(self, username, buddy_username, after_id):
+        """Messages between two users with ids above `after_id`, oldest first"""
+        messages = self.data["messages"]
+        rows = self.index.messages_between.get(pair_key(username, buddy_username), ())
+        start = bisect.bisect_right(rows, after_id, key=messages.message_id)
+        return [messages[row] for row in rows[start:]]
+
+    def _search_index(self):
+        with self.lock:
+            if self._search is None:
+                self._search = search.SearchIndex(self.data)
+            return self._search
+
+    def search_statistics(self, collection, query):
+        """Corpus statistics of the "messages" or "feedback" text index for the words of `query`"""
+        return getattr(self._search_index(), collection).statistics(query)
+
+    @metrics.timed("search_seconds", collection="messages")
+    def search_messages(self, query, username=None, offset=0, limit=20, corpus=None):
+        """One page of (message, score) holding every word of `query`, best first, and
+        the number of matches; only the user's own conversations when `username` is given.
+        `corpus` ranks against statistics of a larger corpus (see `search_statistics`)."""
+        messages = self.data["messages"]
+        scope = None
+        if username is not None:
+            scope = sorted(messages.message_id(row) for buddy in self.index.conversations.get(username, ())
+                           for row in self.index.messages_between[pair_key(username, buddy)])
+        hits, total = self._search_index().messages.search(
+            query, lambda message_id: messages[messages.find(message_id)]["message"], scope, offset, limit, corpus)
+        return [(messages[messages.find(message_id)], score) for message_id, score in hits], total
+
+    @metrics.timed("search_seconds", collection="feedback")
+    def search_feedback(self, query, username=None, offset=0, limit=20, corpus=None):
+        """One page of (feedback, score) whose comments hold every word of `query`, best first,
+        and the number of matches; only the feedback the user wrote when `username` is given"""
+        feedback = self.data["feedback"]
+        index = self._search_index()
+        scope = None if username is None else index.feedback_by.get(username, ())
+        hits, total = index.feedback.search(query, lambda position: feedback[position].get("comments"), scope, offset, limit,
+                                            corpus)
+        return [(feedback[position], score) for position, score in hits], total
+
+    def unread_count(self, username, buddy_username):
+        return len(self.index.unread.get((username, buddy_username), ()))
+
+    def archived(self, collection, username):
+        """A user's sessions or invitations moved to the archive, newest first; read from
+        the archive files on each call"""
+        return archive.archived_records(self.path, self.data, collection, username)
+
+    def user_sessions(self, username, status=None):
+        return [s for s in self.index.sessions_of.get(username, [])
+                if status is None or s["status"] == status]
+
+    def user_feedback(self, username):
+        return list(self.index.feedback_from.get(username, []))
+
+    def has_feedback(self, session_id, username):
+        return (session_id, username) in self.index.feedback_for_session
+
+    def feedback_since(self, cursor=0):
+        """Feedback written after `cursor` (0 for all of it), and the cursor to pass next time"""
+        feedback = self.data.get("feedback", [])
+        return feedback[cursor:], len(feedback)
+
+    def session_conflicts(self, usernames, start, end):
+        """Scheduled sessions of any of `usernames` overlapping [start, end), in minutes since the epoch"""
+        ids = dict.fromkeys(item[2] for username in usernames
+                            for item in self.index.schedule.conflicts(username, start, end))
+        return [self.index.get("sessions", session_id) for session_id in ids]
+
+    def free_slots(self, username, buddy_username, duration, after, count=5):
+        """The next `count` start times when both users are available and free for `duration` minutes"""
+        users = self.data["users"]
+        schedule = self.index.schedule
+        return scheduling.free_slots(
+            users[username], users[buddy_username],
+            lambda start, end: schedule.conflicts(username, start, end) + schedule.conflicts(buddy_username, start, end),
+            duration, after, count)
+
+    def dashboard_stats(self, username):
+        """Materialized dashboard counters and averages of a user"""
+        return self.index.stats.for_user(username)
+
+    def rebuild_stats(self):
+        """Recompute the dashboard aggregates from the records; returns how many users' stats were off"""
+        with self.lock:
+            self.refresh()
+            fresh = dashboard_stats.rebuild(self.data)
+            users = set(fresh.users) | set(self.index.stats.users)
+            changed = sum(1 for u in users if fresh.for_user(u) != self.index.stats.for_user(u))
+            self.index.stats = fresh
+        return changed
@@ -0,0 +1,47 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    # Match caches and weight files are looked up relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def cohort(tmp_path):
+    """Path of a snapshot with 150 synthetic students and their invitations, messages,
+    sessions and feedback"""
+    path = str(tmp_path / "study_buddy_data.pkl")
+    benchmark.generate(150, path, seed=7)
+    return path
+
+
+def _user_view(store, username):
+    # Ids are left out: the sharded migration renumbers records
+    buddies = sorted(store.accepted_buddies(username))
+    return {
+        "buddies": buddies,
+        "received": sorted((i["from_username"], i["status"], i["match_score"]) for i in store.received_invitations(username)),
+        "sent": sorted((i["to_username"], i["status"], i["match_score"]) for i in store.sent_invitations(username)),
+        "sessions": sorted((s["user1"], s["user2"], s["date"], s["time"], s["status"])
+                           for s in store.user_sessions(username)),
+        "feedback": sorted((f["partner_username"], f["rating"], f["productivity"], f["comments"])
+                           for f in store.user_feedback(username)),
+        "stats": store.dashboard_stats(username),
+        "chats": {buddy: ([m["message"] for m in store.conversation(username, buddy)],
+                          store.unread_count(username, buddy)) for buddy in buddies},
+    }
+
+
+@pytest.fixture
+def user_view():
+    """Everything the views show a user from a store, comparable across backends"""
+    return _user_view
@@ -0,0 +1,75 @@
+from datetime import datetime
+
+import archive
+from storage import DataStore, load_persistent_data
+
+# Far enough ahead that every record past its retention leaves the hot data
+LATER = datetime(2030, 1, 1)
+
+
+def whole_conversation(store, username, buddy_username):
+    """Every message of a conversation, paging back the way the chat view does"""
+    messages, more = store.conversation_page(username, buddy_username, limit=7)
+    while more:
+        page, more = store.conversation_page(username, buddy_username, before_id=messages[0]["id"], limit=7)
+        messages = page + messages
+    return [(m["id"], m["message"]) for m in messages]
+
+
+def session(store, user1, user2, status):
+    return store.append("sessions", {"user1": user1, "user2": user2, "date": "2026-01-05", "time": "10:00",
+                                     "duration": "1 hour", "location": "Library", "subject": "Math", "notes": "",
+                                     "status": status, "created_at": "2026-01-01 10:00:00"},
+                        counter="session_counter")
+
+
+def rate(store, session, username, partner):
+    store.append("feedback", {"session_id": session["id"], "from_username": username, "partner_username": partner,
+                              "rating": 4, "productivity": 4, "would_study_again": "Yes", "comments": "",
+                              "timestamp": "2026-01-06 10:00:00"})
+
+
+def test_archiving_keeps_what_users_see(cohort):
+    store = DataStore(cohort)
+    users = sorted(store.data["users"])
+    before = {u: (store.dashboard_stats(u), sorted(s["id"] for s in store.user_sessions(u)),
+                  {b: whole_conversation(store, u, b) for b in store.accepted_buddies(u)}) for u in users}
+
+    moved = store.archive(now=LATER)
+    assert moved["sessions"] and moved["messages"]
+
+    for fresh in (False, True):
+        if fresh:
+            store = DataStore(cohort)
+        for u in users:
+            stats, sessions, chats = before[u]
+            assert store.dashboard_stats(u) == stats
+            assert sorted(s["id"] for s in store.user_sessions(u) + store.archived("sessions", u)) == sessions
+            assert {b: whole_conversation(store, u, b) for b in store.accepted_buddies(u)} == chats
+
+
+def test_restore_brings_every_record_back(cohort):
+    original = load_persistent_data(cohort)
+    DataStore(cohort).archive(now=LATER)
+
+    archived = load_persistent_data(cohort)
+    assert len(archived["messages"]) < len(original["messages"])
+    restored = archive.restore(archived, cohort)
+    for collection in ("sessions", "invitations", "messages"):
+        assert [r["id"] for r in restored[collection]] == [r["id"] for r in original[collection]], collection
+    assert "archive_months" not in restored
+
+
+def test_completed_sessions_wait_for_both_ratings(tmp_path):
+    store = DataStore(str(tmp_path / "data.pkl"))
+    unrated = session(store, "alice", "bob", "completed")
+    half_rated = session(store, "alice", "bob", "completed")
+    rated = session(store, "alice", "bob", "completed")
+    cancelled = session(store, "alice", "bob", "cancelled")
+    rate(store, half_rated, "alice", "bob")
+    rate(store, rated, "alice", "bob")
+    rate(store, rated, "bob", "alice")
+
+    assert store.archive(now=LATER)["sessions"] == 2
+    assert sorted(s["id"] for s in store.user_sessions("alice")) == [unrated["id"], half_rated["id"]]
+    assert sorted(s["id"] for s in store.archived("sessions", "alice")) == [rated["id"], cancelled["id"]]
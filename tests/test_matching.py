@@ -0,0 +1,118 @@
+import pytest
+
+import matching
+from matching import CandidateIndex, MatchCache, MatchEngine, calculate_match_score
+from storage import DataStore
+
+
+def brute_force(users, username, k):
+    """Scores of the best k partners by scoring every pair, best first"""
+    scores = [calculate_match_score(users[username], users[other]) for other in users if other != username]
+    return sorted(scores, reverse=True)[:k]
+
+
+def assert_exact(users, username, matches, k):
+    # Equal scores may come in either order, so the scores are compared as a ranking
+    # and each partner is checked to really score what it was listed with
+    assert [score for _, score in matches] == pytest.approx(brute_force(users, username, k))
+    assert len({other for other, _ in matches}) == len(matches)
+    for other, score in matches:
+        assert other != username
+        assert score == pytest.approx(calculate_match_score(users[username], users[other]))
+
+
+def change_profiles(store, usernames):
+    for i, username in enumerate(usernames):
+        store.update_user(username, subjects=[["Law"], ["Math", "Physics"], []][i % 3],
+                          interests=["Chess"] if i % 2 else ["Music", "Dance"],
+                          study_style="Visual" if i % 2 else "Auditory")
+
+
+@pytest.fixture
+def users(cohort):
+    return DataStore(cohort).data["users"]
+
+
+def test_engine_matches_brute_force(users):
+    engine = MatchEngine(users)
+    for username in list(users)[::7]:
+        for k in (1, 5, 20):
+            assert_exact(users, username, engine.top_matches(username, k), k)
+
+
+def test_engine_follows_profile_changes(users):
+    engine = MatchEngine(users)
+    username = "student0000003"
+    users[username] = dict(users[username].items(), subjects=["Law"], interests=["Chess"])
+    engine.update_user(username, users[username])
+    for other in (username, "alice", "student0000010"):
+        assert_exact(users, other, engine.top_matches(other, 5), 5)
+
+
+def test_cache_stays_exact_through_profile_changes(cohort, tmp_path):
+    store = DataStore(cohort)
+    users = store.data["users"]
+    cache = MatchCache(str(tmp_path / "match_cache.pkl"), k=5)
+    cache.sync_store(store)
+    for username in users:
+        cache.top_matches(username)
+
+    change_profiles(store, sorted(users)[:12])
+    cache.sync_store(store)
+
+    assert cache.stats()["dirty_users"] < len(users)
+    for username in users:
+        assert_exact(users, username, cache.top_matches(username), 5)
+
+
+def test_saved_cache_catches_up_with_changes_made_while_closed(cohort, tmp_path):
+    store = DataStore(cohort)
+    users = store.data["users"]
+    cache = MatchCache(str(tmp_path / "match_cache.pkl"), k=5)
+    cache.sync_store(store)
+    for username in users:
+        cache.top_matches(username)
+    cache.save()
+
+    change_profiles(store, sorted(users)[-5:])
+    reopened = MatchCache(str(tmp_path / "match_cache.pkl"), k=5)
+    reopened.sync_store(store)
+
+    for username in users:
+        assert_exact(users, username, reopened.top_matches(username), 5)
+    assert reopened.stats()["hits"] > 0
+
+
+def test_candidate_index_matches_brute_force(users):
+    index = CandidateIndex(users)
+    for username in users:
+        assert_exact(users, username, index.top_matches(username, 5), 5)
+        assert_exact(users, username, index.top_matches(username, 5, prune=False), 5)
+
+
+@pytest.mark.parametrize("weights", [
+    {"subjects": 0.1, "availability": 0.1, "interests": 2.0, "style_match": 0.0, "style_mismatch": 0.5},
+    {"subjects": 0.0, "availability": 0.0, "interests": 0.0, "style_match": 1.0, "style_mismatch": 0.0},
+])
+def test_candidate_index_bounds_hold_for_learned_weights(users, monkeypatch, weights):
+    # Published weights where sharing nothing can still rank high, so the later stages matter
+    monkeypatch.setattr(matching, "_weights", {"version": 1, "weights": weights})
+    monkeypatch.setattr(matching, "_weights_checked", float("inf"))
+    index = CandidateIndex(users)
+    for username in list(users)[::5]:
+        assert_exact(users, username, index.top_matches(username, 5), 5)
+
+
+def test_candidate_index_follows_profile_changes(users):
+    index = CandidateIndex(users)
+    loner = "student0000042"
+    users[loner] = dict(users[loner].items(), subjects=[], availability=[], interests=[])
+    index.update_user(loner, users[loner])
+    gone = "student0000043"
+    index.remove_user(gone)
+    del users[gone]
+
+    for username in (loner, "alice", "student0000044"):
+        matches = index.top_matches(username, 10)
+        assert gone not in [other for other, _ in matches]
+        assert_exact(users, username, matches, 10)
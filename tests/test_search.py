@@ -0,0 +1,65 @@
+from collections import Counter
+
+import pytest
+
+from search import tokenize
+from sharding import ShardedStore, migrate as migrate_shards
+from sqlite_storage import SQLiteStore, migrate as migrate_sqlite
+from storage import DataStore
+
+
+@pytest.fixture
+def stores(cohort, tmp_path):
+    migrate_sqlite(cohort, str(tmp_path / "data.db"))
+    migrate_shards(cohort, str(tmp_path / "shards"), shards=4)
+    return {"pickle": DataStore(cohort), "sqlite": SQLiteStore(str(tmp_path / "data.db")),
+            "sharded": ShardedStore(str(tmp_path / "shards"))}
+
+
+def message_key(message):
+    return message["from_username"], message["to_username"], message["message"]
+
+
+def feedback_key(feedback):
+    return feedback["from_username"], feedback["partner_username"], feedback["comments"]
+
+
+def expected_messages(store, query, username=None):
+    words = set(tokenize(query))
+    return Counter(message_key(m) for m in store.data["messages"]
+                   if words <= set(tokenize(m["message"]))
+                   and (username is None or username in (m["from_username"], m["to_username"])))
+
+
+@pytest.mark.parametrize("backend", ["pickle", "sqlite", "sharded"])
+def test_scoped_message_search_finds_only_the_users_conversations(stores, backend):
+    pickled, store = stores["pickle"], stores[backend]
+    found = 0
+    for username in sorted(pickled.data["users"])[::10]:
+        expected = expected_messages(pickled, "physics", username)
+        hits, total = store.search_messages("physics", username=username, limit=1000)
+        assert total == sum(expected.values())
+        assert Counter(message_key(m) for m, _ in hits) == expected
+        found += total
+    assert found
+
+
+@pytest.mark.parametrize("backend", ["pickle", "sqlite", "sharded"])
+def test_scoped_feedback_search_finds_only_the_users_comments(stores, backend):
+    pickled, store = stores["pickle"], stores[backend]
+    found = 0
+    for username in sorted(pickled.data["users"])[::10]:
+        expected = Counter(feedback_key(f) for f in pickled.user_feedback(username)
+                           if "pace" in tokenize(f.get("comments")))
+        hits, total = store.search_feedback("pace", username=username, limit=1000)
+        assert total == sum(expected.values())
+        assert Counter(feedback_key(f) for f, _ in hits) == expected
+        found += total
+    assert found
+
+
+def test_sharded_ranking_matches_one_store(stores):
+    pickled, sharded = stores["pickle"], stores["sharded"]
+    expected, _ = pickled.search_messages("physics message", limit=50)
+    hits, _ = sharded.search_messages("physics message", limit=50)
+    assert [score for _, score in hits] == pytest.approx([score for _, score in expected])
@@ -0,0 +1,61 @@
+import pytest
+
+import services
+from sharding import ShardedStore, migrate, shard_of
+from storage import DataStore, StorageError
+
+
+def test_migrated_shards_serve_the_same_data(cohort, tmp_path, user_view):
+    counts = migrate(cohort, str(tmp_path / "shards"), shards=4)
+    pickled, sharded = DataStore(cohort), ShardedStore(str(tmp_path / "shards"))
+
+    assert len(counts) == 4
+    assert sum(part["users"] for part in counts) == len(pickled.data["users"])
+    assert ({u: dict(profile.items()) for u, profile in sharded.data["users"].items()} ==
+            {u: dict(profile.items()) for u, profile in pickled.data["users"].items()})
+    for username in pickled.data["users"]:
+        assert user_view(sharded, username) == user_view(pickled, username), username
+
+
+def test_writes_through_the_services_match_the_pickle_store(cohort, tmp_path, user_view):
+    migrate(cohort, str(tmp_path / "shards"), shards=4)
+    stores = [DataStore(cohort), ShardedStore(str(tmp_path / "shards"))]
+    users = sorted(stores[0].data["users"])
+    # A pair living in different shards, so the invitation and messages are copied
+    sender = users[10]
+    recipient = next(u for u in users[11:] if shard_of(u, 4) != shard_of(sender, 4))
+
+    sent = []
+    for store in stores:
+        sent.append(services.send_invitation(store, sender, recipient, 0.75))
+        for invitation in store.received_invitations(recipient):
+            if invitation["from_username"] == sender and invitation["status"] == "pending":
+                services.respond_to_invitation(store, invitation["id"], accept=True)
+        services.send_message(store, sender, recipient, "see you at the library")
+        services.open_chat(store, recipient, sender)
+
+    assert sent[0] == sent[1]
+    for username in (sender, recipient):
+        assert user_view(stores[1], username) == user_view(stores[0], username)
+
+
+def test_ids_are_unique_across_shards(tmp_path):
+    store = ShardedStore(str(tmp_path / "shards"), shards=4)
+    users = ["user%02d" % i for i in range(20)]
+    sessions = [store.append("sessions", {"user1": a, "user2": b, "date": "2026-01-05", "time": "10:00",
+                                          "duration": "1 hour", "location": "Library", "subject": "Math",
+                                          "notes": "", "status": "scheduled", "created_at": "2026-01-01 10:00:00"},
+                             counter="session_counter")
+                for a, b in zip(users, users[1:])]
+
+    ids = [session["id"] for session in sessions]
+    assert len(set(ids)) == len(ids)
+    reopened = ShardedStore(str(tmp_path / "shards"))
+    for session in sessions:
+        assert reopened.get("sessions", session["id"])["user1"] == session["user1"]
+
+
+def test_migrating_into_an_existing_directory_is_refused(cohort, tmp_path):
+    migrate(cohort, str(tmp_path / "shards"), shards=2)
+    with pytest.raises(StorageError):
+        migrate(cohort, str(tmp_path / "shards"), shards=2)
@@ -0,0 +1,53 @@
+import pytest
+
+import services
+from sqlite_storage import SQLiteStore, migrate
+from storage import DataStore, StorageError
+
+
+def test_migrated_database_serves_the_same_data(cohort, tmp_path, user_view):
+    counts = migrate(cohort, str(tmp_path / "data.db"))
+    pickled, database = DataStore(cohort), SQLiteStore(str(tmp_path / "data.db"))
+
+    assert counts["messages"] == len(pickled.data["messages"])
+    for username in pickled.data["users"]:
+        assert user_view(database, username) == user_view(pickled, username), username
+
+
+def test_writes_through_the_services_match_the_pickle_store(cohort, tmp_path, user_view):
+    migrate(cohort, str(tmp_path / "data.db"))
+    stores = [DataStore(cohort), SQLiteStore(str(tmp_path / "data.db"))]
+    users = sorted(stores[0].data["users"])
+    sender, recipient = users[10], users[20]
+
+    sent = []
+    for store in stores:
+        sent.append(services.send_invitation(store, sender, recipient, 0.75))
+        for invitation in store.received_invitations(recipient):
+            if invitation["from_username"] == sender and invitation["status"] == "pending":
+                services.respond_to_invitation(store, invitation["id"], accept=True)
+        services.send_message(store, sender, recipient, "see you at the library")
+        services.open_chat(store, recipient, sender)
+        services.update_profile(store, sender, subjects=["Math", "Law"])
+
+    assert sent[0] == sent[1]
+    for username in (sender, recipient):
+        assert user_view(stores[1], username) == user_view(stores[0], username)
+    assert stores[1].data["users"][sender]["subjects"] == ["Math", "Law"]
+
+
+def test_migrating_into_an_existing_database_is_refused(cohort, tmp_path):
+    migrate(cohort, str(tmp_path / "data.db"))
+    with pytest.raises(StorageError):
+        migrate(cohort, str(tmp_path / "data.db"))
+
+
+def test_expected_values_reject_a_stale_update(tmp_path):
+    first, second = SQLiteStore(str(tmp_path / "data.db")), SQLiteStore(str(tmp_path / "data.db"))
+    session = first.append("sessions", {"user1": "alice", "user2": "bob", "date": "2026-01-05", "time": "10:00",
+                                        "duration": "1 hour", "location": "Library", "subject": "Math", "notes": "",
+                                        "status": "scheduled", "created_at": "2026-01-01 10:00:00"},
+                           counter="session_counter")
+    assert first.update("sessions", session["id"], expected={"status": "scheduled"}, status="completed")
+    assert not second.update("sessions", session["id"], expected={"status": "scheduled"}, status="cancelled")
+    assert second.get("sessions", session["id"])["status"] == "completed"
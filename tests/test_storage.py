@@ -0,0 +1,140 @@
+import multiprocessing
+import os
+import threading
+
+import pytest
+
+import storage
+from storage import DataStore, load_persistent_data, load_snapshot, log_segments, segment_path
+
+
+def message(sender, recipient, text):
+    return {"from_username": sender, "to_username": recipient, "message": text,
+            "timestamp": "2026-01-01 10:00:00", "read": False}
+
+
+def invitation(sender, recipient, status="pending"):
+    return {"from_username": sender, "to_username": recipient, "match_score": 0.5, "status": status,
+            "timestamp": "2026-01-01 10:00:00"}
+
+
+def test_writes_are_replayed_from_the_log(tmp_path):
+    path = str(tmp_path / "data.pkl")
+    store = DataStore(path)
+    sent = store.append("invitations", invitation("alice", "bob"), counter="invitation_counter")
+    store.update("invitations", sent["id"], status="accepted")
+    store.append("messages", message("alice", "bob", "hi"), counter="message_counter")
+    store.update_user("alice", subjects=["Chemistry"])
+    store.mark_read("bob", "alice")
+
+    assert not os.path.exists(path)
+    assert log_segments(path)
+    fresh = DataStore(path)
+    assert fresh.get("invitations", sent["id"])["status"] == "accepted"
+    assert [m["message"] for m in fresh.conversation("bob", "alice")] == ["hi"]
+    assert fresh.unread_count("bob", "alice") == 0
+    assert fresh.data["users"]["alice"]["subjects"] == ["Chemistry"]
+    assert load_persistent_data(path)["invitation_counter"] == sent["id"]
+
+
+def test_another_store_catches_up_on_refresh(tmp_path):
+    path = str(tmp_path / "data.pkl")
+    reader, writer = DataStore(path), DataStore(path)
+    writer.append("messages", message("alice", "bob", "one"), counter="message_counter")
+    reader.refresh()
+    assert [m["message"] for m in reader.conversation("alice", "bob")] == ["one"]
+
+
+def test_compaction_folds_the_log_into_the_snapshot(tmp_path):
+    path = str(tmp_path / "data.pkl")
+    store = DataStore(path)
+    for i in range(20):
+        store.append("messages", message("alice", "bob", f"m{i}"), counter="message_counter")
+    store.compact()
+
+    assert os.path.exists(path)
+    folded = load_snapshot(path)["log_generation"]
+    assert folded >= 1
+    assert all(generation > folded for generation, _ in log_segments(path))
+    store.append("messages", message("bob", "alice", "after"), counter="message_counter")
+    texts = [m["message"] for m in DataStore(path).conversation("alice", "bob")]
+    assert texts == [f"m{i}" for i in range(20)] + ["after"]
+
+
+def test_a_torn_last_line_is_skipped(tmp_path):
+    path = str(tmp_path / "data.pkl")
+    store = DataStore(path)
+    store.append("messages", message("alice", "bob", "whole"), counter="message_counter")
+    with open(segment_path(path, store._generation), "a", encoding="utf-8") as f:
+        f.write('{"op": "append", "collection": "mess')
+
+    fresh = DataStore(path)
+    assert [m["message"] for m in fresh.conversation("alice", "bob")] == ["whole"]
+    # The next write starts on a fresh line instead of gluing onto the torn one
+    fresh.append("messages", message("bob", "alice", "next"), counter="message_counter")
+    assert [m["message"] for m in DataStore(path).conversation("alice", "bob")] == ["whole", "next"]
+
+
+def test_a_snapshot_that_cannot_be_read_raises(tmp_path):
+    path = str(tmp_path / "data.pkl")
+    with open(path, "wb") as f:
+        f.write(b"not a pickle")
+    with pytest.raises(storage.StorageError):
+        DataStore(path)
+
+
+def test_update_with_expected_values_rejects_a_stale_write(tmp_path):
+    path = str(tmp_path / "data.pkl")
+    first, second = DataStore(path), DataStore(path)
+    sent = first.append("invitations", invitation("alice", "bob"), counter="invitation_counter")
+    second.refresh()
+
+    assert first.update("invitations", sent["id"], expected={"status": "pending"}, status="accepted")
+    assert not second.update("invitations", sent["id"], expected={"status": "pending"}, status="declined")
+    assert DataStore(path).get("invitations", sent["id"])["status"] == "accepted"
+
+
+def test_changes_to_different_fields_merge(tmp_path):
+    path = str(tmp_path / "data.pkl")
+    first, second = DataStore(path), DataStore(path)
+    first.update_user("alice", subjects=["Art"])
+    second.update_user("alice", study_style="Auditory")
+    profile = DataStore(path).data["users"]["alice"]
+    assert (profile["subjects"], profile["study_style"]) == (["Art"], "Auditory")
+
+
+def _append_messages(path, sender, count):
+    store = DataStore(path)
+    for i in range(count):
+        store.append("messages", message(sender, "bob", f"{sender}{i}"), counter="message_counter")
+
+
+def test_processes_writing_at_once_get_unique_ids(tmp_path):
+    path = str(tmp_path / "data.pkl")
+    senders = ["alice", "carol", "david", "emma"]
+    processes = [multiprocessing.Process(target=_append_messages, args=(path, sender, 25)) for sender in senders]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    messages = list(DataStore(path).data["messages"])
+    assert sorted(m["id"] for m in messages) == list(range(1, 101))
+    assert sorted(m["message"] for m in messages) == sorted(f"{s}{i}" for s in senders for i in range(25))
+
+
+def test_a_transaction_keeps_check_and_write_together(tmp_path):
+    path = str(tmp_path / "data.pkl")
+    store = DataStore(path)
+
+    def invite_once():
+        with store.transaction("alice", "bob"):
+            if not store.has_sent_invitation("alice", "bob"):
+                store.append("invitations", invitation("alice", "bob"), counter="invitation_counter")
+
+    threads = [threading.Thread(target=invite_once) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(DataStore(path).sent_invitations("alice")) == 1
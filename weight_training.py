@@ -0,0 +1,105 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from matching import DEFAULT_WEIGHTS, MATCH_WEIGHTS_FILE, MatchEngine
+from storage import STORAGE_FILE, get_store
+
+# Pull toward the hand-set weights; keeps a handful of ratings from swinging the scorer
+RIDGE = 5.0
+STUDY_AGAIN_SCORES = {"Yes": 1.0, "Maybe": 0.5, "No": 0.0}
+
+
+def satisfaction(feedback):
+    """How well each session went, from 0 to 1: rating, productivity and
+    would-study-again weighted equally"""
+    rating = np.array([f["rating"] for f in feedback], dtype=np.float64)
+    productivity = np.array([f["productivity"] for f in feedback], dtype=np.float64)
+    again = np.array([STUDY_AGAIN_SCORES.get(f["would_study_again"], 0.5) for f in feedback])
+    return ((rating - 1) / 4 + (productivity - 1) / 4 + again) / 3
+
+
+def load_state(path=MATCH_WEIGHTS_FILE):
+    """Published weights plus the running sums they were solved from"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def fit(xtx, xty):
+    """Ridge regression toward the default weights, clipped to non-negative and
+    scaled so that a perfect match scores 1 like the hand-set weights"""
+    prior = np.array(list(DEFAULT_WEIGHTS.values()))
+    weights = np.clip(np.linalg.solve(xtx + RIDGE * np.eye(len(prior)), xty + RIDGE * prior), 0, None)
+    best = weights[:3].sum() + weights[3:].max()
+    if best > 0:
+        weights /= best
+    return dict(zip(DEFAULT_WEIGHTS, weights.tolist()))
+
+
+def mean_squared_error(weights, xtx, xty, yty, samples):
+    w = np.array(list(weights.values()))
+    return float((w @ xtx @ w - 2 * w @ xty + yty) / samples) if samples else None
+
+
+def train(data_path=STORAGE_FILE, weights_path=MATCH_WEIGHTS_FILE, full=False):
+    """Fold the feedback written since the last run into the running sums and
+    publish a new weight version if there was any; returns a report"""
+    state = load_state(weights_path)
+    if full or state is None or state.get("data") != os.path.abspath(data_path):
+        state = {"version": state["version"] if state else 0, "cursor": 0, "samples": 0, "yty": 0.0,
+                 "xtx": np.zeros((len(DEFAULT_WEIGHTS),) * 2).tolist(), "xty": [0.0] * len(DEFAULT_WEIGHTS)}
+    xtx, xty, yty = np.array(state["xtx"]), np.array(state["xty"]), state["yty"]
+
+    store = get_store(data_path)
+    store.refresh()
+    users = store.data["users"]
+    feedback, cursor = store.feedback_since(state["cursor"])
+    # Features come from the partners' current profiles; feedback about removed users is skipped
+    feedback = [f for f in feedback if f["from_username"] in users and f.get("partner_username") in users]
+
+    started = time.perf_counter()
+    if feedback:
+        engine = MatchEngine(users)
+        features = engine.pair_features(np.array([engine.row[f["from_username"]] for f in feedback]),
+                                        np.array([engine.row[f["partner_username"]] for f in feedback]))
+        target = satisfaction(feedback)
+        xtx += features.T @ features
+        xty += features.T @ target
+        yty += float(target @ target)
+
+    samples = state["samples"] + len(feedback)
+    report = {"new_feedback": len(feedback), "samples": samples, "version": state["version"]}
+    if feedback:
+        state = dict(state, version=state["version"] + 1, weights=fit(xtx, xty),
+                     trained_at=time.strftime("%Y-%m-%d %H:%M:%S"))
+        report.update(version=state["version"], weights=state["weights"])
+    if feedback or cursor != state["cursor"]:
+        # Saved even when every new row was skipped, so those rows are not read again next run
+        state.update(data=os.path.abspath(data_path), cursor=cursor, samples=samples, xtx=xtx.tolist(),
+                     xty=xty.tolist(), yty=yty)
+        tmp_path = weights_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_path, weights_path)
+    report["train_seconds"] = time.perf_counter() - started
+    if samples:
+        report["mse_default"] = mean_squared_error(DEFAULT_WEIGHTS, xtx, xty, yty, samples)
+        if "weights" in state:
+            report["mse_learned"] = mean_squared_error(state["weights"], xtx, xty, yty, samples)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Learn match weights from session feedback and publish them")
+    parser.add_argument("--data", default=STORAGE_FILE)
+    parser.add_argument("--weights", default=MATCH_WEIGHTS_FILE)
+    parser.add_argument("--full", action="store_true", help="retrain from all feedback instead of only new feedback")
+    args = parser.parse_args()
+
+    print(json.dumps(train(args.data, args.weights, full=args.full), indent=2))